@@ -1,4 +1,3 @@
-import torch
 import torch.nn as nn
 
 from itertools import chain
@@ -6,40 +5,70 @@ from itertools import chain
 import aux_funcs as af
 import model_funcs as mf
 
+
 class DenseNet(nn.Module):
 
-    def __init__(self, total_size, ics, init_weights=True):
+    def __init__(self, params):
         super(DenseNet, self).__init__()
-        self.total_size = total_size
-        self.init_weights = init_weights
-        self.ics = ics
+        self.ic_only = False
+        self.augment_training = params['augment_training']
+        self.init_weights = params['init_weights']
+        self.total_size = params['size']
+        self.ics = params['ics']
         self.num_ics = sum(self.ics)
-        self.num_class = 10
+        self.prune = params['prune']
+        self.init_type = 'dense'  # every layer sees the features of all the previous ones
+
+        if self.prune:
+            self.keep_ratio = params['keep_ratio']
+
+        if 'memory_efficient' in params:
+            self.memory_efficient = params['memory_efficient']
+        else:
+            self.memory_efficient = False
+
+        if len(self.ics) != self.total_size:
+            raise ValueError(
+                "final size of network does not match the length of ics array: {}; {}".format(self.total_size,
+                                                                                              self.ics))
+
+        self.num_class = int(params['num_classes'])
         self.num_output = 0
 
         self.train_func = mf.iter_training_0
         self.test_func = mf.sdn_test
 
         self.input_size = 32
-        self.in_channels = 16
-        self.cum_in_channels = self.in_channels
+        self.in_channels = 16  # number of channels of the concatenation of all the grown features
+        self.growth_rate = params['growth_rate'] if 'growth_rate' in params else 16
+
+        # the layers between two ICs add growth_rate more channels than the previous ones
+        self.layer_channels = []
+        stage = 1
+        for ic in self.ics:
+            self.layer_channels.append(self.growth_rate * stage)
+            stage += ic
+        self.final_channels = self.in_channels + sum(self.layer_channels)
 
         self.init_conv = nn.Sequential(*[
             nn.Conv2d(3, self.in_channels, kernel_size=3, stride=1, padding=1, bias=False),
             nn.BatchNorm2d(self.in_channels),
-            nn.ReLu()
+            nn.ReLU()
         ])
 
+        self.layers = nn.ModuleList()
+
+        red_size = int(self.input_size / 8)
         self.end_layers = nn.Sequential(*[
             nn.AvgPool2d(kernel_size=8),
             af.Flatten(),
-            nn.linear(2560, self.num_class)
+            nn.Linear(self.final_channels * red_size * red_size, self.num_class)
         ])
         self.grow()
 
         if self.init_weights:
             self._init_weights(self.modules())
-    
+
     def _init_weights(self, it):
         for m in it:
             if isinstance(m, nn.Conv2d):
@@ -49,18 +78,19 @@ class DenseNet(nn.Module):
                 nn.init.constant_(m.bias, 0)
 
     def forward(self, x):
-        outputs = []
         fwd = self.init_conv(x)
-        added_input = fwd
-        for layer in self.layers:
-            fwd, is_output, output = layer(added_input)
-            added_input = torch.cat([added_input, fwd], 1)
-            if is_output:
-                outputs.append(output)
+        added_input, outputs = af.dense_forward(fwd, self.layers, self.in_channels, self.memory_efficient)
         if self.num_output == self.num_ics + 1:
             outputs.append(self.end_layers(added_input))
         return outputs
 
+    # same interface as ResNet_Baseline, the final output is only computed once the network is fully grown
+    def to_train(self):
+        pass
+
+    def to_eval(self):
+        pass
+
     def grow(self):
         nb_grow = 0
         add_ic = False
@@ -71,6 +101,8 @@ class DenseNet(nn.Module):
             if tmp >= self.num_output:
                 ics_index = ind
                 break
+        if tmp == self.num_ics:  # no more ICs are to be grown
+            self.to_eval()
         pos = 1
         if ics_index == 0:
             pos = 0
@@ -82,40 +114,68 @@ class DenseNet(nn.Module):
         layers = []
         for i in range(nb_grow):
             layers.append(ConvBNRLUnit(
-                self.in_channels, 16*self.num_output, 
-                add_ic = add_ic if i == nb_grow-1 else False
+                self.in_channels, self.layer_channels[len(self.layers) + i],
+                add_ic=add_ic if i == nb_grow - 1 else False,
+                num_classes=self.num_class, input_size=self.input_size
             ))
             self.in_channels += layers[-1].out_channels
         if self.init_weights:
             self._init_weights(layers)
         self.layers.extend(layers)
         self.num_output += 1
+        return filter(lambda p: p.requires_grad, [p for l in layers for p in l.parameters(True)])
+
+    # structure of the grown network, saved in the checkpoints so that it is rebuilt without replaying the growth
+    def get_manifest(self):
+        return {
+            'in_channels': [layer.layers[0].in_channels for layer in self.layers],
+            'add_ic': [not layer.no_output for layer in self.layers],
+            'num_output': self.num_output,
+            'total_channels': self.in_channels
+        }
+
+    def rebuild(self, manifest):
+        self.layers = nn.ModuleList([
+            ConvBNRLUnit(in_channels, self.layer_channels[i], add_ic=add_ic,
+                         num_classes=self.num_class, input_size=self.input_size)
+            for i, (in_channels, add_ic) in enumerate(zip(manifest['in_channels'], manifest['add_ic']))])
+        self.num_output = manifest['num_output']
+        self.in_channels = manifest['total_channels']
+
 
 class ConvBNRLUnit(nn.Module):
 
     def __init__(self, in_channels, out_channels, add_ic=False, num_classes=10, input_size=32):
-        super(ConvBNRLUnit, self)
+        super(ConvBNRLUnit, self).__init__()
+        self.out_channels = out_channels
+        self.depth = 1
+
         self.layers = nn.Sequential(*[
-            nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1),
+            nn.Conv2d(in_channels, out_channels, kernel_size=3, stride=1, padding=1, bias=False),
             nn.BatchNorm2d(out_channels),
-            nn.ReLu()
+            nn.ReLU()
         ])
-        
+
         if add_ic:
-            self.ic = af.InternalClassifier(input_size, out_channels, num_classes)
+            self.output = af.InternalClassifier(input_size, out_channels, num_classes)
+            self.no_output = False
         else:
-            self.ic = None
-        
+            self.output = None
+            self.forward = self.only_forward
+            self.no_output = True
+
     def forward(self, x):
         fwd = self.layers(x)
-        return fwd, self.ic is not None, None if self.ic is None else self.ic(fwd)
-    
+        return fwd, 1, self.output(fwd)
+
     def only_output(self, x):
-        return self.ic(self.layers(x))
+        return self.output(self.layers(x))
+
+    def only_forward(self, x):
+        return self.layers(x), 0, None
 
     def get_parameters(self):
-        if hasattr(self, 'output'):
-            return chain(self.layers.parameters(True), self.output.parameter)
+        if self.output is not None:
+            return chain(self.layers.parameters(True), self.output.parameters(True))
         else:
             return self.layers.parameters(True)
-    
@@ -25,6 +25,24 @@ class ResNet_Baseline(nn.Module):
         if self.prune:
             self.keep_ratio = params["keep_ratio"]
 
+        # recompute the dense connections in the backward instead of storing them
+        if 'memory_efficient' in params:
+            self.memory_efficient = params['memory_efficient']
+        else:
+            self.memory_efficient = False
+
+        # initialization of the grown layers: 'kaiming', 'zero' (the new cells start as identities)
+        # or 'copy' (copies of the last cell and of the last ic, with noise)
+        if 'growth_init' in params:
+            self.growth_init = params['growth_init']
+        else:
+            self.growth_init = 'kaiming'
+        self.growth_noise = params['growth_noise'] if 'growth_noise' in params else 0.01
+
+        if self.growth_init not in ['kaiming', 'zero', 'copy']:
+            raise KeyError(
+                "the growth_init should be either 'kaiming', 'zero' or 'copy' and it is: {}".format(self.growth_init))
+
         if 'mode' in params:
             self.mode = params['mode']
         else:
@@ -131,27 +149,15 @@ class ResNet_Baseline(nn.Module):
         return outputs
 
     def forward_eval_dense(self, input):
-        outputs = []
         fwd = self.init_conv(input)
-        added_input = fwd
-        for layer in self.layers:
-            fwd, is_output, output = layer(added_input)
-            added_input = torch.cat([added_input, fwd], 1)
-            if is_output:
-                outputs.append(output)
+        added_input, outputs = af.dense_forward(fwd, self.layers, self.in_channels, self.memory_efficient)
         fwd = self.end_layers(added_input)
         outputs.append(fwd)
         return outputs
 
     def forward_train_dense(self, input):
-        outputs = []
         fwd = self.init_conv(input)
-        added_input = fwd
-        for layer in self.layers:
-            fwd, is_output, output = layer(added_input)
-            added_input = torch.cat([added_input, fwd], 1)
-            if is_output:
-                outputs.append(output)
+        _, outputs = af.dense_forward(fwd, self.layers, self.in_channels, self.memory_efficient)
         return outputs
 
     def to_train(self):
@@ -203,6 +209,52 @@ class ResNet_Baseline(nn.Module):
                          self.num_class, 32, 1)
                 ))
         self._init_weights(layers)
+        if len(self.layers) > 0:
+            self._init_grown(layers)
         self.layers.extend(layers)
         self.num_output += 1
         return filter(lambda p: p.requires_grad, [p for l in layers for p in l.parameters(True)])
+
+    # zero gamma on the last batch norm of the residual branch: the new cell starts as relu(shortcut), an identity
+    # (function preserving growth) when the shortcut is one; the projection shortcut of the dense cells keeps its
+    # init, with a zero gamma there too the cell would output relu(0) and never get a gradient
+    def _zero_init(self, layer):
+        nn.init.constant_(layer.layers[0][-1].weight, 0)
+
+    def _copy_init(self, layer, source):
+        state = {k: v for k, v in source.state_dict().items() if 'weight_mask' not in k}
+        layer.load_state_dict(state, strict=False)
+        for m in layer.modules():
+            if isinstance(m, nn.Conv2d):
+                m.weight.data.add_(torch.randn_like(m.weight) * m.weight.std() * self.growth_noise)
+
+    def _init_grown(self, layers):
+        last_ic = None
+        for layer in self.layers:
+            if not layer.no_output:
+                last_ic = layer.output
+        for layer in layers:
+            if self.growth_init == 'zero':
+                self._zero_init(layer)
+            elif self.growth_init == 'copy':
+                if self.init_type == 'dense':  # the input channels differ from the last cell
+                    self._zero_init(layer)
+                else:
+                    self._copy_init(layer.layers, self.layers[-1].layers)
+                if not layer.no_output and last_ic is not None:
+                    layer.output.load_state_dict(last_ic.state_dict(), strict=False)
+
+    # structure of the grown network, saved in the checkpoints so that it is rebuilt without replaying the growth
+    def get_manifest(self):
+        return {
+            'in_channels': [layer.layers[0][0].in_channels for layer in self.layers],
+            'add_ic': [not layer.no_output for layer in self.layers],
+            'num_output': self.num_output,
+            'total_channels': self.in_channels
+        }
+
+    def rebuild(self, manifest):
+        self.layers = nn.ModuleList([self.block(in_channels, 16, (add_ic, self.num_class, 32, 1))
+                                     for in_channels, add_ic in zip(manifest['in_channels'], manifest['add_ic'])])
+        self.num_output = manifest['num_output']
+        self.in_channels = manifest['total_channels']
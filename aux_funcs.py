@@ -2,14 +2,18 @@
 # contains auxiliary functions for optimizers, internal classifiers, confusion metric
 # conversion between CNNs and SDNs and also plotting
 
+import atexit
 import copy
 import itertools as it
+import json
 import math
 import os
 import os.path
 import pickle
+import queue
 import random
 import sys
+import threading
 import time
 import statistics
 from functools import reduce
@@ -30,37 +34,110 @@ from bisect import bisect_right
 from torch.optim import SGD, Adam
 from torch.optim.lr_scheduler import _LRScheduler, ExponentialLR
 from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint
 
+import metrics_stream
 import network_architectures as arcs
+import registry
 import snip
 from profiler import profile
 
-from data import CIFAR10, CIFAR100, TinyImagenet
+from data import CIFAR10, CIFAR100, TinyImagenet, Synthetic, SYNTHETIC
 
 
 # to log the output of the experiments to a file
+# the writes are handed to a background thread through a bounded queue, the thread writes them to the terminal and
+# to the log file and flushes every flush_interval seconds and at exit, so the prints of the training never wait
+# on the file; record() adds a structured record to the json lines file <log_file>.jsonl
 class Logger(object):
-    def __init__(self, log_file, mode='out'):
+    _STOP = object()
+    _FLUSH = object()
+
+    def __init__(self, log_file, mode='out', flush_interval=1., max_queue=10000):
         if mode == 'out':
             self.terminal = sys.stdout
         else:
             self.terminal = sys.stderr
 
+        self.log_file = log_file
         self.log = open('{}.{}'.format(log_file, mode), "a")
-        print(self.log)
+        self.json_log = None  # opened with the first record
+        self.flush_interval = flush_interval
+        # when the queue is full the writers wait for the thread instead of losing messages
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.closed = False
+        self.pid = os.getpid()  # the forked processes (data loader workers) do not have the thread
+        self.thread = threading.Thread(target=self._run, name='logger', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
 
     def write(self, message):
-        self.terminal.write(message)
-        self.terminal.flush()
-        self.log.write(message)
-        self.log.flush()
+        if self.closed or os.getpid() != self.pid:
+            self.terminal.write(message)
+            return
+        self.queue.put(('text', message))
+
+    def record(self, **fields):
+        fields.setdefault('time', time.time())
+        if not self.closed and os.getpid() == self.pid:
+            self.queue.put(('json', fields))
+
+    def _write_item(self, item):
+        kind, payload = item
+        if kind == 'text':
+            self.terminal.write(payload)
+            self.log.write(payload)
+        else:
+            if self.json_log is None:
+                self.json_log = open('{}.jsonl'.format(self.log_file), 'a')
+            self.json_log.write(json.dumps(payload, default=lambda o: o.tolist() if hasattr(o, 'tolist') else float(o)))
+            self.json_log.write('\n')
 
-    def flush(self):
+    def _flush_files(self):
         self.terminal.flush()
         self.log.flush()
+        if self.json_log is not None:
+            self.json_log.flush()
+
+    def _run(self):
+        last_flush = time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = None
+            try:
+                if item is Logger._STOP:
+                    self._flush_files()
+                    return
+                if item is not None and item is not Logger._FLUSH:
+                    self._write_item(item)
+                if item is Logger._FLUSH or time.time() - last_flush >= self.flush_interval:
+                    self._flush_files()
+                    last_flush = time.time()
+            except Exception as e:  # the thread keeps running, the writers would wait for it
+                self.terminal.write('logger error: {}\n'.format(e))
+            finally:
+                if item is not None:
+                    self.queue.task_done()
 
-    def __del__(self):
+    def flush(self):
+        # waits until everything written before is in the files
+        if self.closed:
+            self.terminal.flush()
+            return
+        self.queue.put(Logger._FLUSH)
+        self.queue.join()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(Logger._STOP)
+        self.thread.join()
         self.log.close()
+        if self.json_log is not None:
+            self.json_log.close()
 
 
 def set_logger(log_file):
@@ -68,6 +145,12 @@ def set_logger(log_file):
     # sys.stderr = Logger(log_file, 'err')
 
 
+# structured record in the json lines file of the logger, if there is one
+def log_record(**fields):
+    if isinstance(sys.stdout, Logger):
+        sys.stdout.record(**fields)
+
+
 # the learning rate scheduler
 class MultiStepMultiLR(_LRScheduler):
     def __init__(self, optimizer, milestones, gammas, last_epoch=-1):
@@ -78,17 +161,64 @@ class MultiStepMultiLR(_LRScheduler):
         self.gammas = gammas
         super(MultiStepMultiLR, self).__init__(optimizer, last_epoch)
 
+    def group_lr(self, group, epoch):
+        # the groups added during the training (growth) have their own initial_lr and an optional warmup
+        cur_milestone = bisect_right(self.milestones, epoch)
+        new_lr = group['initial_lr'] * np.prod(self.gammas[:cur_milestone])
+        if group.get('warmup_epochs', 0) > 0:
+            new_lr *= min(1., float(epoch - group['warmup_start'] + 1) / group['warmup_epochs'])
+        return round(new_lr, 8)
+
     def get_lr(self):
-        lrs = []
-        for base_lr in self.base_lrs:
-            cur_milestone = bisect_right(self.milestones, self.last_epoch)
-            new_lr = base_lr * np.prod(self.gammas[:cur_milestone])
-            new_lr = round(new_lr, 8)
-            lrs.append(new_lr)
+        # every group of the optimizer, not only the ones that existed when the scheduler was built
+        self.base_lrs = [group['initial_lr'] for group in self.optimizer.param_groups]
+        lrs = [self.group_lr(group, self.last_epoch) for group in self.optimizer.param_groups]
         print("base_lrs: {}".format(self.base_lrs))
         print("af scheduler: {}".format(lrs))
         return lrs
 
+
+# registers the parameters of the grown layers in the optimizer and the scheduler
+class GrowthManager(object):
+    def __init__(self, optimizer, scheduler, warmup_epochs=0):
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.warmup_epochs = warmup_epochs  # the lr of the new layers grows linearly during these epochs
+
+    def add_params(self, params):
+        params = list(params)
+        if len(params) == 0:
+            return None
+        group = {'params': params, 'initial_lr': self.optimizer.param_groups[0]['initial_lr']}
+        if self.warmup_epochs > 0:
+            # the scheduler steps at the beginning of the epoch, before the first training of the new layers
+            group['warmup_epochs'] = self.warmup_epochs
+            group['warmup_start'] = self.scheduler.last_epoch + 1
+        group['lr'] = self.scheduler.group_lr(group, self.scheduler.last_epoch + 1)
+        self.optimizer.add_param_group(group)
+        self.scheduler.base_lrs.append(group['initial_lr'])
+        return group
+
+    def grow(self, model, device):
+        grown_layers = model.grow()
+        model.to(device)
+        return self.add_params(grown_layers)
+
+
+def get_dead_cells(model, cells, images, labels):
+    # indices of the cells whose layers (ic excluded) get no gradient from the loss of the outputs on a batch,
+    # e.g. grown cells cut off by their initialization
+    model.train()
+    model.zero_grad()
+    outputs = model(images)
+    outputs = outputs if isinstance(outputs, list) else [outputs]
+    sum([get_loss_criterion()(output, labels) for output in outputs]).backward()
+    dead = [i for i, cell in enumerate(cells)
+            if not any(p.grad is not None and float(p.grad.abs().sum()) > 0 for p in cell.layers.parameters())]
+    model.zero_grad()
+    return dead
+
+
 class SGDForPruning(Optimizer):
 
     def __init__(self, params, lr=required, momentum=0, dampening=0,
@@ -118,39 +248,128 @@ class SGDForPruning(Optimizer):
             with torch.enable_grad():
                 loss = closure()
 
+        # the groups with the same hyperparameters (one per growth) are updated together
+        batches = {}
         for group in self.param_groups:
-            weight_decay = group['weight_decay']
-            momentum = group['momentum']
-            dampening = group['dampening']
-            nesterov = group['nesterov']
-
-            for p in group['params']:
-                if p.grad is None:
-                    continue
-                d_p = p.grad
-                if weight_decay != 0:
-                    d_p = d_p.add(p, alpha=weight_decay)
-                if momentum != 0:
-                    param_state = self.state[p]
-                    if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.clone(d_p).detach()
-                    else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
-                    if nesterov:
-                        d_p = d_p.add(buf, alpha=momentum)
-                    else:
-                        d_p = buf
-                d_p[p==0.] = 0.
-                p.add_(d_p, alpha=-group['lr'])
+            key = (group['lr'], group['weight_decay'], group['momentum'], group['dampening'], group['nesterov'])
+            batches.setdefault(key, []).extend([p for p in group['params'] if p.grad is not None])
+
+        step = self._step_foreach if hasattr(torch, '_foreach_add_') else self._step_params
+        for (lr, weight_decay, momentum, dampening, nesterov), params in batches.items():
+            if len(params) > 0:
+                step(params, lr, weight_decay, momentum, dampening, nesterov)
         return loss
 
+    def _step_params(self, params, lr, weight_decay, momentum, dampening, nesterov):
+        for p in params:
+            d_p = p.grad
+            if weight_decay != 0:
+                d_p = d_p.add(p, alpha=weight_decay)
+            if momentum != 0:
+                param_state = self.state[p]
+                if 'momentum_buffer' not in param_state:
+                    buf = param_state['momentum_buffer'] = torch.clone(d_p).detach()
+                else:
+                    buf = param_state['momentum_buffer']
+                    buf.mul_(momentum).add_(d_p, alpha=1 - dampening)
+                if nesterov:
+                    d_p = d_p.add(buf, alpha=momentum)
+                else:
+                    d_p = buf
+            d_p[p==0.] = 0.
+            p.add_(d_p, alpha=-lr)
+
+    # same update with one kernel per operation for all the parameters, the masking of the pruned weights
+    # applies to the same tensors: the gradients, the new ones with weight decay or the momentum buffers
+    def _step_foreach(self, params, lr, weight_decay, momentum, dampening, nesterov):
+        d_ps = [p.grad for p in params]
+        if weight_decay != 0:
+            d_ps = torch._foreach_add(d_ps, params, alpha=weight_decay)
+        if momentum != 0:
+            bufs, old_bufs, old_d_ps = [], [], []
+            for p, d_p in zip(params, d_ps):
+                param_state = self.state[p]
+                if 'momentum_buffer' not in param_state:
+                    param_state['momentum_buffer'] = torch.clone(d_p).detach()
+                else:
+                    old_bufs.append(param_state['momentum_buffer'])
+                    old_d_ps.append(d_p)
+                bufs.append(param_state['momentum_buffer'])
+            if len(old_bufs) > 0:
+                torch._foreach_mul_(old_bufs, momentum)
+                torch._foreach_add_(old_bufs, old_d_ps, alpha=1 - dampening)
+            if nesterov:
+                d_ps = torch._foreach_add(d_ps, bufs, alpha=momentum)
+            else:
+                d_ps = bufs
+        torch._foreach_mul_(d_ps, [p.ne(0.).to(p.dtype) for p in params])
+        torch._foreach_add_(params, d_ps, alpha=-lr)
+
 # flatten the output of conv layers for fully connected layers
 class Flatten(nn.Module):
     def forward(self, input):
         return input.view(input.size(0), -1)
 
 
+# dense connectivity without a torch.cat after every layer: the features of all the layers are written in
+# their own channel slice of one preallocated (B, C_total, H, W) buffer and each layer reads a prefix view of it
+class _DenseView(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, buffer, *features):
+        ctx.channels = [f.size(1) for f in features]
+        return buffer[:, :sum(ctx.channels)]
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        # the gradient of the view goes back to the layers that produced each slice
+        return (None,) + tuple(grad_output.split(ctx.channels, 1))
+
+
+class DenseFeatures(object):
+    def __init__(self, first, total_channels):
+        self.buffer = first.new_empty((first.size(0), total_channels) + tuple(first.shape[2:]))
+        self.features = []
+        self.channels = 0
+        self.append(first)
+
+    def append(self, fwd):
+        # written through .data: autograd does not see the write, so the views already given to the
+        # previous layers (and saved for their backward) are not invalidated, they do not overlap it anyway
+        self.buffer.data[:, self.channels:self.channels + fwd.size(1)] = fwd.detach()
+        self.features.append(fwd)
+        self.channels += fwd.size(1)
+
+    def view(self):
+        return _DenseView.apply(self.buffer, *self.features)
+
+
+def _checkpointed_dense_layer(layer, buffer):
+    def run(*features):
+        fwd, is_output, output = layer(_DenseView.apply(buffer, *features))
+        return (fwd, output) if is_output else (fwd,)
+    return run
+
+
+# memory_efficient: the layers are gradient-checkpointed, only their input features are kept for the backward
+# and the view of the buffer, the batch norms and the activations inside the layers are recomputed
+def dense_forward(first, layers, total_channels, memory_efficient=False):
+    features = DenseFeatures(first, total_channels)
+    outputs = []
+    checkpointed = memory_efficient and torch.is_grad_enabled() and first.requires_grad
+    for layer in layers:
+        if checkpointed:
+            res = checkpoint(_checkpointed_dense_layer(layer, features.buffer), *features.features)
+            fwd = res[0]
+            if len(res) == 2:
+                outputs.append(res[1])
+        else:
+            fwd, is_output, output = layer(features.view())
+            if is_output:
+                outputs.append(output)
+        features.append(fwd)
+    return features.view(), outputs
+
+
 # the formula for feature reduction in the internal classifiers
 def feature_reduction_formula(input_feature_map_size):
     if input_feature_map_size >= 4:
@@ -248,6 +467,9 @@ def get_dataset(dataset, batch_size=128, add_trigger=False):
         return load_cifar100(batch_size)
     elif dataset == 'tinyimagenet':
         return load_tinyimagenet(batch_size)
+    elif dataset in SYNTHETIC:
+        return load_synthetic(dataset, batch_size)
+    raise KeyError("unknown dataset: {}".format(dataset))
 
 
 def load_cifar10(batch_size, add_trigger=False):
@@ -265,6 +487,12 @@ def load_tinyimagenet(batch_size):
     return tiny_imagenet
 
 
+def load_synthetic(dataset, batch_size, **kwargs):
+    # kwargs override the shape of the real dataset, e.g. num_train
+    params = dict(SYNTHETIC[dataset], **kwargs)
+    return Synthetic(batch_size=batch_size, **params)
+
+
 def get_output_relative_depths(model):
     total_depth = model.init_depth
     output_depths = []
@@ -354,35 +582,39 @@ def get_loss_criterion():
     return CrossEntropyLoss()
 
 
-def get_all_trained_models_info(models_path, use_profiler=False, device='gpu'):
+def get_all_trained_models_info(models_path, use_profiler=False, device='gpu', index_missing=False):
     print('Testing all models in: {}'.format(models_path))
 
-    for model_name in sorted(os.listdir(models_path)):
+    # the listing only queries the registry, index_missing=True (or python registry.py <models_path>) first
+    # indexes the models saved without it
+    if index_missing:
+        registry.index_existing(models_path, arcs.load_params, missing_only=True)
+
+    for run in registry.get_runs_params(models_path, with_curves=True):
+        model_name = run['name']
         try:
-            model_params = arcs.load_params(models_path, model_name, -1)
-            train_time = model_params['total_time']
-            num_epochs = model_params['epochs']
-            architecture = model_params['architecture']
+            architecture = run['architecture']
             print(model_name)
-            task = model_params['task']
-            print(task)
-            net_type = model_params['network_type']
-            print(net_type)
+            print(run['task'])
+            print(run['network_type'])
 
-            top1_test = model_params['test_top1_acc']
-            top1_train = model_params['train_top1_acc']
-            top5_test = model_params['test_top5_acc']
-            top5_train = model_params['train_top5_acc']
+            top1_test = run['test_top1_acc']
+            top3_test = run['test_top3_acc']
+            top1_train = run['train_top1_acc']
+            top3_train = run['train_top3_acc']
 
-            print('Top1 Test accuracy: {}'.format(top1_test[-1]))
-            print('Top5 Test accuracy: {}'.format(top5_test[-1]))
-            print('\nTop1 Train accuracy: {}'.format(top1_train[-1]))
-            print('Top5 Train accuracy: {}'.format(top5_train[-1]))
+            print('Top1 Test accuracy: {}'.format(top1_test[-1] if top1_test else None))
+            print('Top3 Test accuracy: {}'.format(top3_test[-1] if top3_test else None))
+            print('\nTop1 Train accuracy: {}'.format(top1_train[-1] if top1_train else None))
+            print('Top3 Train accuracy: {}'.format(top3_train[-1] if top3_train else None))
+            print('Best epoch: {}'.format(run['best_epoch']))
+            print('Training time: {}, in {} epochs'.format(run['total_time'], run['epochs']))
 
-            print('Training time: {}, in {} epochs'.format(train_time, num_epochs))
+            if run['flops'] is not None:
+                print('Flops: {}'.format(run['flops']))
 
             if use_profiler:
-                model, _ = arcs.load_model(models_path, model_name, epoch=-1)
+                model, model_params = arcs.load_model(models_path, model_name, epoch=-1)
                 model.to(device)
                 input_size = model_params['input_size']
 
@@ -618,6 +850,16 @@ def print_acc(arr, groups=None, extend=False):
                 print("{} stds: {}".format(i, stds))
                 print("{} std /100: {}".format(i, [100 * std / mean for std, mean in zip(stds, means)]))
 
+# same as print_acc and plot_acc for the runs of the registry whose name matches name_like, e.g. '%dense%'
+def print_registry_acc(models_path, name_like=None, groups=None, extend=False):
+    runs = registry.get_runs_params(models_path, name_like)
+    print_acc([(None, run) for run in runs], groups, extend)
+
+
+def plot_registry_acc(models_path, name_like=None):
+    plot_acc(registry.get_runs_params(models_path, name_like, with_curves=True))
+
+
 def reverse(test_acc):
     max_len = len(test_acc[-1])
     tmp = []
@@ -639,26 +881,19 @@ def plot_acc(arr):
         acc = m['valid_top1_acc']
         tr = reverse(acc)
         fig, ax = plt.subplots()
-        ax.text(m['epochs']-80, 20, "best model epoch: \n{}".format(m['best_model_epoch']))
+        ax.text(max(m['epochs']-80, 0), 20, "best model epoch: \n{}".format(m.get('best_model_epoch')))
         ax.set_xlabel('epochs')
         ax.set_ylabel('accuracy')
         name = "_".join(m['name'].split('_')[3:])
-        ax.set_title(name + '\naccuracy: {}'.format(m['test_top1_acc']))
-
-        ax.plot([i for i in range(len(acc))],
-                tr[0],
-                label="IC 1")
-        ax.plot([i for i in range(len(acc))],
-                tr[1],
-                label="IC 2")
-        ax.plot([i for i in range(len(acc))],
-                tr[2],
-                label="IC 3")
-        ax.plot([i for i in range(len(acc))],
-                tr[3],
-                label="final output")
+        ax.set_title(name + '\naccuracy: {}'.format(m.get('test_top1_acc')))
+
+        # one curve per exit, at 0 before the growth that adds it
+        for j, curve in enumerate(tr):
+            ax.plot([i for i in range(len(acc))],
+                    curve,
+                    label="final output" if j == len(tr) - 1 else "IC {}".format(j + 1))
         
-        for epoch_prune in m['epoch_prune']:
+        for epoch_prune in m.get('epoch_prune') or []:
             ax.axvline(x=epoch_prune)
 
         figs.append(fig)
@@ -669,32 +904,47 @@ def plot_acc(arr):
         fig.savefig("results/{}/{}".format(name, i))
 
 
-def print_sparsity(model, mask=False):
+def plot_stream_acc(paths, names=None):
+    # plot_acc of running trainings, from their metrics streams (metrics_stream.py)
+    arr = []
+    for i, path in enumerate(paths):
+        records, _ = metrics_stream.read(path)
+        if len(records) == 0:
+            print("no epoch yet in {}".format(path))
+            continue
+        arr.append(metrics_stream.to_params(records, names[i] if names is not None else os.path.basename(path)))
+    plot_acc(arr)
+
+
+def _count_weights(module, mask=False):
+    layers = list(filter(lambda l: isinstance(l, (nn.Linear, nn.Conv2d)), module.modules()))
+    if mask:
+        return sum([layer.weight_mask.nelement() for layer in layers]), sum([int(torch.sum(layer.weight_mask != 0)) for layer in layers])
+    return sum([layer.weight.nelement() for layer in layers]), sum([int(torch.sum(layer.weight != 0)) for layer in layers])
+
+
+def get_sparsity(model, mask=False):
+    # [(total, non zero)] of the blocks of snip.get_blocs and (total, non zero) of the network, end layers excluded
+    # while the network is not fully grown
     blocks = snip.get_blocs(model)
-    #grown_index = -1
-    print("blocks:")
-    for i, b in enumerate(blocks):
+    counts = []
+    for b in blocks:
         if len(b)==0:
             break
-        #grown_index += 1
-        if mask:
-            p_z = sum([torch.sum(layer.weight_mask != 0) for layer in filter(lambda l: isinstance(l, (nn.Linear, nn.Conv2d)), b.modules())]) 
-            t_p = sum([layer.weight_mask.nelement() for layer in filter(lambda l: isinstance(l, (nn.Linear, nn.Conv2d)), b.modules())])
-        else:
-            p_z = sum([torch.sum(layer.weight != 0) for layer in filter(lambda l: isinstance(l, (nn.Linear, nn.Conv2d)), b.modules())]) 
-            t_p = sum([layer.weight.nelement() for layer in filter(lambda l: isinstance(l, (nn.Linear, nn.Conv2d)), b.modules())])
-        print("    {} total: {}, non zero: {}, ratio: {:.2f}".format(i, t_p, p_z, float(p_z)/float(t_p)))
-    
-    if mask:
-        total_param = sum([layer.weight_mask.nelement() for layer in filter(lambda l: isinstance(l, (nn.Linear, nn.Conv2d)), model.modules())])
-        param_z = sum([torch.sum(layer.weight_mask != 0) for layer in filter(lambda l: isinstance(l, (nn.Linear, nn.Conv2d)), model.modules())]) 
-    else:
-        total_param = sum([layer.weight.nelement() for layer in filter(lambda l: isinstance(l, (nn.Linear, nn.Conv2d)), model.modules())])
-        param_z = sum([torch.sum(layer.weight != 0) for layer in filter(lambda l: isinstance(l, (nn.Linear, nn.Conv2d)), model.modules())]) 
+        counts.append(_count_weights(b, mask))
 
+    total_param, param_z = _count_weights(model, mask)
     final_layers_param = sum(layer.weight.nelement() for layer in filter(lambda l: isinstance(l, (nn.Conv2d, nn.Linear)), model.end_layers.modules()))
     total_param = total_param-final_layers_param if len(blocks[-1]) == 0 else total_param
     param_z = param_z-final_layers_param if len(blocks[-1]) == 0 else param_z
+    return counts, (total_param, param_z)
+
+
+def print_sparsity(model, mask=False):
+    counts, (total_param, param_z) = get_sparsity(model, mask)
+    print("blocks:")
+    for i, (t_p, p_z) in enumerate(counts):
+        print("    {} total: {}, non zero: {}, ratio: {:.2f}".format(i, t_p, p_z, float(p_z)/float(t_p)))
     print("total: {}, non_zero: {}, ratio: {}".format(total_param, param_z, float(param_z)/float(total_param)))
 
 def connection_importance(model):
@@ -758,7 +1008,11 @@ def calculate_flops(model, input_shape):
     flops = 0
     ic_buffer = []
     ic = None
+    dense = getattr(model, 'init_type', None) == 'dense'
     for layer in model.modules():
+        if dense and layer is model.end_layers:
+            # the end layers of a dense network see the concatenation of all the features
+            in_shape = (model.in_channels, in_shape[1], in_shape[2])
         if isinstance(layer, InternalClassifier):
             ic_buffer.append([layer, in_shape])
             ic = 0
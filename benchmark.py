@@ -0,0 +1,200 @@
+# benchmark.py
+# throughput (images/s) of every architecture for the forward, forward+backward and eval passes
+# sweeps the batch size, the number of threads and the sparsity (random snip masks), on the synthetic data
+# the results are written in json and compared with a stored baseline to catch the regressions of the hot paths
+# python benchmark.py [--models=resnet56_sdn,...] [--batch-sizes=32,128] [--threads=1,4] [--sparsity=0,0.9]
+#                     [--iterations=10] [--output=benchmark.json] [--baseline=baseline.json] [--tolerance=0.1]
+
+import getopt
+import json
+import os
+import platform
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+import aux_funcs as af
+import network_architectures as arcs
+import proxies
+import snip
+from architectures.CNNs.MobileNet import MobileNet
+from architectures.CNNs.ResNet import ResNet
+from architectures.CNNs.VGG import VGG
+from architectures.CNNs.WideResNet import WideResNet
+from architectures.SDNs.MobileNet_SDN import MobileNet_SDN
+from architectures.SDNs.ResNet_SDN import ResNet_SDN
+from architectures.SDNs.VGG_SDN import VGG_SDN
+from architectures.SDNs.WideResNet_SDN import WideResNet_SDN
+
+MODES = ['forward', 'forward_backward', 'eval']
+
+
+def _sdn_cnn(create, sdn_class, cnn_class):
+    return {'sdn': lambda: sdn_class(create(None, 'cifar10', None, get_params=True)),
+            'cnn': lambda: cnn_class(create(None, 'cifar10', None, get_params=True))}
+
+
+def get_models():
+    models = {}
+    for name, create, sdn_class, cnn_class in [
+            ('resnet56', arcs.create_resnet56, ResNet_SDN, ResNet),
+            ('vgg16bn', arcs.create_vgg16bn, VGG_SDN, VGG),
+            ('wideresnet32_4', arcs.create_wideresnet32_4, WideResNet_SDN, WideResNet),
+            ('mobilenet', arcs.create_mobilenet, MobileNet_SDN, MobileNet)]:
+        for architecture, build in _sdn_cnn(create, sdn_class, cnn_class).items():
+            models['{}_{}'.format(name, architecture)] = build
+    models['resnet_baseline_iterative'] = lambda: proxies.build_network([0, 0, 1, 0, 0, 1, 0, 1, 0], 'iterative')
+    models['resnet_baseline_dense'] = lambda: proxies.build_network([0, 0, 1, 0, 0, 1, 0, 1, 0], 'dense')
+    return models
+
+
+def sparsify(model, sparsity, seed=0):
+    # random masks on the conv and linear layers, with the masked forward of the pruned networks
+    generator = torch.Generator().manual_seed(seed)
+    for layer in model.modules():
+        if isinstance(layer, (nn.Conv2d, nn.Linear)):
+            mask = (torch.rand(layer.weight.shape, generator=generator) >= sparsity).float()
+            layer.weight.data[mask == 0.] = 0.
+            snip.set_prune_mask(layer, mask)
+    return model
+
+
+def _loss(output, labels):
+    if isinstance(output, (list, tuple)):
+        return sum([af.get_loss_criterion()(o, labels) for o in output])
+    return af.get_loss_criterion()(output, labels)
+
+
+def measure(model, mode, images, labels, iterations=10, warmup=3):
+    if mode == 'eval':
+        model.eval()
+    else:
+        model.train()
+
+    def run():
+        if mode == 'eval':
+            with torch.no_grad():
+                model(images)
+        elif mode == 'forward':
+            model(images)
+        else:
+            model.zero_grad()
+            _loss(model(images), labels).backward()
+
+    for _ in range(warmup):
+        run()
+    start_time = time.perf_counter()
+    for _ in range(iterations):
+        run()
+    return iterations * images.size(0) / (time.perf_counter() - start_time)
+
+
+def run_benchmarks(model_names, batch_sizes, threads, sparsities, iterations=10, warmup=3, dataset='synthetic_cifar10'):
+    models = get_models()
+    for name in model_names:
+        if name not in models:
+            raise KeyError("unknown model: {}, the models are: {}".format(name, sorted(models.keys())))
+    num_threads = torch.get_num_threads()
+    results = []
+    for batch_size in batch_sizes:
+        images, labels = next(iter(af.get_dataset(dataset, batch_size).train_loader))
+        for name in model_names:
+            for sparsity in sparsities:
+                torch.manual_seed(0)
+                model = models[name]()
+                if sparsity > 0:
+                    sparsify(model, sparsity)
+                for thread_count in threads:
+                    torch.set_num_threads(thread_count)
+                    for mode in MODES:
+                        images_per_sec = measure(model, mode, images, labels, iterations, warmup)
+                        result = {'model': name, 'mode': mode, 'batch_size': batch_size, 'threads': thread_count,
+                                  'sparsity': sparsity, 'images_per_sec': images_per_sec}
+                        print('{model:>28} {mode:>16} batch {batch_size:4d} threads {threads:3d} '
+                              'sparsity {sparsity:.2f}: {images_per_sec:9.1f} images/s'.format(**result))
+                        results.append(result)
+    torch.set_num_threads(num_threads)
+    return {
+        'machine': {'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+                    'torch': torch.__version__},
+        'results': results
+    }
+
+
+def _key(result):
+    return result['model'], result['mode'], result['batch_size'], result['threads'], result['sparsity']
+
+
+def compare(report, baseline, tolerance=0.1):
+    # the measures slower than the baseline by more than tolerance
+    reference = {_key(r): r['images_per_sec'] for r in baseline['results']}
+    regressions = []
+    for result in report['results']:
+        key = _key(result)
+        if key not in reference:
+            continue
+        ratio = result['images_per_sec'] / reference[key]
+        result['baseline_ratio'] = ratio
+        if ratio < 1. - tolerance:
+            regressions.append(result)
+            print('REGRESSION {} {} batch {} threads {} sparsity {}: {:.1f} images/s, baseline {:.1f} ({:+.1f}%)'.format(
+                *key, result['images_per_sec'], reference[key], 100. * (ratio - 1.)))
+    if baseline.get('machine') != report['machine']:
+        print('the baseline was measured on another machine: {}'.format(baseline.get('machine')))
+    print('{} regressions over {} measures'.format(len(regressions), len(report['results'])))
+    return regressions
+
+
+def _parse_list(arg, cast):
+    return [cast(v) for v in arg.split(',')]
+
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], '', ['models=', 'batch-sizes=', 'threads=', 'sparsity=',
+                                                         'iterations=', 'output=', 'baseline=', 'tolerance='])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+    model_names = sorted(get_models().keys())
+    batch_sizes = [32, 128]
+    threads = sorted(set([1, torch.get_num_threads()]))
+    sparsities = [0., 0.5, 0.9]
+    iterations = 10
+    output = 'benchmark.json'
+    baseline_path = None
+    tolerance = 0.1
+    for opt, arg in optlist:
+        if opt == '--models':
+            model_names = _parse_list(arg, str)
+        if opt == '--batch-sizes':
+            batch_sizes = _parse_list(arg, int)
+        if opt == '--threads':
+            threads = _parse_list(arg, int)
+        if opt == '--sparsity':
+            sparsities = _parse_list(arg, float)
+        if opt == '--iterations':
+            iterations = int(arg)
+        if opt == '--output':
+            output = arg
+        if opt == '--baseline':
+            baseline_path = arg
+        if opt == '--tolerance':
+            tolerance = float(arg)
+
+    report = run_benchmarks(model_names, batch_sizes, threads, sparsities, iterations)
+    regressions = []
+    if baseline_path is not None and os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            regressions = compare(report, json.load(f), tolerance)
+    elif baseline_path is not None:
+        # the first run stores the baseline
+        with open(baseline_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print('baseline written to {}'.format(baseline_path))
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to {}'.format(output))
+    sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,152 @@
+# benchmark_snip.py
+# wall time and peak rss of the pruning pipeline of snip.py: snip.snip, snip_skip_layers and snip_bloc_iterative
+# with their apply_prune_mask_* functions, across network sizes, batch sizes and keep ratios
+# the time is split in the spans of snip.py (deepcopy, forward/backward, score concatenation, topk, masks) and the
+# mask application; every configuration runs in its own process so that its peak rss is not hidden by the others
+# python benchmark_snip.py [--functions=snip,skip_layers,bloc_iterative] [--sizes=9,18,27] [--batch-sizes=64,128]
+#                          [--keep-ratios=0.2,0.6] [--repeats=3] [--output=benchmark_snip.json]
+
+import getopt
+import json
+import resource
+import subprocess
+import sys
+import time
+
+FUNCTIONS = ['snip', 'skip_layers', 'bloc_iterative']
+
+
+def get_ics(size):
+    # 3 ics at a quarter, half and three quarters of the network
+    return [1 if i in [size // 4, size // 2, 3 * size // 4] else 0 for i in range(size)]
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.  # kilobytes on linux
+
+
+def run_single(function, size, batch_size, keep_ratio, repeats=3):
+    # runs in the child process
+    import aux_funcs as af
+    import model_funcs as mf
+    import proxies
+    import snip
+    import timing
+
+    model = proxies.build_network(get_ics(size), 'iterative')
+    model.to_train()
+    loader = af.load_synthetic('synthetic_cifar10', batch_size, num_train=batch_size * 2).train_loader
+    keep_ratios = [keep_ratio] * model.num_output
+    steps = [0] * (model.num_ics + 1)
+    rss_before = _peak_rss_mb()
+
+    timing.enable()
+    timings = []
+    wall_times = []
+    for _ in range(repeats):
+        network = proxies.build_network(get_ics(size), 'iterative') if len(wall_times) > 0 else model
+        network.to_train()
+        timing.reset()
+        start_time = time.perf_counter()
+        if function == 'snip':
+            masks = snip.snip(network, keep_ratio, loader, mf.sdn_loss)
+            with timing.span('apply_mask'):
+                snip.apply_prune_mask(network, masks)
+        elif function == 'skip_layers':
+            masks = snip.snip_skip_layers(network, keep_ratios, loader, mf.sdn_loss, 0, None)
+            with timing.span('apply_mask'):
+                snip.apply_prune_mask_skip_layers(network, masks, 0)
+        elif function == 'bloc_iterative':
+            masks = snip.snip_bloc_iterative(network, keep_ratios, None, steps, loader, mf.sdn_loss)
+            with timing.span('apply_mask'):
+                snip.apply_prune_mask_bloc_iterative(network, masks)
+        else:
+            raise KeyError("the function should be either 'snip', 'skip_layers' or 'bloc_iterative' and it is: {}".format(
+                function))
+        wall_times.append(time.perf_counter() - start_time)
+        timings.append({name: t['time'] for name, t in timing.summary().items()})
+
+    # the first repeat warms up the allocator, it is not in the means
+    kept = timings[1:] if repeats > 1 else timings
+    spans = {name: sum([t.get(name, 0.) for t in kept]) / len(kept) for name in timings[0]}
+    return {
+        'function': function, 'size': size, 'batch_size': batch_size, 'keep_ratio': keep_ratio,
+        'num_params': sum([p.numel() for p in model.parameters()]),
+        'wall_time': sum(wall_times[1:] if repeats > 1 else wall_times) / len(kept),
+        'spans': spans,
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': _peak_rss_mb()
+    }
+
+
+def run_isolated(function, size, batch_size, keep_ratio, repeats=3):
+    config = json.dumps({'function': function, 'size': size, 'batch_size': batch_size, 'keep_ratio': keep_ratio,
+                         'repeats': repeats})
+    res = subprocess.run([sys.executable, __file__, '--single=' + config], stdout=subprocess.PIPE,
+                         universal_newlines=True, check=True)
+    # the result is the last line, the lines before are the prints of the pruning
+    return json.loads(res.stdout.strip().split('\n')[-1])
+
+
+def print_result(result):
+    spans = ', '.join(['{} {:.1f}ms'.format(name.replace('snip_', ''), 1000. * t)
+                       for name, t in sorted(result['spans'].items(), key=lambda item: -item[1])])
+    print('{function:>15} size {size:3d} batch {batch_size:4d} keep {keep_ratio:.2f}: {wall:8.1f}ms, '
+          'peak rss {peak_rss_mb:.0f}MB (+{rss:.0f}MB) | {spans}'.format(
+              wall=1000. * result['wall_time'], rss=result['peak_rss_mb'] - result['rss_before_mb'], spans=spans,
+              **result))
+
+
+def run_benchmarks(functions, sizes, batch_sizes, keep_ratios, repeats=3):
+    results = []
+    for function in functions:
+        for size in sizes:
+            for batch_size in batch_sizes:
+                for keep_ratio in keep_ratios:
+                    result = run_isolated(function, size, batch_size, keep_ratio, repeats)
+                    print_result(result)
+                    results.append(result)
+    return results
+
+
+def _parse_list(arg, cast):
+    return [cast(v) for v in arg.split(',')]
+
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], '', ['functions=', 'sizes=', 'batch-sizes=', 'keep-ratios=',
+                                                         'repeats=', 'output=', 'single='])
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(2)
+    functions = FUNCTIONS
+    sizes = [9, 18, 27]
+    batch_sizes = [64, 128]
+    keep_ratios = [0.2, 0.6]
+    repeats = 3
+    output = 'benchmark_snip.json'
+    for opt, arg in optlist:
+        if opt == '--single':  # child process
+            config = json.loads(arg)
+            result = run_single(config['function'], config['size'], config['batch_size'], config['keep_ratio'],
+                                config['repeats'])
+            print(json.dumps(result))
+            sys.exit(0)
+        if opt == '--functions':
+            functions = _parse_list(arg, str)
+        if opt == '--sizes':
+            sizes = _parse_list(arg, int)
+        if opt == '--batch-sizes':
+            batch_sizes = _parse_list(arg, int)
+        if opt == '--keep-ratios':
+            keep_ratios = _parse_list(arg, float)
+        if opt == '--repeats':
+            repeats = int(arg)
+        if opt == '--output':
+            output = arg
+
+    results = run_benchmarks(functions, sizes, batch_sizes, keep_ratios, repeats)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('results written to {}'.format(output))
@@ -0,0 +1,139 @@
+# checkpoint.py
+# checkpoint format used by network_architectures.save_model() and load_model()
+# [magic][header length][json header][aligned raw tensor buffers]
+# the header indexes every tensor (dtype, shape, offset) and holds a manifest of the structure of the model
+# (grown layers, internal classifiers, pruning masks) so that it is rebuilt without replaying its growth
+# the file is memory-mapped: a tensor, a block or an exit is only read from the disk when it is accessed
+
+import json
+import struct
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+import snip
+
+MAGIC = b'SDNCKPT1'
+ALIGNMENT = 64  # alignment of the tensor buffers in the file
+HEADER_ALIGNMENT = 4096
+
+DTYPES = {
+    torch.float32: 'float32',
+    torch.float64: 'float64',
+    torch.float16: 'float16',
+    torch.int64: 'int64',
+    torch.int32: 'int32',
+    torch.uint8: 'uint8',
+    torch.int8: 'int8',
+    torch.bool: 'bool'
+}
+
+
+def _align(offset, alignment):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def get_manifest(model):
+    manifest = {'masks': [name for name, module in model.named_modules() if 'weight_mask' in module._parameters]}
+    if hasattr(model, 'get_manifest'):  # growing networks
+        manifest['layers'] = model.get_manifest()
+    return manifest
+
+
+def save(model, path):
+    state_dict = model.state_dict()
+    tensors = OrderedDict()
+    entries = OrderedDict()
+    offset = 0
+    for name, tensor in state_dict.items():
+        if tensor.dtype not in DTYPES:
+            raise TypeError("unsupported dtype for {}: {}".format(name, tensor.dtype))
+        tensor = tensor.detach().cpu().contiguous()
+        offset = _align(offset, ALIGNMENT)
+        nbytes = tensor.numel() * tensor.element_size()
+        entries[name] = {'dtype': DTYPES[tensor.dtype], 'shape': list(tensor.shape), 'offset': offset,
+                         'nbytes': nbytes}
+        tensors[name] = tensor
+        offset += nbytes
+
+    header = json.dumps({'tensors': entries, 'manifest': get_manifest(model)}).encode('utf-8')
+    data_start = _align(len(MAGIC) + 8 + len(header), HEADER_ALIGNMENT)
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name, tensor in tensors.items():
+            entry = entries[name]
+            f.seek(data_start + entry['offset'])
+            if entry['nbytes'] > 0:
+                f.write(tensor.numpy().tobytes())
+        f.truncate(data_start + offset)
+
+
+def is_checkpoint(path):
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class CheckpointReader(object):
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("not a checkpoint file: {}".format(path))
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            header = json.loads(f.read(header_len).decode('utf-8'))
+        self.entries = header['tensors']
+        self.manifest = header['manifest']
+        self.data_start = _align(len(MAGIC) + 8 + header_len, HEADER_ALIGNMENT)
+        # copy on write: the tensors can be modified in memory, the file is never written
+        self.file = np.memmap(path, dtype=np.uint8, mode='c')
+
+    def keys(self, prefix=''):
+        return [name for name in self.entries if name.startswith(prefix)]
+
+    def tensor(self, name):
+        entry = self.entries[name]
+        dtype = np.dtype(entry['dtype'])
+        array = np.ndarray(entry['shape'], dtype=dtype, buffer=self.file,
+                           offset=self.data_start + entry['offset'])
+        return torch.from_numpy(array)
+
+    def state_dict(self, prefix=''):
+        # the returned tensors share the mapped pages, nothing is read before they are used
+        return OrderedDict((name[len(prefix):], self.tensor(name)) for name in self.keys(prefix))
+
+    def load_module(self, module, prefix):
+        # loads a single block or exit, e.g. load_module(model.layers[3].output, 'layers.3.output.')
+        module.load_state_dict(self.state_dict(prefix), strict=False)
+        return module
+
+    def restore(self, model, mmap=False):
+        if 'layers' in self.manifest and hasattr(model, 'rebuild'):
+            model.rebuild(self.manifest['layers'])
+
+        modules = dict(model.named_modules())
+        for name in self.manifest['masks']:
+            snip.set_prune_mask(modules[name], self.tensor(name + '.weight_mask'))
+
+        if not mmap:
+            model.load_state_dict(self.state_dict(), strict=False)
+            return model
+
+        # the parameters and buffers directly use the mapped tensors
+        for name in self.keys():
+            module_name, _, attr = name.rpartition('.')
+            if module_name not in modules:
+                continue
+            module = modules[module_name]
+            tensor = self.tensor(name)
+            if attr in module._parameters and module._parameters[attr] is not None:
+                if module._parameters[attr].shape != tensor.shape:
+                    raise ValueError("size mismatch for {}: {} in the checkpoint, {} in the model".format(
+                        name, tuple(tensor.shape), tuple(module._parameters[attr].shape)))
+                module._parameters[attr].data = tensor
+            elif attr in module._buffers:
+                module._buffers[attr] = tensor
+        return model
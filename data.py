@@ -1,10 +1,16 @@
 # data.py
 # to standardize the datasets used in the experiments
-# datasets are CIFAR10, CIFAR100 and Tiny ImageNet
+# datasets are CIFAR10, CIFAR100 and Tiny ImageNet, and Synthetic: generated stand-ins of them that need no download
 # use create_val_folder() function to convert original Tiny ImageNet structure to structure PyTorch expects
+# or pack_tinyimagenet() to convert it once into a few large binary shards read by PackedImageDataset
 
+import bisect
 import os
+import pickle
+import queue
+import threading
 
+import numpy as np
 import torch
 from PIL import Image
 from torch.utils.data import sampler
@@ -93,6 +99,88 @@ class CIFAR100:
                                                        num_workers=4)
 
 
+class SyntheticImages(torch.utils.data.Dataset):
+    # deterministic learnable images: every class has a smooth random prototype, a sample is the prototype of its
+    # class plus gaussian noise, both drawn from (seed, index) so that the images are generated when they are read
+    # and any number of them costs no memory
+    def __init__(self, prototypes, num_samples, seed, noise=0.5, augment=False):
+        self.prototypes = prototypes
+        self.num_classes = prototypes.size(0)
+        self.num_samples = num_samples
+        self.seed = seed
+        self.noise = noise
+        self.augment = augment  # random flips and shifts, as the augmented transforms of the real datasets
+        self.targets = torch.randint(self.num_classes, (num_samples,),
+                                     generator=torch.Generator().manual_seed(seed)).tolist()
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, index):
+        generator = torch.Generator().manual_seed(self.seed * 1000003 + index)
+        target = self.targets[index]
+        img = self.prototypes[target] + self.noise * torch.randn(self.prototypes.shape[1:], generator=generator)
+        if self.augment:
+            if torch.rand(1).item() < 0.5:
+                img = img.flip(2)
+            shift = self.prototypes.size(2) // 8
+            img = torch.roll(img, tuple(torch.randint(-shift, shift + 1, (2,)).tolist()), dims=(1, 2))
+        return img, target
+
+
+def get_prototypes(num_classes, img_size, seed):
+    # low frequency patterns, normalized as the real datasets
+    generator = torch.Generator().manual_seed(seed)
+    low = torch.randn(num_classes, 3, 4, 4, generator=generator)
+    prototypes = torch.nn.functional.interpolate(low, size=(img_size, img_size), mode='bilinear', align_corners=False)
+    return (prototypes - prototypes.mean()) / prototypes.std()
+
+
+class Synthetic:
+    # offline stand-in of CIFAR10, CIFAR100 or TinyImagenet with the same attributes, for the benchmarks
+    def __init__(self, batch_size=128, img_size=32, num_classes=10, num_train=50000, num_test=10000, valid_ratio=0.1,
+                 seed=0, noise=0.5, num_workers=0):
+        self.batch_size = batch_size
+        self.img_size = img_size
+        self.num_classes = num_classes
+        self.num_test = num_test
+        self.num_train = num_train
+
+        prototypes = get_prototypes(num_classes, img_size, seed)
+        num_valid = int(num_train * valid_ratio)
+        indices = list(range(num_train))
+        # the same split for the augmented and normalized sets
+        train_indices, valid_indices = indices[:num_train - num_valid], indices[num_train - num_valid:]
+
+        aug_set = SyntheticImages(prototypes, num_train, seed + 1, noise, augment=True)
+        self.aug_trainset = torch.utils.data.Subset(aug_set, train_indices)
+        self.aug_validset = torch.utils.data.Subset(aug_set, valid_indices)
+        self.aug_train_loader = torch.utils.data.DataLoader(self.aug_trainset, batch_size=batch_size, shuffle=True,
+                                                            num_workers=num_workers)
+        self.aug_valid_loader = torch.utils.data.DataLoader(self.aug_validset, batch_size=batch_size, shuffle=True,
+                                                            num_workers=num_workers)
+
+        normalized_set = SyntheticImages(prototypes, num_train, seed + 1, noise)
+        self.trainset = torch.utils.data.Subset(normalized_set, train_indices)
+        self.validset = torch.utils.data.Subset(normalized_set, valid_indices)
+        self.train_loader = torch.utils.data.DataLoader(self.trainset, batch_size=batch_size, shuffle=True,
+                                                        num_workers=num_workers)
+        self.valid_loader = torch.utils.data.DataLoader(self.validset, batch_size=batch_size, shuffle=True,
+                                                        num_workers=num_workers)
+
+        self.testset = SyntheticImages(prototypes, num_test, seed + 2, noise)
+        self.test_loader = torch.utils.data.DataLoader(self.testset, batch_size=batch_size, shuffle=False,
+                                                       num_workers=num_workers)
+
+
+# shapes of the real datasets
+SYNTHETIC = {
+    'synthetic_cifar10': dict(img_size=32, num_classes=10, num_train=50000, num_test=10000),
+    'synthetic_cifar100': dict(img_size=32, num_classes=100, num_train=50000, num_test=10000),
+    'synthetic_tinyimagenet': dict(img_size=64, num_classes=200, num_train=100000, num_test=10000)
+}
+
+
 class ImageFolderWithPaths(datasets.ImageFolder):
     def __getitem__(self, index):
         original_tuple = super(ImageFolderWithPaths, self).__getitem__(index)
@@ -101,8 +189,213 @@ class ImageFolderWithPaths(datasets.ImageFolder):
         return tuple_with_path
 
 
+class PackedImageDataset(torch.utils.data.IterableDataset):
+    # streams the uint8 images of one split written by pack_tinyimagenet()
+    # the shards are read sequentially by chunks of chunk_size images, a background thread keeps
+    # readahead chunks in memory ahead of the decoding so the reads never wait on the transforms
+    def __init__(self, index_path, split, transform=None, shuffle=False, chunk_size=1024, readahead=2,
+                 with_paths=False):
+        super(PackedImageDataset, self).__init__()
+        with open(index_path, 'rb') as f:
+            index = pickle.load(f)
+
+        self.root = os.path.dirname(index_path)
+        self.transform = transform
+        self.shuffle = shuffle
+        self.chunk_size = chunk_size
+        self.readahead = readahead
+        self.with_paths = with_paths
+
+        self.classes = index['classes']
+        self.class_to_idx = {name: i for i, name in enumerate(self.classes)}
+        self.img_shape = (index['img_size'], index['img_size'], 3)
+        self.shards = index[split]['shards']  # [(file name, number of images), ...]
+        self.targets = index[split]['labels']
+        self.paths = index[split]['paths']
+        self.imgs = list(zip(self.paths, self.targets.tolist()))  # same attribute as datasets.ImageFolder
+
+        if shuffle and not index.get('shuffled', False):
+            print('{} was packed in class order, the chunks hold few classes: pack it again with '
+                  'pack_tinyimagenet()'.format(index_path))
+
+        # (shard file, first image in the shard, first image in the split, number of images)
+        self.chunks = []
+        self.shard_starts = []
+        first = 0
+        for shard, count in self.shards:
+            self.shard_starts.append(first)
+            for start in range(0, count, chunk_size):
+                self.chunks.append((shard, start, first + start, min(chunk_size, count - start)))
+            first += count
+
+    def __len__(self):
+        return len(self.targets)
+
+    def _sample(self, image, index):
+        img = Image.fromarray(image)
+        if self.transform is not None:
+            img = self.transform(img)
+        target = int(self.targets[index])
+        if self.with_paths:
+            return img, target, self.paths[index]
+        return img, target
+
+    def __getitem__(self, index):
+        # random access to one image, as with datasets.ImageFolder; the loaders stream the chunks
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('index {} out of range for {} images'.format(index, len(self)))
+        shard_id = bisect.bisect_right(self.shard_starts, index) - 1
+        img_bytes = int(np.prod(self.img_shape))
+        with open(os.path.join(self.root, self.shards[shard_id][0]), 'rb') as f:
+            f.seek((index - self.shard_starts[shard_id]) * img_bytes)
+            buffer = f.read(img_bytes)
+        if len(buffer) != img_bytes:
+            raise IOError('truncated shard: {}'.format(self.shards[shard_id][0]))
+        return self._sample(np.frombuffer(buffer, dtype=np.uint8).reshape(self.img_shape), index)
+
+    def _worker_chunks(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            num_workers, worker_id = 1, 0
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            # every worker draws the same permutation, the base seed changes at every epoch
+            num_workers, worker_id = worker_info.num_workers, worker_info.id
+            seed = worker_info.seed - worker_info.id
+
+        order = np.arange(len(self.chunks))
+        if self.shuffle:
+            order = np.random.RandomState(seed % 2 ** 32).permutation(order)
+        # contiguous spans so that each worker keeps reading sequentially
+        begin = worker_id * len(order) // num_workers
+        end = (worker_id + 1) * len(order) // num_workers
+        return [self.chunks[i] for i in order[begin:end]], seed + worker_id
+
+    @staticmethod
+    def _put(out, item, stop):
+        while not stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_chunks(self, chunks, out, stop):
+        img_bytes = int(np.prod(self.img_shape))
+        files = {}
+        try:
+            for shard, start, first, count in chunks:
+                if shard not in files:
+                    files[shard] = open(os.path.join(self.root, shard), 'rb', buffering=0)
+                    if hasattr(os, 'posix_fadvise'):
+                        os.posix_fadvise(files[shard].fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                f = files[shard]
+                f.seek(start * img_bytes)
+                buffer = bytearray(count * img_bytes)
+                view, read = memoryview(buffer), 0
+                while read < len(buffer):  # network filesystems can return short reads
+                    n = f.readinto(view[read:])
+                    if not n:
+                        raise IOError('truncated shard: {}'.format(shard))
+                    read += n
+                images = np.frombuffer(buffer, dtype=np.uint8).reshape((count,) + self.img_shape)
+                if not self._put(out, (images, first), stop):
+                    return
+            self._put(out, None, stop)
+        except Exception as e:  # raised again by the consuming iterator
+            self._put(out, e, stop)
+        finally:
+            for f in files.values():
+                f.close()
+
+    def __iter__(self):
+        chunks, seed = self._worker_chunks()
+        rng = np.random.RandomState(seed % 2 ** 32)
+        out = queue.Queue(maxsize=max(1, self.readahead))
+        stop = threading.Event()
+        reader = threading.Thread(target=self._read_chunks, args=(chunks, out, stop), daemon=True)
+        reader.start()
+        try:
+            while True:
+                item = out.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                images, first = item
+                order = rng.permutation(len(images)) if self.shuffle else range(len(images))
+                for i in order:
+                    yield self._sample(images[i], first + i)
+        finally:
+            stop.set()
+
+
+def get_packed_index_path(packed_dir='data/tiny-imagenet-200/packed'):
+    return os.path.join(packed_dir, 'index')
+
+
+def pack_tinyimagenet(root='data/tiny-imagenet-200', packed_dir=None, shard_size=25000, seed=0):
+    """
+    One-time conversion of Tiny ImageNet to uint8 binary shards (N x 64 x 64 x 3 per file) plus an index
+    holding the classes, the labels, the original paths and the shard sizes of the train and val splits
+    The train images are written in a fixed random order: the shuffling of PackedImageDataset only permutes
+    the chunks and the images inside a chunk, and a batch comes from a single chunk, so with the class order
+    of ImageFolder a batch would only hold 2 or 3 classes
+    """
+    packed_dir = os.path.join(root, 'packed') if packed_dir is None else packed_dir
+    if not os.path.exists(packed_dir):
+        os.makedirs(packed_dir)
+    print('Packing TinyImageNet into {}...'.format(packed_dir))
+
+    train_set = datasets.ImageFolder(os.path.join(root, 'train'))
+    classes = train_set.classes
+    class_to_idx = train_set.class_to_idx
+
+    # the val annotations are read directly, there is no need to run create_val_folder() first
+    val_dir = os.path.join(root, 'val/images')
+    val_samples = []
+    with open(os.path.join(root, 'val/val_annotations.txt'), 'r') as fp:
+        for line in fp:
+            words = line.split('\t')
+            img, folder = words[0], words[1]
+            path = os.path.join(val_dir, img)
+            if not os.path.exists(path):  # already moved by create_val_folder()
+                path = os.path.join(val_dir, folder, img)
+            val_samples.append((path, class_to_idx[folder]))
+    val_samples.sort()
+
+    train_samples = [train_set.samples[i] for i in np.random.RandomState(seed).permutation(len(train_set.samples))]
+
+    index = {'classes': classes, 'img_size': 64, 'shuffled': True}
+    for split, samples in [('train', train_samples), ('val', val_samples)]:
+        shards = []
+        for shard_id, start in enumerate(range(0, len(samples), shard_size)):
+            shard = '{}_{:03d}.bin'.format(split, shard_id)
+            count = 0
+            with open(os.path.join(packed_dir, shard), 'wb') as f:
+                for path, _ in samples[start:start + shard_size]:
+                    with Image.open(path) as img:
+                        f.write(np.asarray(img.convert('RGB'), dtype=np.uint8).tobytes())
+                    count += 1
+            shards.append((shard, count))
+            print('    {}: {} images'.format(shard, count))
+        index[split] = {
+            'shards': shards,
+            'labels': np.array([label for _, label in samples], dtype=np.int64),
+            'paths': [path for path, _ in samples]
+        }
+
+    index_path = get_packed_index_path(packed_dir)
+    with open(index_path, 'wb') as f:
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+    return index_path
+
+
 class TinyImagenet():
-    def __init__(self, batch_size=128):
+    def __init__(self, batch_size=128, packed_dir='data/tiny-imagenet-200/packed'):
         print('Loading TinyImageNet...')
         self.batch_size = batch_size
         self.img_size = 64
@@ -120,6 +413,11 @@ class TinyImagenet():
 
         self.normalized = transforms.Compose([transforms.ToTensor(), normalize])
 
+        index_path = get_packed_index_path(packed_dir) if packed_dir is not None else None
+        if index_path is not None and os.path.exists(index_path):
+            self._load_packed(index_path, batch_size)
+            return
+
         self.aug_trainset = datasets.ImageFolder(train_dir, transform=self.augmented)
         self.aug_train_loader = torch.utils.data.DataLoader(self.aug_trainset, batch_size=batch_size, shuffle=True,
                                                             num_workers=8)
@@ -134,20 +432,80 @@ class TinyImagenet():
         self.test_loader = torch.utils.data.DataLoader(self.testset, batch_size=batch_size, shuffle=False,
                                                        num_workers=8)
 
+    def _load_packed(self, index_path, batch_size):
+        print('Using the packed shards: {}'.format(index_path))
+        # the packed datasets shuffle themselves, DataLoader does not accept shuffle=True for them
+        self.aug_trainset = PackedImageDataset(index_path, 'train', transform=self.augmented, shuffle=True)
+        self.aug_train_loader = torch.utils.data.DataLoader(self.aug_trainset, batch_size=batch_size,
+                                                            num_workers=8)
 
-def get_mean_and_std(dataset):
-    '''Compute the mean and std value of dataset.'''
-    dataloader = torch.utils.data.DataLoader(dataset, batch_size=1, num_workers=4)
-    mean = torch.zeros(3)
-    std = torch.zeros(3)
+        self.trainset = PackedImageDataset(index_path, 'train', transform=self.normalized, shuffle=True)
+        self.train_loader = torch.utils.data.DataLoader(self.trainset, batch_size=batch_size, num_workers=8)
+
+        self.testset = PackedImageDataset(index_path, 'val', transform=self.normalized)
+        self.testset_paths = PackedImageDataset(index_path, 'val', transform=self.normalized, with_paths=True)
+
+        # a single process reads the val shards in order: with several workers each one would emit its own last
+        # partial batch and the batches would be interleaved, the batch positions would no longer be the images
+        # of the test set (cnn_get_confidence) and len(test_loader) would be wrong; the readahead thread of
+        # PackedImageDataset still keeps the reads ahead of the decoding
+        self.test_loader = torch.utils.data.DataLoader(self.testset, batch_size=batch_size, num_workers=0)
+
+
+def merge_moments(count, mean, m2, batch_count, batch_mean, batch_m2):
+    # parallel form of Welford's algorithm (Chan et al.): merges the per channel count, mean and
+    # sum of squared deviations of a batch into the running ones
+    total = count + batch_count
+    delta = batch_mean - mean
+    mean = mean + delta * (batch_count / total)
+    m2 = m2 + batch_m2 + delta * delta * (count * batch_count / total)
+    return total, mean, m2
+
+
+def get_mean_and_std(dataset, batch_size=1024, num_workers=4):
+    '''Compute the per channel mean and std value of dataset over all of its pixels.'''
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+    count = 0
+    mean = None
+    m2 = None
+    print('==> Computing mean and std..')
+    for batch in dataloader:
+        inputs = batch[0].to(torch.float64)
+        pixels = inputs.transpose(0, 1).reshape(inputs.size(1), -1)  # channels x pixels
+        batch_count = pixels.size(1)
+        batch_mean = pixels.sum(1) / batch_count
+        batch_m2 = ((pixels - batch_mean[:, None]) ** 2).sum(1)
+        if mean is None:
+            count, mean, m2 = batch_count, batch_mean, batch_m2
+        else:
+            count, mean, m2 = merge_moments(count, mean, m2, batch_count, batch_mean, batch_m2)
+    std = (m2 / count).sqrt()
+    return mean.float(), std.float()
+
+
+def get_packed_mean_and_std(index_path, split='train', chunk_size=4096):
+    '''Same as get_mean_and_std() but directly on the uint8 shards written by pack_tinyimagenet().'''
+    with open(index_path, 'rb') as f:
+        index = pickle.load(f)
+    root = os.path.dirname(index_path)
+    img_shape = (index['img_size'], index['img_size'], 3)
+
+    # the sums of uint8 values and of their squares are exact in int64, no cancellation is possible
+    total = np.zeros(3, dtype=np.int64)
+    total_sq = np.zeros(3, dtype=np.int64)
+    count = 0
     print('==> Computing mean and std..')
-    for inputs, targets in dataloader:
-        for i in range(3):
-            mean[i] += inputs[:, i, :, :].mean()
-            std[i] += inputs[:, i, :, :].std()
-    mean.div_(len(dataset))
-    std.div_(len(dataset))
-    return mean, std
+    for shard, num_images in index[split]['shards']:
+        images = np.memmap(os.path.join(root, shard), dtype=np.uint8, mode='r', shape=(num_images,) + img_shape)
+        for start in range(0, num_images, chunk_size):
+            pixels = np.asarray(images[start:start + chunk_size]).reshape(-1, 3).astype(np.int64)
+            total += pixels.sum(0)
+            total_sq += np.einsum('ij,ij->j', pixels, pixels)
+            count += pixels.shape[0]
+
+    mean = [float(s) / count / 255. for s in total]
+    var = [float(int(sq) * count - int(s) ** 2) / count ** 2 / 255. ** 2 for s, sq in zip(total, total_sq)]
+    return torch.tensor(mean), torch.tensor(var).sqrt()
 
 
 def create_val_folder():
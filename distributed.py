@@ -0,0 +1,134 @@
+# distributed.py
+# data-parallel training on N local cpu processes (gloo backend) for sdn_train, iter_training_0 and iter_training_4
+# every process trains the same model on its shard of the training set, the gradients are averaged by
+# DistributedDataParallel and the test metrics are all-reduced, so all the ranks take the same decisions
+# (growth, pruning epochs, best model); the wrapper is rebuilt when the model grows and the masks computed by
+# rank 0 are broadcast after each pruning
+# when torch.distributed is not initialized every function is a no-op and the training is unchanged
+
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader, IterableDataset, Sampler
+from torch.utils.data.distributed import DistributedSampler
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def init_process(rank, world_size, port=29500, backend='gloo'):
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(port))
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    # the cores are shared between the processes
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+class ShardSampler(Sampler):
+    # evaluation shards: every sample is seen exactly once (DistributedSampler pads the last shards)
+    def __init__(self, dataset, num_replicas, rank):
+        self.indices = list(range(rank, len(dataset), num_replicas))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def shard_loader(loader, train):
+    dataset = loader.dataset
+    if isinstance(dataset, IterableDataset):
+        print('cannot shard an iterable dataset, every rank reads all of it')
+        return loader
+    world_size, rank = get_world_size(), get_rank()
+    if train:
+        # the global batch size stays the one of the loader
+        sampler = DistributedSampler(dataset, world_size, rank, shuffle=True)
+        batch_size = max(1, loader.batch_size // world_size)
+    else:
+        sampler = ShardSampler(dataset, world_size, rank)
+        batch_size = loader.batch_size
+    return DataLoader(dataset, batch_size=batch_size, sampler=sampler, num_workers=loader.num_workers,
+                      pin_memory=loader.pin_memory, drop_last=loader.drop_last)
+
+
+def shard_dataset(data):
+    if not is_distributed():
+        return data
+    for name, train in [('aug_train_loader', True), ('train_loader', True), ('aug_valid_loader', False),
+                        ('valid_loader', False), ('test_loader', False)]:
+        if hasattr(data, name):
+            setattr(data, name, shard_loader(getattr(data, name), train))
+    return data
+
+
+def set_epoch(loader, epoch):
+    # reshuffles the training shards at every epoch
+    if isinstance(getattr(loader, 'sampler', None), DistributedSampler):
+        loader.sampler.set_epoch(epoch)
+
+
+_wrappers = {}
+
+
+def wrap(model):
+    # the DistributedDataParallel wrapper of the model, rebuilt when its trainable parameters change (growth)
+    if not is_distributed():
+        return model
+    key = tuple(id(p) for p in model.parameters() if p.requires_grad)
+    cached = _wrappers.get(id(model))
+    if cached is None or cached[0] != key or cached[1].module is not model:
+        # the parameters of rank 0 are broadcast when the wrapper is built
+        # find_unused_parameters: the final output is not computed before the network is fully grown
+        _wrappers[id(model)] = (key, DistributedDataParallel(model, find_unused_parameters=True))
+    return _wrappers[id(model)][1]
+
+
+def broadcast_model(model, src=0):
+    # parameters, masks and buffers of rank src, e.g. after a pruning computed on each rank
+    if not is_distributed():
+        return
+    for tensor in model.state_dict().values():
+        dist.broadcast(tensor, src)
+
+
+def broadcast_buffers(model, src=0):
+    # batch norm statistics, DistributedDataParallel only broadcasts them at the start of a forward
+    if not is_distributed():
+        return
+    for buf in model.buffers():
+        dist.broadcast(buf, src)
+
+
+def all_reduce_meters(meters):
+    # data.AverageMeter of each rank -> average over all the samples of all the ranks
+    if not is_distributed():
+        return meters
+    stats = torch.tensor([[float(m.sum), float(m.count)] for m in meters], dtype=torch.float64)
+    dist.all_reduce(stats)
+    for meter, (total, count) in zip(meters, stats.tolist()):
+        meter.sum, meter.count = total, count
+        meter.avg = torch.tensor(total / count if count > 0 else 0.)
+    return meters
@@ -0,0 +1,199 @@
+# exit_server.py
+# asyncio early-exit inference service: single images are grouped in micro-batches (max batch size or latency
+# deadline), every exit has its own stage that runs the segment of the network up to the exit on the batch
+# the samples whose confidence reaches the threshold are answered right away, the others go to the next stage
+# with their activation, so an early sample never waits for the deeper ones
+# includes a load generator replaying the test set and a comparison with plain batched inference (BatchedServer),
+# both measured from the submission of a request to its answer
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+import aux_funcs as af
+import segments
+
+
+class _Request(object):
+    def __init__(self, x, future):
+        self.x = x
+        self.future = future
+        self.start_time = time.perf_counter()
+
+
+class ExitServer(object):
+    def __init__(self, model, threshold=0.9, max_batch_size=32, max_delay=0.005):
+        self.threshold = threshold
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay  # seconds a sample waits at most for its micro-batch to fill
+        model = model.cpu()
+        model.eval()
+        self.segments = self._split(model)
+        self.num_stages = len(self.segments)
+        self.queues = None
+        self.workers = []
+        # one thread per stage: the stages run concurrently, torch releases the gil
+        self.executor = ThreadPoolExecutor(max_workers=self.num_stages)
+
+    def _split(self, model):
+        # [(trunk, ic)] of the stages, one per exit
+        return segments.split_sdn(model)
+
+    async def start(self):
+        self.queues = [asyncio.Queue() for _ in range(self.num_stages)]
+        self.workers = [asyncio.ensure_future(self._stage(k)) for k in range(self.num_stages)]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.executor.shutdown()
+
+    async def infer(self, x):
+        # x: a single image (C, H, W), returns (prediction, exit, confidence)
+        future = asyncio.get_event_loop().create_future()
+        await self.queues[0].put(_Request(x.unsqueeze(0), future))
+        return await future
+
+    async def _next_batch(self, queue):
+        batch = [await queue.get()]
+        deadline = time.perf_counter() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def _run_stage(self, k, x):
+        trunk, ic = self.segments[k]
+        with torch.no_grad():
+            handoff, exit_input = trunk(x)
+            confidence, prediction = F.softmax(ic(exit_input), dim=1).max(1)
+        return handoff, confidence, prediction
+
+    async def _stage(self, k):
+        loop = asyncio.get_event_loop()
+        last = k == self.num_stages - 1
+        while True:
+            batch = await self._next_batch(self.queues[k])
+            x = torch.cat([r.x for r in batch])
+            try:
+                handoff, confidence, prediction = await loop.run_in_executor(self.executor, self._run_stage, k, x)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            for i, request in enumerate(batch):
+                if request.future.cancelled():
+                    continue
+                if last or confidence[i] >= self.threshold:
+                    request.future.set_result((int(prediction[i]), k, float(confidence[i])))
+                else:
+                    request.x = handoff[i:i + 1]
+                    self.queues[k + 1].put_nowait(request)
+
+
+class BatchedServer(ExitServer):
+    # baseline: the same micro-batches, the full network in a single stage without early exit
+    def __init__(self, model, max_batch_size=32, max_delay=0.005):
+        super(BatchedServer, self).__init__(model, 0., max_batch_size, max_delay)
+
+    def _split(self, model):
+        if hasattr(model, 'to_eval'):
+            model.to_eval()
+        return [(model, None)]
+
+    def _run_stage(self, k, x):
+        model, _ = self.segments[k]
+        with torch.no_grad():
+            output = model(x)
+        output = output[-1] if isinstance(output, list) else output
+        confidence, prediction = F.softmax(output, dim=1).max(1)
+        return None, confidence, prediction
+
+
+def _report(name, latencies, total_time, correct=None):
+    latencies = 1000 * np.array(latencies)
+    res = {
+        'p50_ms': float(np.percentile(latencies, 50)),
+        'p99_ms': float(np.percentile(latencies, 99)),
+        'throughput': len(latencies) / total_time
+    }
+    if correct is not None:
+        res['top1'] = 100. * correct / len(latencies)
+    print('{}: p50: {:.2f}ms, p99: {:.2f}ms, throughput: {:.1f} images/s{}'.format(
+        name, res['p50_ms'], res['p99_ms'], res['throughput'],
+        ', top1: {:.2f}'.format(res['top1']) if correct is not None else ''))
+    return res
+
+
+async def _generate_load(server, testset, num_requests, rate, name='early exit server', seed=0):
+    # rate: requests per second (poisson arrivals), None sends them all at once
+    # the latency of a request goes from its submission to its answer, queueing included
+    arrivals = np.random.RandomState(seed)  # same arrivals for the servers compared
+    latencies = []
+    exits = []
+    correct = [0]
+
+    async def request(x, y):
+        start_time = time.perf_counter()
+        prediction, exit_id, _ = await server.infer(x)
+        latencies.append(time.perf_counter() - start_time)
+        exits.append(exit_id)
+        correct[0] += int(prediction == y)
+
+    await server.start()
+    start_time = time.perf_counter()
+    tasks = []
+    for i in range(num_requests):
+        x, y = testset[i % len(testset)]
+        tasks.append(asyncio.ensure_future(request(x, int(y))))
+        if rate is not None:
+            await asyncio.sleep(arrivals.exponential(1. / rate))
+    await asyncio.gather(*tasks)
+    total_time = time.perf_counter() - start_time
+    await server.stop()
+    res = _report(name, latencies, total_time, correct[0])
+    res['exit_counts'] = np.bincount(exits, minlength=server.num_stages).tolist()
+    print('exit counts: {}'.format(res['exit_counts']))
+    return res
+
+
+def _run(server, testset, num_requests, rate, name):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_generate_load(server, testset, num_requests, rate, name))
+    finally:
+        loop.close()
+
+
+def run_load(model, testset, threshold=0.9, num_requests=2000, rate=None, max_batch_size=32, max_delay=0.005):
+    server = ExitServer(model, threshold, max_batch_size, max_delay)
+    return _run(server, testset, num_requests, rate, 'early exit server')
+
+
+def run_baseline(model, testset, num_requests=2000, rate=None, max_batch_size=32, max_delay=0.005):
+    # plain batched inference of the full network under the same load: every sample waits for its whole batch
+    server = BatchedServer(model, max_batch_size, max_delay)
+    return _run(server, testset, num_requests, rate, 'batched full network')
+
+
+if __name__ == '__main__':
+    import sys
+    import network_architectures as arcs
+
+    models_path, model_name = sys.argv[1], sys.argv[2]
+    threshold = float(sys.argv[3]) if len(sys.argv) > 3 else 0.9
+    model, model_params = arcs.load_model(models_path, model_name, epoch=-1)
+    dataset = af.get_dataset(model_params['task'] if 'task' in model_params else 'cifar10')
+    run_baseline(model, dataset.testset)
+    run_load(model, dataset.testset, threshold)
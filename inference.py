@@ -0,0 +1,142 @@
+# inference.py
+# export of a trained SDN for inference: the pruning masks are applied to the weights and every
+# BatchNorm2d is folded in the convolution that precedes it, so each conv+bn pair runs as a single conv
+# works for ResNet_SDN, MobileNet_SDN, VGG_SDN, ResNet_Baseline and DenseNet (WideResNet normalizes before its convs)
+
+import copy
+import time
+
+import torch
+import torch.nn as nn
+
+import aux_funcs as af
+
+
+def bake_masks(model):
+    # the masked weights are set to zero and the layers use their default forward again
+    for module in model.modules():
+        if 'weight_mask' in module._parameters:
+            module.weight.data.mul_(module.weight_mask.data)
+            del module._parameters['weight_mask']
+            if 'forward' in module.__dict__:
+                del module.__dict__['forward']
+    return model
+
+
+def fold_conv_bn(conv, bn):
+    # conv followed by bn in eval mode: w' = w * gamma / std, b' = (b - mean) * gamma / std + beta
+    std = torch.sqrt(bn.running_var + bn.eps)
+    scale = bn.weight / std if bn.affine else 1. / std
+    shift = bn.bias if bn.affine else torch.zeros_like(std)
+
+    weight = conv.weight
+    if 'weight_mask' in conv._parameters:
+        weight = weight * conv.weight_mask
+    bias = conv.bias if conv.bias is not None else torch.zeros_like(std)
+
+    folded = nn.Conv2d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride,
+                       padding=conv.padding, dilation=conv.dilation, groups=conv.groups, bias=True,
+                       padding_mode=conv.padding_mode).to(weight.device)
+    with torch.no_grad():
+        folded.weight.copy_(weight * scale.view(-1, 1, 1, 1))
+        folded.bias.copy_((bias - bn.running_mean) * scale + shift)
+    return folded
+
+
+def fold_batch_norms(model):
+    # the bn is replaced by an identity so that the indexes of the sequentials do not change
+    num_folded = 0
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules.keys())
+        for cur, nxt in zip(names[:-1], names[1:]):
+            conv, bn = module._modules[cur], module._modules[nxt]
+            if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d) and bn.track_running_stats:
+                module._modules[cur] = fold_conv_bn(conv, bn)
+                module._modules[nxt] = nn.Identity()
+                num_folded += 1
+    return num_folded
+
+
+def export_for_inference(model):
+    # returns an eval-only copy, the given model is not modified
+    model = copy.deepcopy(model)
+    model.eval()
+    if hasattr(model, 'to_eval'):
+        model.to_eval()
+    num_folded = fold_batch_norms(model)
+    bake_masks(model)
+    for param in model.parameters():
+        param.requires_grad = False
+    print('{} batch norms folded'.format(num_folded))
+    return model
+
+
+def get_exit_modules(model):
+    # the modules computing the outputs of the network, in the order of the outputs
+    exits = [layer.output for layer in model.layers if not getattr(layer, 'no_output', True)]
+    exits.append(model.end_layers)
+    return exits
+
+
+def exit_latencies(model, input_size, device='cpu', batch_size=1, repeats=100, warmup=10):
+    # mean time (ms) between the start of the forward pass and the computation of each exit
+    model.eval()
+    exits = get_exit_modules(model)
+    totals = [0.] * len(exits)
+    start = [0.]
+    cuda = 'cuda' in str(device)
+
+    def hook_factory(exit_id):
+        def hook(module, inp, out):
+            if cuda:
+                torch.cuda.synchronize()
+            totals[exit_id] += time.perf_counter() - start[0]
+
+        return hook
+
+    x = torch.rand(batch_size, 3, input_size, input_size).to(device)
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(x)
+        handles = [e.register_forward_hook(hook_factory(i)) for i, e in enumerate(exits)]
+        for _ in range(repeats):
+            if cuda:
+                torch.cuda.synchronize()
+            start[0] = time.perf_counter()
+            model(x)
+        for handle in handles:
+            handle.remove()
+    return [1000 * t / repeats for t in totals]
+
+
+def benchmark_export(model, input_size, device='cpu', batch_size=1, repeats=100):
+    exported = export_for_inference(model)
+    model.eval()
+    if hasattr(model, 'to_eval'):
+        model.to_eval()
+
+    x = torch.rand(batch_size, 3, input_size, input_size).to(device)
+    with torch.no_grad():
+        diffs = [float((a - b).abs().max()) for a, b in zip(model(x), exported(x))]
+
+    before = exit_latencies(model, input_size, device, batch_size, repeats)
+    after = exit_latencies(exported, input_size, device, batch_size, repeats)
+    print('max output difference: {:.2e}'.format(max(diffs)))
+    print('exit\toriginal (ms)\tfolded (ms)\tdrop')
+    for exit_id, (b, a) in enumerate(zip(before, after)):
+        print('{}\t{:.3f}\t\t{:.3f}\t\t{:.1f}%'.format(exit_id, b, a, 100 * (b - a) / b))
+    return exported, before, after
+
+
+if __name__ == '__main__':
+    import sys
+    import network_architectures as arcs
+
+    models_path, model_name = sys.argv[1], sys.argv[2]
+    device = af.get_pytorch_device()
+    model, model_params = arcs.load_model(models_path, model_name, epoch=-1)
+    model.to(device)
+    input_size = int(model_params['input_size']) if 'input_size' in model_params else 32
+    benchmark_export(model, input_size, device)
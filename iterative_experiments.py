@@ -1,8 +1,12 @@
 import copy
 import getopt
+import os
 import sys
 
+import torch.multiprocessing as mp
+
 import aux_funcs as af
+import distributed
 import network_architectures as arcs
 
 
@@ -10,11 +14,38 @@ import network_architectures as arcs
 def train_model(models_path, cr_params, device, num=0):
     type, mode, pruning, ics = cr_params
     model, params = arcs.create_resnet_iterative(models_path, type, mode, pruning, ics, False)
-    dataset = af.get_dataset('cifar10')
+    dataset = distributed.shard_dataset(af.get_dataset('cifar10'))
     params['name'] = params['base_model'] + '_{}_{}'.format(type, mode)
     if model.prune:
         params['name'] += "_prune_{}".format([x * 100 for x in model.keep_ratio])
         print("prune: {}".format(model.keep_ratio))
+    set_schedule(params, type, mode)
+    print("lr: {}".format(params['learning_rate']))
+
+    opti_param = (params['learning_rate'], params['weight_decay'], params['momentum'], -1)
+    lr_schedule_params = (params['milestones'], params['gammas'])
+
+    model.to(device)
+    train_params = get_train_params(params, pruning[2])
+    train_params['metrics_stream'] = os.path.join(models_path, params['name'], 'metrics.jsonl')
+
+    params['epoch_growth']=train_params['epoch_growth']
+    params['epoch_prune']=train_params['epoch_prune']
+    optimizer, scheduler = af.get_full_optimizer(model, opti_param, lr_schedule_params)
+    metrics, best_model = model.train_func(model, dataset,
+                                           train_params,
+                                           optimizer, scheduler, device)
+    _link_metrics(params, metrics)
+
+    af.print_sparsity(best_model)
+
+    if distributed.get_rank() == 0:
+        arcs.save_model(best_model, params, models_path, params['name'], epoch=-1)
+    print("test acc: {}, last val: {}".format(params['test_top1_acc'], params['valid_top1_acc'][-1]))
+    return best_model, params
+
+
+def set_schedule(params, type, mode):
     if mode == "0":
         params['epochs'] = 250
         params['milestones'] = [120, 160, 180]
@@ -27,36 +58,19 @@ def train_model(models_path, cr_params, device, num=0):
 
     if "full" in type:
         params['learning_rate'] = 0.1
-    print("lr: {}".format(params['learning_rate']))
 
-    opti_param = (params['learning_rate'], params['weight_decay'], params['momentum'], -1)
-    lr_schedule_params = (params['milestones'], params['gammas'])
 
-    model.to(device)
-    train_params = dict(
+def get_train_params(params, prune_batch_size):
+    return dict(
         epochs=params['epochs'],
         epoch_growth=[25, 50, 75],
         epoch_prune=[10, 35, 60, 85, 110, 135, 160],  #[10, 35, 60, 85],
-        prune_batch_size=pruning[2],
+        prune_batch_size=prune_batch_size,
         prune_type='2',  # 0 skip layer, 1 normal full, 2 iterative
         reinit=False,
         min_ratio=[0.3, 0.1, 0.05, 0.05]  # not needed if skip layers, minimum for the iterative pruning
     )
 
-    params['epoch_growth']=train_params['epoch_growth']
-    params['epoch_prune']=train_params['epoch_prune']
-    optimizer, scheduler = af.get_full_optimizer(model, opti_param, lr_schedule_params)
-    metrics, best_model = model.train_func(model, dataset,
-                                           train_params,
-                                           optimizer, scheduler, device)
-    _link_metrics(params, metrics)
-
-    af.print_sparsity(best_model)
-
-    arcs.save_model(best_model, params, models_path, params['name'], epoch=-1)
-    print("test acc: {}, last val: {}".format(params['test_top1_acc'], params['valid_top1_acc'][-1]))
-    return best_model, params
-
 
 def multi_experiments(models_path, params, device):
     count = 0
@@ -81,6 +95,8 @@ def _link_metrics(params, metrics):
     params['epoch_times'] = metrics['epoch_times']
     params['lrs'] = metrics['lrs']
     params['best_model_epoch'] = metrics['best_model_epoch']
+    if 'timings' in metrics:
+        params['timings'] = metrics['timings']
 
 def main(mode, load):
     random_seed = af.get_random_seed()
@@ -109,9 +125,12 @@ def main(mode, load):
     #af.print_acc(arr, extend=False)
     #af.plot_acc([m[1] for m in arr])
     #print the numbers of paramters
-    for m in [t[0] for t in arr]:
+    for m, p in arr:
         print("")
-        print("flops: {}".format(af.calculate_flops(m, (3,32,32))))
+        p['flops'] = af.calculate_flops(m, (3,32,32))
+        print("flops: {}".format(p['flops']))
+    if distributed.get_rank() != 0:
+        return
     for m, p in arr:
         arcs.save_model(m, p, models_path, p['name'], -1)
     print("model: {}".format(arr[0][0]))
@@ -132,18 +151,40 @@ def main(mode, load):
     #     print("flops: {}".format(af.calculate_flops(m, (3,32,32))))
 
 
+def distributed_main(rank, world_size, mode, load):
+    distributed.init_process(rank, world_size)
+    if rank != 0:  # only rank 0 logs
+        sys.stdout = open(os.devnull, 'w')
+    if rank == 0:  # downloads the dataset once
+        af.get_dataset('cifar10')
+    distributed.barrier()
+    # after the download, which draws the train/valid split of rank 0: same split, same initialization of the
+    # models and of the grown layers on every rank
+    af.set_random_seeds()
+    try:
+        main(mode, load)
+    finally:
+        distributed.cleanup()
+
+
 if __name__ == '__main__':
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], 'm:l:')
+        optlist, args = getopt.getopt(sys.argv[1:], 'm:l:n:')
     except getopt.GetoptError as err:
         print(err)
         sys.exit(2)
     mode = 0
     load = None
+    num_processes = 1
     for opt, arg in optlist:
         if opt == "-m":
             mode = arg
         if opt == "-l":
             load = arg
+        if opt == "-n":  # number of cpu processes for data parallel training
+            num_processes = int(arg)
 
-    main(mode, load)
+    if num_processes > 1:
+        mp.spawn(distributed_main, args=(num_processes, mode, load), nprocs=num_processes)
+    else:
+        main(mode, load)
@@ -0,0 +1,82 @@
+# metrics_stream.py
+# per-epoch metrics of a training appended to a json lines file while it runs: one os.write per record (a single
+# append, the readers never see half of a record except at the end of the file) and an fsync every fsync_interval
+# seconds, so a running experiment can be followed (registry.ingest_stream, af.plot_stream_acc) without waiting
+# for the parameters pickled at the end
+
+import json
+import os
+import time
+
+
+def _json_default(obj):
+    # accuracies are numpy scalars or tensors
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return float(obj)
+
+
+class MetricsStream(object):
+    def __init__(self, path, fsync_interval=30.):
+        directory = os.path.dirname(path)
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.fsync_interval = fsync_interval
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self.last_fsync = time.time()
+        self.cache = {}  # values reused across records until they change, e.g. the flops between growths and prunings
+
+    def write(self, record):
+        line = (json.dumps(record, default=_json_default) + '\n').encode('utf-8')
+        written = os.write(self.fd, line)
+        while written < len(line):
+            written += os.write(self.fd, line[written:])
+        if time.time() - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.fd)
+            self.last_fsync = time.time()
+
+    def close(self):
+        if self.fd is None:
+            return
+        os.fsync(self.fd)
+        os.close(self.fd)
+        self.fd = None
+
+
+def read(path, offset=0):
+    # the complete records after offset and the offset of the next record, to tail a running experiment
+    if not os.path.exists(path):
+        return [], offset
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b'\n') + 1  # a record being written is read the next time
+    records = [json.loads(line) for line in data[:end].decode('utf-8').splitlines() if line.strip()]
+    return records, offset + end
+
+
+def follow(path, interval=5.):
+    # yields the records as they are written
+    offset = 0
+    while True:
+        records, offset = read(path, offset)
+        for record in records:
+            yield record
+        if len(records) == 0:
+            time.sleep(interval)
+
+
+def to_params(records, name=None):
+    # the records in the format of the model parameters, as expected by af.plot_acc
+    params = {
+        'name': name if name is not None else 'stream',
+        'epochs': len(records),
+        'best_model_epoch': None,
+        'test_top1_acc': None
+    }
+    for key, column in [('valid_top1_acc', 'valid_top1_acc'), ('valid_top3_acc', 'valid_top3_acc'),
+                        ('train_top1_acc', 'train_top1_acc'), ('train_top3_acc', 'train_top3_acc'),
+                        ('lr', 'lrs'), ('epoch_time', 'epoch_times'), ('loss', 'losses'), ('flops', 'flops_curve')]:
+        params[column] = [record.get(key) for record in records]
+    return params
@@ -11,25 +11,33 @@ import torch.nn as nn
 
 import aux_funcs as af
 import data
+import distributed
+import metrics_stream
+import profiler
 import snip
+import timing
 
 import pdb
 
 def sdn_training_step(optimizer, model, coeffs, batch, device, epoch):
     b_x = batch[0].to(device)
     b_y = batch[1].to(device)
-    output = model(b_x)
+    with timing.span('forward'):
+        output = distributed.wrap(model)(b_x)
     optimizer.zero_grad()  # clear gradients for this training step
-    total_loss = sdn_loss(output, b_y, coeffs)
-    total_loss.backward()
-    optimizer.step()  # apply gradients
+    with timing.span('loss'):
+        total_loss = sdn_loss(output, b_y, coeffs)
+    with timing.span('backward'):
+        total_loss.backward()
+    with timing.span('optimizer_step'):
+        optimizer.step()  # apply gradients
     return total_loss
 
 
 def sdn_ic_only_step(optimizer, model, batch, device):
     b_x = batch[0].to(device)
     b_y = batch[1].to(device)
-    output = model(b_x)
+    output = distributed.wrap(model)(b_x)
     optimizer.zero_grad()  # clear gradients for this training step
     total_loss = 0.0
 
@@ -68,17 +76,25 @@ def sdn_train(model, data, params, optimizer, scheduler, device='cpu'):
                'lrs': []}
     max_coeffs = np.array([0.15, 0.3, 0.45, 0.6, 0.75, 0.9])  # max tau_i --- C_i values
     epochs = params['epochs']
+    timing_state = timing.get_state()
+    if params.get('timing'):
+        timing.enable()
+        timing.reset()  # spans recorded before the training are not of its first epoch
+    training_profiler = profiler.get_training_profiler(params.get('profile'))
+    stream = get_metrics_stream(params)
     if model.ic_only:
         print('sdn will be converted from a pre-trained CNN...  (The IC-only training)')
     else:
         print('sdn will be trained from scratch...(The SDN training)')
 
-    if model.prune:
+    if getattr(model, 'prune', False):
         loader = get_loader(data, False)
         prune2(model, model.keep_ratio, loader, sdn_loss, device)
+        distributed.broadcast_model(model)
     best_model, accuracies, best_epoch = None, None, 0
     for epoch in range(1, epochs + 1):
-        epoch_routine(model, data, optimizer, scheduler, epoch, epochs, augment, metrics, device)
+        epoch_routine(model, data, optimizer, scheduler, epoch, epochs, augment, metrics, device, training_profiler,
+                      stream)
 
         print("best model evaluation: {}/{}".format(metrics['valid_top1_acc'][-1], accuracies))
         if best_model is None:
@@ -89,11 +105,14 @@ def sdn_train(model, data, params, optimizer, scheduler, device='cpu'):
             best_model, accuracies = copy.deepcopy(model), metrics['valid_top1_acc'][-1]
             best_epoch = epoch
             print("New best model: {}".format(accuracies))
+    if stream is not None:
+        stream.close()
     metrics['test_top1_acc'], metrics['test_top3_acc'] = sdn_test(best_model, data.test_loader, device)
     test_top1, test_top3 = sdn_test(model, data.test_loader, device)
     metrics['best_model_epoch'] = best_epoch
     print("best epoch: {}".format(best_epoch))
     print("comparison best and latest: {}/{}".format(metrics['test_top1_acc'], test_top1))
+    timing.set_state(timing_state)
     return metrics, best_model
 
 
@@ -118,6 +137,8 @@ def sdn_test(model, loader, device='cpu'):
                 top1[output_id].update(prec1[0], b_x.size(0))
                 top3[output_id].update(prec3[0], b_x.size(0))
 
+    distributed.all_reduce_meters(top1 + top3)
+
     top1_accs = []
     top3_accs = []
 
@@ -260,20 +281,25 @@ def sdn_test_early_exits(model, loader, device='cpu'):
 def cnn_training_step(model, optimizer, data, labels, device='cpu', islist=False):
     b_x = data.to(device)  # batch x
     b_y = labels.to(device)  # batch y
-    output = model(b_x)
+    with timing.span('forward'):
+        output = model(b_x)
     if isinstance(output, list):  # cnn final output
         output = output[0]
     criterion = af.get_loss_criterion()
-    loss = criterion(output, b_y)  # cross entropy loss
+    with timing.span('loss'):
+        loss = criterion(output, b_y)  # cross entropy loss
     optimizer.zero_grad()  # clear gradients for this training step
-    loss.backward()  # backpropagation, compute gradients
-    optimizer.step()  # apply gradients
+    with timing.span('backward'):
+        loss.backward()  # backpropagation, compute gradients
+    with timing.span('optimizer_step'):
+        optimizer.step()  # apply gradients
 
 
-def cnn_train(model, data, epochs, optimizer, scheduler, device='cpu'):
+def cnn_train(model, data, epochs, optimizer, scheduler, device='cpu', profile=None):
     metrics = {'epoch_times': [], 'test_top1_acc': [], 'test_top3_acc': [], 'train_top1_acc': [], 'train_top3_acc': [],
                'lrs': []}
     print("cnn training")
+    training_profiler = profiler.get_training_profiler(profile)
     for epoch in range(1, epochs + 1):
         scheduler.step()
 
@@ -288,18 +314,23 @@ def cnn_train(model, data, epochs, optimizer, scheduler, device='cpu'):
         model.train()
         print('Epoch: {}/{}'.format(epoch, epochs))
         print('Cur lr: {}'.format(cur_lr))
-        for x, y in train_loader:
+        training_profiler.start_epoch(model, epoch)
+        for x, y in timing.iterate(train_loader):
             cnn_training_step(model, optimizer, x, y, device)
+            training_profiler.step()
+        training_profiler.end_epoch()
 
         end_time = time.time()
 
-        top1_test, top3_test = cnn_test(model, data.test_loader, device)
+        with timing.span('validation'):
+            top1_test, top3_test = cnn_test(model, data.test_loader, device)
         print('Top1 Test accuracy: {}'.format(top1_test))
         print('Top3 Test accuracy: {}'.format(top3_test))
         metrics['test_top1_acc'].append(top1_test)
         metrics['test_top3_acc'].append(top3_test)
 
-        top1_train, top3_train = cnn_test(model, train_loader, device)
+        with timing.span('train_evaluation'):
+            top1_train, top3_train = cnn_test(model, train_loader, device)
         print('Top1 Train accuracy: {}'.format(top1_train))
         print('top3 Train accuracy: {}'.format(top3_train))
         metrics['train_top1_acc'].append(top1_train)
@@ -309,6 +340,7 @@ def cnn_train(model, data, epochs, optimizer, scheduler, device='cpu'):
         metrics['epoch_times'].append(epoch_time)
 
         metrics['lrs'].append(cur_lr)
+        record_timings(metrics, time.time() - start_time)
 
     return metrics
 
@@ -393,21 +425,37 @@ def cnn_get_confidence(model, loader, device='cpu'):
 
 
 # default training
+# resumable: params['stop_epoch'] stops the training before params['epochs'] and the state of the training is
+# left in params['state'], a later call with this state continues from the next epoch (successive halving)
 def iter_training_0(model, data, params, optimizer, scheduler, device='cpu'):
     print("iter training 0")
     augment = model.augment_training
-    metrics = {
-        'epoch_times': [],
-        'valid_top1_acc': [],
-        'valid_top3_acc': [],
-        'train_top1_acc': [],
-        'train_top3_acc': [],
-        'test_top1_acc': [],
-        'test_top3_acc': [],
-        'lrs': []
-    }
+    state = params.get('state')
+    if state is None:
+        state = {
+            'epoch': 0,
+            'metrics': {
+                'epoch_times': [],
+                'valid_top1_acc': [],
+                'valid_top3_acc': [],
+                'train_top1_acc': [],
+                'train_top3_acc': [],
+                'test_top1_acc': [],
+                'test_top3_acc': [],
+                'lrs': []
+            },
+            'best_model': None, 'accuracies': None, 'best_epoch': 0,
+            'masks': [], 'mask1': None, 'block_to_prune': 0
+        }
+    metrics = state['metrics']
     epochs, epoch_growth, epoch_prune = params['epochs'], params['epoch_growth'], params['epoch_prune']
     pruning_batch_size, pruning_type, reinit = params['prune_batch_size'], params['prune_type'], params['reinit']
+    timing_state = timing.get_state()
+    if params.get('timing'):
+        timing.enable()
+        timing.reset()  # spans recorded before the training are not of its first epoch
+    training_profiler = profiler.get_training_profiler(params.get('profile'))
+    stream = get_metrics_stream(params)
 
     #epoch_growth = [25, 50, 75]  # [(i + 1) * epochs / (model.num_ics + 1) for i in range(model.num_ics)]
     print("array params: num_ics {}, epochs {}".format(model.num_ics, epochs))
@@ -417,28 +465,28 @@ def iter_training_0(model, data, params, optimizer, scheduler, device='cpu'):
     max_coeffs = calc_coeff(model)
     print('max_coeffs: {}'.format(max_coeffs))
     model.to(device)
-    model.to_train()
+    # a fully grown network (a resumed run) keeps the forward set by its last growth, with the final output
+    if model.num_output < model.num_ics + 1:
+        model.to_train()
 
     if model.prune:
-        prune_dataset = af.get_dataset('cifar10', batch_size=pruning_batch_size)
+        prune_loader = get_prune_loader(data, pruning_batch_size)
         print("pruning_batch_size: {}, prune_type: {}, reinit: {}".format(pruning_batch_size, pruning_type, reinit))
         print("min_ratio: {}".format(params['min_ratio']))
         print("keep_ratio: {}".format(model.keep_ratio))
 
-    best_model, accuracies, best_epoch = None, None, 0
-    masks = []
-    mask1 = None
-    block_to_prune = 0
-    for epoch in range(1, epochs + 1):
+    growth = af.GrowthManager(optimizer, scheduler, params.get('warmup_epochs', 0))
+    best_model, accuracies, best_epoch = state['best_model'], state['accuracies'], state['best_epoch']
+    masks, mask1, block_to_prune = state['masks'], state['mask1'], state['block_to_prune']
+    stop_epoch = min(params['stop_epoch'], epochs) if 'stop_epoch' in params else epochs
+    for epoch in range(state['epoch'] + 1, stop_epoch + 1):
         print('\nEpoch: {}/{}'.format(epoch, epochs))
         if epoch in epoch_growth:
-            grown_layers = model.grow()
-            model.to(device)
-            optimizer.add_param_group({'params': grown_layers})
+            growth.grow(model, device)
             print("model grow")
 
         if epoch in epoch_prune and model.prune:
-            loader = get_loader(prune_dataset, False)
+            loader = prune_loader
             if pruning_type == '0':
                 mask1 = prune_skip_layer(model, model.keep_ratio, loader, sdn_loss, block_to_prune, mask1, device, reinit)
                 block_to_prune += 1
@@ -456,8 +504,14 @@ def iter_training_0(model, data, params, optimizer, scheduler, device='cpu'):
                 mask = prune_iterative(model, model.keep_ratio, params['min_ratio'], steps, loader, sdn_loss, device, reinit)
                 masks.append(mask)
                 mask1 = mask
+            # the masks of rank 0 are kept, each rank computed them on its own batches
+            distributed.broadcast_model(model)
 
-        epoch_routine(model, data, optimizer, scheduler, epoch, epochs, augment, metrics, device)
+        if stream is not None and (epoch in epoch_growth or (epoch in epoch_prune and model.prune)):
+            stream.cache.pop('flops', None)  # the structure or the masks changed
+
+        epoch_routine(model, data, optimizer, scheduler, epoch, epochs, augment, metrics, device, training_profiler,
+                      stream)
 
         if model.num_output == model.num_ics + 1:
             if model.prune and epoch >= epoch_prune[-1]:
@@ -470,12 +524,22 @@ def iter_training_0(model, data, params, optimizer, scheduler, device='cpu'):
         
         af.print_sparsity(model)
 
+    state.update(epoch=max(state['epoch'], stop_epoch), best_model=best_model, accuracies=accuracies,
+                 best_epoch=best_epoch, masks=masks, mask1=mask1, block_to_prune=block_to_prune)
+    params['state'] = state
+    if stream is not None:
+        stream.close()
+    if stop_epoch < epochs:
+        timing.set_state(timing_state)
+        return metrics, best_model
+
     metrics['test_top1_acc'], metrics['test_top3_acc'] = sdn_test(best_model, data.test_loader, device)
     test_top1, _ = sdn_test(model, data.test_loader, device)
     metrics['best_model_epoch'] = best_epoch
     metrics['masks'] = masks
     print("best epoch: {}".format(best_epoch))
     print("comparison best and latest: {}/{}".format(metrics['test_top1_acc'], test_top1))
+    timing.set_state(timing_state)
     return metrics, best_model
 
 def best_model_def(best_model, model, accuracies, best_epoch, metrics, epoch):
@@ -496,6 +560,19 @@ def best_model_def(best_model, model, accuracies, best_epoch, metrics, epoch):
     return best_model, accuracies, best_epoch
 
 
+# score of the search runs and of the surrogate, which have any number of outputs: the deeper outputs weight
+# more, (i + 1) / n for the output i of n (0.25, 0.5, 0.75, 1 for 4 outputs, the weights of best_model_def),
+# divided by the sum of the weights so that the networks with more outputs, or grown sooner, are not favored
+def weighted_score(accuracies):
+    weights = [(i + 1) / len(accuracies) for i in range(len(accuracies))]
+    return sum([acc * w for acc, w in zip(accuracies, weights)]) / sum(weights)
+
+
+def get_prune_loader(data, batch_size):
+    # the snip batches come from the training set of the dataset already loaded
+    return torch.utils.data.DataLoader(data.trainset, batch_size=batch_size, shuffle=True)
+
+
 def sdn_loss(output, label, coeffs=None):
     total_loss = 0.0
     if coeffs is None:
@@ -533,6 +610,7 @@ def iter_training_4(model, data, epochs, optimizer, scheduler, device='cpu'):
                 if not grow:
                     break
         return grow
+    growth = af.GrowthManager(optimizer, scheduler)
     best_model, accuracies = None, None
     for epoch in range(epochs):
         epoch_routine(model, data, optimizer, scheduler, epoch, epochs, augment, metrics, device)
@@ -541,9 +619,7 @@ def iter_training_4(model, data, epochs, optimizer, scheduler, device='cpu'):
             print("num_output, ic_num: {}, {}".format(model.num_output, model.num_ics))
             if model.num_output == model.num_ics + 1:
                 break
-            grown_layers = model.grow()
-            model.to(device)
-            optimizer.add_param_group({'params': grown_layers})
+            growth.grow(model, device)
             print("model grow: {}".format(model.num_output))
         if model.num_output == model.num_ics + 1:
             print("best model evaluation")
@@ -557,7 +633,8 @@ def iter_training_4(model, data, epochs, optimizer, scheduler, device='cpu'):
     return metrics, best_model
 
 
-def epoch_routine(model, datas, optimizer, scheduler, epoch, epochs, augment, metrics, device):
+def epoch_routine(model, datas, optimizer, scheduler, epoch, epochs, augment, metrics, device, training_profiler=None,
+                  stream=None):
     scheduler.step()
     cur_lr = af.get_lr(optimizer)
     
@@ -569,20 +646,30 @@ def epoch_routine(model, datas, optimizer, scheduler, epoch, epochs, augment, me
     print("current coeffs: {}".format(cur_coeffs))
 
     start_time = time.time()
+    timing.watch_exits(model)
     model.train()
     loader = get_loader(datas, augment)
+    distributed.set_epoch(loader, epoch)
     losses = []
-    for i, batch in enumerate(loader):
+    if training_profiler is None:
+        training_profiler = profiler.get_training_profiler(None)
+    training_profiler.start_epoch(model, epoch)
+    for i, batch in enumerate(timing.iterate(loader)):
         total_loss = sdn_training_step(optimizer, model, cur_coeffs, batch, device, epoch)
+        training_profiler.step()
         losses.append(total_loss)
         if i % 100 == 0:
             print("Loss: {}".format(total_loss))
-    top1_test, top3_test = sdn_test(model, datas.aug_valid_loader if augment else datas.valid_loader, device)
+    training_profiler.end_epoch()
+    distributed.broadcast_buffers(model)
+    with timing.span('validation'):
+        top1_test, top3_test = sdn_test(model, datas.aug_valid_loader if augment else datas.valid_loader, device)
     end_time = time.time()
 
     print('Top1 Valid accuracies: {}'.format(top1_test))
     print('Top3 Valid accuracies: {}'.format(top3_test))
-    top1_train, top3_train = sdn_test(model, get_loader(datas, augment), device)
+    with timing.span('train_evaluation'):
+        top1_train, top3_train = sdn_test(model, get_loader(datas, augment), device)
     print('Top1 Train accuracies: {}'.format(top1_train))
     print('Top3 Train accuracies: {}'.format(top3_train))
 
@@ -595,12 +682,59 @@ def epoch_routine(model, datas, optimizer, scheduler, epoch, epochs, augment, me
     metrics['train_top3_acc'].append(top3_train)
     metrics['epoch_times'].append(epoch_time)
     metrics['lrs'].append(cur_lr)
+    record_timings(metrics, time.time() - start_time)
 
     loss_moy = sum(losses) / len(losses)
     print("mean loss: {}".format(loss_moy))
+    if stream is not None:
+        stream.write(get_epoch_record(model, metrics, epoch, loss_moy, stream))
     return loss_moy
 
 
+# params['metrics_stream']: path of the json lines file the metrics of every epoch are appended to, written by
+# rank 0 only; a resumed training appends to the same file
+def get_metrics_stream(params):
+    if params.get('metrics_stream') is None or distributed.get_rank() != 0:
+        return None
+    return metrics_stream.MetricsStream(params['metrics_stream'], params.get('metrics_fsync_interval', 30.))
+
+
+def get_epoch_record(model, metrics, epoch, loss, stream):
+    record = {
+        'epoch': epoch,
+        'time': time.time(),
+        'valid_top1_acc': metrics['valid_top1_acc'][-1],
+        'valid_top3_acc': metrics['valid_top3_acc'][-1],
+        'train_top1_acc': metrics['train_top1_acc'][-1],
+        'train_top3_acc': metrics['train_top3_acc'][-1],
+        'loss': float(loss),
+        'lr': metrics['lrs'][-1],
+        'epoch_time': metrics['epoch_times'][-1]
+    }
+    if hasattr(model, 'ics'):  # the blocks of snip.get_blocs and the flops of af.calculate_flops are of ResNet_Baseline
+        counts, (total, non_zero) = af.get_sparsity(model)
+        # fraction of zero weights, print_sparsity prints the fraction of non-zero weights
+        record['sparsity'] = [1. - float(p_z) / float(t_p) for t_p, p_z in counts]
+        record['total_sparsity'] = 1. - float(non_zero) / float(total)
+        # calculate_flops loops over the masks in python: only after a growth or a pruning (see iter_training_0)
+        if 'flops' not in stream.cache:
+            stream.cache['flops'] = af.calculate_flops(model, (3, model.input_size, model.input_size))
+        record['flops'] = stream.cache['flops']
+    if timing.is_enabled() and len(metrics.get('timings', [])) > 0:
+        record['timings'] = metrics['timings'][-1]
+    return record
+
+
+# the spans of the epoch (pruning before the epoch included) go to metrics['timings']
+def record_timings(metrics, epoch_time):
+    if not timing.is_enabled():
+        return
+    timing.add('epoch', epoch_time)
+    timings = timing.pop_summary()
+    timing.print_summary(timings)
+    metrics.setdefault('timings', []).append(timings)
+
+
 def calc_coeff(model):
     return [0.01 + (1 / model.num_output) * (i + 1) for i in range(model.num_output - 1)]
 
@@ -608,17 +742,23 @@ def calc_coeff(model):
 # max tau: % of the network for the IC -> if 3 outputs: 0.33, 0.66, 1
 
 def prune_skip_layer(model, keep_ratio, loader, loss, index_to_prune, previous_masks, device, reinit):
-    n_masks = snip.snip_skip_layers(model, keep_ratio, loader, loss, index_to_prune, previous_masks, device, reinit)
-    snip.apply_prune_mask_skip_layers(model, n_masks, index_to_prune)
+    with timing.span('snip_score'):
+        n_masks = snip.snip_skip_layers(model, keep_ratio, loader, loss, index_to_prune, previous_masks, device, reinit)
+    with timing.span('apply_mask'):
+        snip.apply_prune_mask_skip_layers(model, n_masks, index_to_prune)
     return n_masks
 
 def prune_iterative(model, k_r, min_ratio, steps, loader, loss, device, reinit):
-    masks = snip.snip_bloc_iterative(model, k_r, min_ratio, steps, loader, loss, device, reinit)
-    snip.apply_prune_mask_bloc_iterative(model, masks)
+    with timing.span('snip_score'):
+        masks = snip.snip_bloc_iterative(model, k_r, min_ratio, steps, loader, loss, device, reinit)
+    with timing.span('apply_mask'):
+        snip.apply_prune_mask_bloc_iterative(model, masks)
     
     return masks
 
 def prune2(layers, keep_ratio, loader, loss, device):
-    masks = snip.snip(layers, keep_ratio, loader, loss, device)
-    snip.apply_prune_mask(layers, masks)
+    with timing.span('snip_score'):
+        masks = snip.snip(layers, keep_ratio, loader, loss, device)
+    with timing.span('apply_mask'):
+        snip.apply_prune_mask(layers, masks)
     return masks
@@ -6,9 +6,14 @@
 import os
 import os.path
 import pickle
+import time
 
 import torch
 
+import checkpoint
+import distributed
+import registry
+import timing
 from architectures.CNNs.MobileNet import MobileNet
 from architectures.CNNs.ResNet import ResNet
 from architectures.CNNs.VGG import VGG
@@ -159,8 +164,8 @@ def create_mobilenet(models_path, task, save_type, get_params=False):
     return save_networks(model_name, model_params, models_path, save_type)
 
 
-def create_resnet_iterative(models_path, type="full", mode=None, prune=(False, 0.5, 128), ics=[0, 0, 1, 0, 0, 1, 0, 1, 0], return_name=True):
-    print('Creating Resnet for iterative training for cifar10')
+def get_resnet_iterative_params(type="full", mode=None, prune=(False, 0.5, 128), ics=[0, 0, 1, 0, 0, 1, 0, 1, 0],
+                                memory_efficient=False, growth_init='kaiming'):
     model_params = get_task_params('cifar10')
     model_name = '{}_resnet_{}'.format('cifar10', type)
     model_params['network_type'] = 'resnet_iterative'
@@ -169,8 +174,6 @@ def create_resnet_iterative(models_path, type="full", mode=None, prune=(False, 0
     model_params['block_type'] = 'basic'
     model_params['momentum'] = 0.9
 
-    network_type = model_params['network_type']
-
     model_params['weight_decay'] = 0.0001
 
     model_params['learning_rate'] = 0.01
@@ -185,17 +188,29 @@ def create_resnet_iterative(models_path, type="full", mode=None, prune=(False, 0
     model_params['size'] = len(ics)
     model_params['ics'] = ics
     model_params['prune'], model_params['keep_ratio'], _ = prune
+    model_params['memory_efficient'] = memory_efficient
+    model_params['growth_init'] = growth_init
+    return model_params
+
+
+def create_resnet_iterative(models_path, type="full", mode=None, prune=(False, 0.5, 128), ics=[0, 0, 1, 0, 0, 1, 0, 1, 0], return_name=True,
+                            memory_efficient=False, growth_init='kaiming'):
+    print('Creating Resnet for iterative training for cifar10')
+    model_params = get_resnet_iterative_params(type, mode, prune, ics, memory_efficient, growth_init)
+    model_name = model_params['base_model']
 
     model = ResNet_Baseline(model_params)
 
-    save_model(model, model_params, models_path, model_name, 0)
+    if distributed.get_rank() == 0:  # the ranks build the same model, one of them writes it
+        save_model(model, model_params, models_path, model_name, 0)
     return model_name if return_name else model, model_params
 
-def create_dense_iterative(models_path, prune):
+def create_dense_iterative(models_path, prune, memory_efficient=False):
+    print('Creating DenseNet for iterative training for cifar10')
     model_name = '{}_dense'.format('cifar10')
     model_params = {
         'network_type' : 'dense_iterative',
-        'augment' : True,
+        'augment_training' : True,
         'init_weights' : True,
         'momentum' : 0.9,
         'weight_decay' : 0.0001,
@@ -211,13 +226,16 @@ def create_dense_iterative(models_path, prune):
             0,0,0,1,
             0,0,0
         ],
+        'growth_rate' : 16,
+        'memory_efficient' : memory_efficient,
+        'prune' : True,
         'keep_ratio' : prune[0],
         'min_ratio' : prune[1],
         'prune_type' : prune[2],
         **get_task_params('cifar10')
     }
 
-    model = DenseNet(model_params['size'], model_params['ics'], model_params['init_weights'])
+    model = DenseNet(model_params)
 
     save_model(model, model_params, models_path, model_name, 0)
     return model, model_params
@@ -300,28 +318,58 @@ def save_model(model, model_params, models_path, model_name, epoch=-1):
         path = network_path + '/' + str(epoch)
         params_path = network_path + '/parameters_' + str(epoch)
 
-    torch.save(model.state_dict(), path)
+    start_time = time.perf_counter()
+    checkpoint.save(model, path)
+    add_checkpoint_timing(model_params, time.perf_counter() - start_time)
 
     if model_params is not None:
         with open(params_path, 'wb') as f:
             pickle.dump(model_params, f, pickle.HIGHEST_PROTOCOL)
+        registry.record_model(models_path, model_name, epoch, model_params, path, params_path)
+
+
+# the checkpoint of a timed training goes to the timings of its last epoch, saved with the parameters;
+# otherwise to the spans of the epoch in progress when the timers are on
+def add_checkpoint_timing(model_params, seconds):
+    timings = model_params.get('timings') if model_params is not None else None
+    if timings:
+        t = timings[-1].setdefault('checkpoint', {'time': 0., 'count': 0})
+        t['time'] += seconds
+        t['count'] += 1
+    elif timing.is_enabled():
+        timing.add('checkpoint', seconds)
 
 
 def load_params(models_path, model_name, epoch=0):
     params_path = models_path + '/' + model_name
     if epoch == 0:
         params_path = params_path + '/parameters_untrained'
-    else:
+    elif epoch == -1:
         params_path = params_path + '/parameters_last'
+    else:
+        params_path = params_path + '/parameters_' + str(epoch)
 
     with open(params_path, 'rb') as f:
         model_params = pickle.load(f)
     return model_params
 
 
-def load_model(models_path, model_name, epoch=0):
+def load_model(models_path, model_name, epoch=0, mmap=False):
+    # mmap: the weights stay in the mapped checkpoint file and are only read when they are used
     model_params = load_params(models_path, model_name, epoch)
 
+    network_path = models_path + '/' + model_name
+
+    if epoch == 0:  # untrained model
+        load_path = network_path + '/untrained'
+    elif epoch == -1:  # last model
+        load_path = network_path + '/last'
+    else:
+        load_path = network_path + '/' + str(epoch)
+
+    # checkpoints saved with torch.save before the checkpoint format existed only hold the weights
+    legacy = not checkpoint.is_checkpoint(load_path)
+
     architecture = 'empty' if 'architecture' not in model_params else model_params['architecture']
     network_type = model_params['network_type']
 
@@ -346,23 +394,24 @@ def load_model(models_path, model_name, epoch=0):
         elif 'mobilenet' in network_type:
             model = MobileNet(model_params)
 
+    elif network_type == 'dense_iterative':
+        model = DenseNet(model_params)
+        if legacy:
+            num_to_grow = sum([1 if epoch > grow else 0 for grow in model_params['epoch_growth']]) if epoch != -1 else len(model_params['epoch_growth'])
+            for _ in range(num_to_grow):
+                model.grow()
+
     elif 'iterative' or 'dense' in model_name:
         model = ResNet_Baseline(model_params)
-        num_to_grow = sum([1 if epoch > grow else 0 for grow in model_params['epoch_growth']]) if epoch != -1 else len(model_params['epoch_growth'])
-        for _ in range(num_to_grow):
-            model.grow()
-        
+        if legacy:
+            num_to_grow = sum([1 if epoch > grow else 0 for grow in model_params['epoch_growth']]) if epoch != -1 else len(model_params['epoch_growth'])
+            for _ in range(num_to_grow):
+                model.grow()
 
-    network_path = models_path + '/' + model_name
-
-    if epoch == 0:  # untrained model
-        load_path = network_path + '/untrained'
-    elif epoch == -1:  # last model
-        load_path = network_path + '/last'
+    if legacy:
+        model.load_state_dict(torch.load(load_path), strict=False)
     else:
-        load_path = network_path + '/' + str(epoch)
-
-    model.load_state_dict(torch.load(load_path), strict=False)
+        checkpoint.CheckpointReader(load_path).restore(model, mmap)
 
     return model, model_params
 
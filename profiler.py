@@ -1,10 +1,14 @@
 # profiler.py
 # to compute GFLOPs (inference cost) and num params of a CNN or SDN
+# and TrainingProfiler: torch.profiler on a window of training steps of chosen epochs
+
+import os
 
 import torch
 import torch.nn as nn
 
 import aux_funcs as af
+import timing
 
 
 def count_conv2d(m, x, y):
@@ -207,3 +211,105 @@ def profile(model, input_size, device):
     total_params = total_params
 
     return total_ops, total_params
+
+
+class _NullProfiler(object):
+    def start_epoch(self, model, epoch):
+        pass
+
+    def step(self):
+        pass
+
+    def end_epoch(self):
+        pass
+
+
+def _region_start(name):
+    def hook(module, input):
+        region = torch.autograd.profiler.record_function(name)
+        region.__enter__()
+        module._profiler_regions.append(region)
+    return hook
+
+
+def _region_end(module, input, output):
+    if len(module._profiler_regions) > 0:
+        module._profiler_regions.pop().__exit__(None, None, None)
+
+
+class TrainingProfiler(object):
+    # config: path of the traces and tables, epochs to profile, schedule of the steps of the window
+    # (wait, warmup and active steps), top_k ops of the table and their sort key
+    def __init__(self, config):
+        self.path = config['path']
+        self.epochs = config['epochs'] if 'epochs' in config else [1]
+        self.wait = config['wait'] if 'wait' in config else 1
+        self.warmup = config['warmup'] if 'warmup' in config else 1
+        self.active = config['active'] if 'active' in config else 5
+        self.top_k = config['top_k'] if 'top_k' in config else 20
+        self.sort_by = config['sort_by'] if 'sort_by' in config else 'self_cpu_time_total'
+        self.prof = None
+        self.epoch = None
+        self.handles = []
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def _label_regions(self, model):
+        # record_function regions for the blocks, the exits and the end layers
+        modules = [('block_{}'.format(i), block) for i, block in enumerate(getattr(model, 'layers', []))]
+        exit_id = 0
+        for _, block in modules[:]:
+            if not getattr(block, 'no_output', True):
+                modules.append(('exit_{}'.format(exit_id), block.output))
+                exit_id += 1
+        if hasattr(model, 'end_layers'):
+            modules.append(('end_layers', model.end_layers))
+        for name, module in modules:
+            module._profiler_regions = []
+            self.handles.append(module.register_forward_pre_hook(_region_start(name)))
+            self.handles.append(module.register_forward_hook(_region_end))
+
+    def _on_trace_ready(self, prof):
+        trace_path = os.path.join(self.path, 'epoch_{}_trace.json'.format(self.epoch))
+        prof.export_chrome_trace(trace_path)
+        table = prof.key_averages(group_by_input_shape=True).table(sort_by=self.sort_by, row_limit=self.top_k)
+        with open(os.path.join(self.path, 'epoch_{}_top{}.txt'.format(self.epoch, self.top_k)), 'w') as f:
+            f.write(table)
+        print(table)
+        print('chrome trace: {}'.format(trace_path))
+
+    def start_epoch(self, model, epoch):
+        if epoch not in self.epochs:
+            return
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.epoch = epoch
+        self._label_regions(model)
+        timing.set_record_function(True)
+        self.prof = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=self.wait, warmup=self.warmup, active=self.active, repeat=1),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=True,
+            profile_memory=True)
+        self.prof.__enter__()
+
+    def step(self):
+        if self.prof is not None:
+            self.prof.step()
+
+    def end_epoch(self):
+        if self.prof is None:
+            return
+        # an epoch shorter than the window still exports what was recorded
+        self.prof.__exit__(None, None, None)
+        self.prof = None
+        timing.set_record_function(False)
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+
+def get_training_profiler(config):
+    return TrainingProfiler(config) if config else _NullProfiler()
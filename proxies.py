@@ -0,0 +1,130 @@
+# proxies.py
+# zero-cost proxies: scores of an untrained network computed on a single batch in a few seconds on cpu, used to
+# rank ResNet_Baseline configurations (placement of the ics, size, dense or iterative) before training them
+#   snip: sum of the saliencies |g.w| of the weights (the masks of snip.py), for the sdn loss of all the outputs
+#   synflow: synaptic flow, product of the absolute weights along the paths, on an input of ones (no data)
+#   jacob_cov: correlation of the input jacobians of the samples, low when the network separates the samples
+
+import copy
+import itertools
+import time
+
+import numpy as np
+import torch
+
+import model_funcs as mf
+import network_architectures as arcs
+import snip
+from architectures.SDNs.ResNet_Baseline import ResNet_Baseline
+
+
+def get_ics_placements(size, num_ics):
+    # no ic on the first and last blocks
+    placements = []
+    for positions in itertools.combinations(range(1, size - 1), num_ics):
+        placements.append([1 if i in positions else 0 for i in range(size)])
+    return placements
+
+
+def build_network(ics, type='iterative'):
+    # the fully grown network of the configuration
+    params = arcs.get_resnet_iterative_params(type, None, (False, 1., 0), ics)
+    model = ResNet_Baseline(params)
+    for _ in range(model.num_ics):
+        model.grow()
+    model.to_eval()
+    return model
+
+
+def snip_score(model, inputs, targets):
+    network = snip.add_saliency_masks(copy.deepcopy(model))
+    network.train()
+    network.zero_grad()
+    mf.sdn_loss(network(inputs), targets).backward()
+    return sum([float(torch.sum(torch.abs(g))) for g in snip.get_saliencies(network)])
+
+
+def synflow_score(model, inputs, targets=None):
+    # double: the flow overflows in float for the deeper networks
+    network = snip.add_saliency_masks(copy.deepcopy(model)).double()
+    network.eval()  # the batch norms use their running statistics
+    with torch.no_grad():
+        for p in network.parameters():
+            p.abs_()
+    network.zero_grad()
+    outputs = network(torch.ones((1,) + tuple(inputs.shape[1:]), dtype=torch.float64, device=inputs.device))
+    sum([torch.sum(output) for output in outputs]).backward()
+    return sum([float(torch.sum(g)) for g in snip.get_saliencies(network)])
+
+
+def jacob_cov_score(model, inputs, targets=None):
+    network = copy.deepcopy(model)
+    network.train()
+    network.zero_grad()
+    x = inputs.clone().requires_grad_(True)
+    output = network(x)[-1]
+    output.backward(torch.ones_like(output))
+    jacobs = x.grad.view(x.size(0), -1).cpu().numpy()
+    eigenvalues = np.linalg.eigvalsh(np.corrcoef(jacobs))
+    k = 1e-5
+    return -float(np.sum(np.log(eigenvalues + k) + 1. / (eigenvalues + k)))
+
+
+PROXIES = {
+    'snip': snip_score,
+    'synflow': synflow_score,
+    'jacob_cov': jacob_cov_score
+}
+
+
+def score_network(model, inputs, targets, proxies=('snip', 'synflow', 'jacob_cov')):
+    for proxy in proxies:
+        if proxy not in PROXIES:
+            raise KeyError("the proxy should be either 'snip', 'synflow' or 'jacob_cov' and it is: {}".format(proxy))
+    return {proxy: PROXIES[proxy](model, inputs, targets) for proxy in proxies}
+
+
+def rank_configs(configs, loader, type='iterative', proxies=('snip', 'synflow', 'jacob_cov'), device='cpu'):
+    # configs: dicts with an 'ics' entry, returns the configs sorted from the best and their scores
+    # the proxies only see the architecture, the configs sharing a placement of the ics are scored once
+    inputs, targets = next(iter(loader))
+    inputs, targets = inputs.to(device), targets.to(device)
+    scores = {}
+    start_time = time.time()
+    for config in configs:
+        key = (config.get('type', type), tuple(config['ics']))
+        if key not in scores:
+            model = build_network(list(key[1]), key[0]).to(device)
+            scores[key] = score_network(model, inputs, targets, proxies)
+    print('{} architectures scored in {:.1f}s'.format(len(scores), time.time() - start_time))
+
+    # the proxies have different scales: the architectures are ranked by their mean rank over the proxies
+    keys = list(scores.keys())
+    ranks = {key: 0. for key in keys}
+    for proxy in proxies:
+        for rank, key in enumerate(sorted(keys, key=lambda k: scores[k][proxy], reverse=True)):
+            ranks[key] += rank / len(proxies)
+    order = sorted(range(len(configs)), key=lambda i: ranks[(configs[i].get('type', type), tuple(configs[i]['ics']))])
+    return [configs[i] for i in order], [scores[(configs[i].get('type', type), tuple(configs[i]['ics']))] for i in order]
+
+
+def filter_configs(configs, loader, num_configs, type='iterative', proxies=('snip', 'synflow', 'jacob_cov'),
+                   device='cpu'):
+    ranked, scores = rank_configs(configs, loader, type, proxies, device)
+    for config, score in zip(ranked[:num_configs], scores[:num_configs]):
+        print('{}: {}'.format(config['ics'], score))
+    return ranked[:num_configs]
+
+
+if __name__ == '__main__':
+    import sys
+    import aux_funcs as af
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 9
+    type = sys.argv[2] if len(sys.argv) > 2 else 'iterative'
+    af.set_random_seeds()
+    dataset = af.get_dataset('cifar10')
+    configs = [{'ics': ics} for num_ics in [2, 3] for ics in get_ics_placements(size, num_ics)]
+    ranked, scores = rank_configs(configs, dataset.train_loader, type)
+    for config, score in zip(ranked, scores):
+        print('{}: {}'.format(config['ics'], score))
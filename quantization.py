@@ -0,0 +1,203 @@
+# quantization.py
+# post-training static int8 quantization of the SDNs (eager mode, fbgemm on x86 or qnnpack on arm cpus)
+# the blocks are wrapped in quantizable versions: the residual additions, the mixed max/avg pooling of the
+# internal classifiers and the dense concatenations go through FloatFunctional so that they get observers
+# the observers are calibrated on a streamed subset of the training set, then the accuracy and the latency
+# of every exit are compared with the float model
+
+import copy
+
+import torch
+import torch.nn as nn
+from torch.quantization import QuantStub, DeQuantStub
+from torch.nn.quantized import FloatFunctional
+
+import aux_funcs as af
+import inference
+import model_funcs as mf
+from architectures.SDNs.DenseNet import ConvBNRLUnit
+from architectures.SDNs.MobileNet_SDN import BlockWOutput
+from architectures.SDNs.ResNet_SDN import BasicBlockWOutput
+from architectures.SDNs.VGG_SDN import ConvBlockWOutput, FcBlockWOutput
+
+
+class QuantizableInternalClassifier(nn.Module):
+    def __init__(self, ic):
+        super(QuantizableInternalClassifier, self).__init__()
+        self.linear = ic.linear
+        self.pooling = hasattr(ic, 'alpha')
+        if self.pooling:
+            self.max_pool = ic.max_pool
+            self.avg_pool = ic.avg_pool
+            # the learned alpha is a constant once trained, it becomes a scalar multiplication
+            self.alpha = float(ic.alpha.detach().cpu())
+            self.mul_max = FloatFunctional()
+            self.mul_avg = FloatFunctional()
+            self.add = FloatFunctional()
+
+    def forward(self, x):
+        if self.pooling:
+            x = self.add.add(self.mul_max.mul_scalar(self.max_pool(x), self.alpha),
+                             self.mul_avg.mul_scalar(self.avg_pool(x), 1 - self.alpha))
+        return self.linear(x.reshape(x.size(0), -1))
+
+
+def _wrap_output(output):
+    if isinstance(output, af.InternalClassifier):
+        return QuantizableInternalClassifier(output)
+    return output
+
+
+class QuantizableBasicBlock(nn.Module):
+    def __init__(self, block):
+        super(QuantizableBasicBlock, self).__init__()
+        self.layers = block.layers
+        self.no_output = block.no_output
+        self.output = _wrap_output(block.output)
+        self.skip_add = FloatFunctional()
+
+    def forward(self, x):
+        fwd = self.skip_add.add(self.layers[0](x), self.layers[1](x))
+        if self.no_output:
+            return self.layers[2](fwd), 0, None
+        return self.layers[2](fwd), 1, self.output(fwd)
+
+
+class QuantizableSequentialBlock(nn.Module):
+    # the blocks without residual connection (MobileNet_SDN, VGG_SDN, DenseNet)
+    def __init__(self, block):
+        super(QuantizableSequentialBlock, self).__init__()
+        self.layers = block.layers
+        self.no_output = block.no_output
+        self.output = _wrap_output(block.output)
+
+    def forward(self, x):
+        fwd = self.layers(x)
+        if self.no_output:
+            return fwd, 0, None
+        return fwd, 1, self.output(fwd)
+
+
+def wrap_block(block):
+    if isinstance(block, BasicBlockWOutput):
+        return QuantizableBasicBlock(block)
+    elif isinstance(block, (BlockWOutput, ConvBlockWOutput, FcBlockWOutput, ConvBNRLUnit)):
+        return QuantizableSequentialBlock(block)
+    raise NotImplementedError("quantization is not implemented for the block: {}".format(type(block).__name__))
+
+
+class QuantizableSDN(nn.Module):
+    def __init__(self, model):
+        super(QuantizableSDN, self).__init__()
+        self.quant = QuantStub()
+        self.dequant = DeQuantStub()
+        self.init_conv = model.init_conv
+        self.layers = nn.ModuleList([wrap_block(layer) for layer in model.layers])
+        self.end_layers = model.end_layers
+        self.num_output = sum([not layer.no_output for layer in self.layers]) + 1
+        self.dense = getattr(model, 'init_type', None) == 'dense'
+        if self.dense:
+            # the concatenation of the features seen by every layer and by the end layers
+            self.cats = nn.ModuleList([FloatFunctional() for _ in range(len(self.layers) + 1)])
+
+    def forward(self, x):
+        outputs = []
+        fwd = self.init_conv(self.quant(x))
+        features = [fwd]
+        for layer_id, layer in enumerate(self.layers):
+            if self.dense:
+                fwd = self.cats[layer_id].cat(features, 1)
+            fwd, is_output, output = layer(fwd)
+            if self.dense:
+                features.append(fwd)
+            if is_output:
+                outputs.append(self.dequant(output))
+        if self.dense:
+            fwd = self.cats[-1].cat(features, 1)
+        outputs.append(self.dequant(self.end_layers(fwd)))
+        return outputs
+
+
+def fuse_sequential(seq):
+    # conv+bn+relu, conv+bn, conv+relu and linear+relu
+    names = list(seq._modules.keys())
+    groups = []
+    i = 0
+    while i < len(names):
+        cur = seq._modules[names[i]]
+        nxt = seq._modules[names[i + 1]] if i + 1 < len(names) else None
+        nxt2 = seq._modules[names[i + 2]] if i + 2 < len(names) else None
+        if isinstance(cur, nn.Conv2d) and isinstance(nxt, nn.BatchNorm2d):
+            size = 3 if isinstance(nxt2, nn.ReLU) else 2
+        elif isinstance(cur, (nn.Conv2d, nn.Linear)) and isinstance(nxt, nn.ReLU):
+            size = 2
+        else:
+            size = 1
+        if size > 1:
+            groups.append(names[i:i + size])
+        i += size
+    if len(groups) > 0:
+        torch.quantization.fuse_modules(seq, groups, inplace=True)
+    return len(groups)
+
+
+def quantize_sdn(model, loader, backend='fbgemm', num_batches=32):
+    # returns an int8 copy of the model, the given model is not modified
+    torch.backends.quantized.engine = backend
+    float_model = copy.deepcopy(model).cpu()
+    float_model.eval()
+    if hasattr(float_model, 'to_eval'):
+        float_model.to_eval()
+    inference.bake_masks(float_model)
+
+    qmodel = QuantizableSDN(float_model)
+    qmodel.eval()
+    num_fused = sum([fuse_sequential(m) for m in list(qmodel.modules()) if isinstance(m, nn.Sequential)])
+    print('{} layer groups fused'.format(num_fused))
+
+    qmodel.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(qmodel, inplace=True)
+    calibrate(qmodel, loader, num_batches)
+    torch.quantization.convert(qmodel, inplace=True)
+    return qmodel
+
+
+def calibrate(model, loader, num_batches):
+    # the batches are consumed from the loader as they come, only num_batches are read
+    with torch.no_grad():
+        for batch_id, batch in enumerate(loader):
+            if batch_id == num_batches:
+                break
+            model(batch[0])
+
+
+def compare_exits(model, qmodel, loader, input_size, repeats=100):
+    model = copy.deepcopy(model).cpu()
+    model.eval()
+    if hasattr(model, 'to_eval'):
+        model.to_eval()
+
+    float_top1, _ = mf.sdn_test(model, loader, 'cpu')
+    int8_top1, _ = mf.sdn_test(qmodel, loader, 'cpu')
+    float_time = inference.exit_latencies(model, input_size, 'cpu', repeats=repeats)
+    int8_time = inference.exit_latencies(qmodel, input_size, 'cpu', repeats=repeats)
+
+    print('exit\tfloat top1\tint8 top1\tfloat (ms)\tint8 (ms)')
+    for exit_id in range(len(float_top1)):
+        print('{}\t{:.2f}\t\t{:.2f}\t\t{:.3f}\t\t{:.3f}'.format(exit_id, float_top1[exit_id], int8_top1[exit_id],
+                                                              float_time[exit_id], int8_time[exit_id]))
+    return {'float_top1': float_top1, 'int8_top1': int8_top1, 'float_time': float_time, 'int8_time': int8_time}
+
+
+if __name__ == '__main__':
+    import sys
+    import network_architectures as arcs
+
+    models_path, model_name = sys.argv[1], sys.argv[2]
+    backend = sys.argv[3] if len(sys.argv) > 3 else 'fbgemm'
+    model, model_params = arcs.load_model(models_path, model_name, epoch=-1)
+    dataset = af.get_dataset(model_params['task'] if 'task' in model_params else 'cifar10')
+    input_size = int(model_params['input_size']) if 'input_size' in model_params else 32
+
+    qmodel = quantize_sdn(model, dataset.train_loader, backend)
+    compare_exits(model, qmodel, dataset.test_loader, input_size)
@@ -0,0 +1,262 @@
+# registry.py
+# sqlite index of the saved models: run configuration, per-epoch metrics, results and checkpoint paths
+# filled by network_architectures.save_model() and queried by the result summaries of aux_funcs
+# so that listing or comparing runs does not need to scan the models directory and unpickle every parameters file
+
+import json
+import os
+import sqlite3
+import time
+
+import metrics_stream
+
+REGISTRY_NAME = 'registry.db'
+
+# columns of the runs table read directly from the model parameters
+RUN_COLUMNS = ['task', 'network_type', 'architecture', 'init_type', 'epochs', 'total_time', 'flops']
+JSON_COLUMNS = ['ics', 'keep_ratio', 'min_ratio', 'epoch_growth', 'epoch_prune', 'test_top1_acc', 'test_top3_acc']
+EPOCH_COLUMNS = ['valid_top1_acc', 'valid_top3_acc', 'train_top1_acc', 'train_top3_acc']
+RUNNING_EPOCH = -2  # runs followed through their metrics stream, replaced by epoch -1 at the end of the training
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    epoch INTEGER NOT NULL,
+    task TEXT,
+    network_type TEXT,
+    architecture TEXT,
+    init_type TEXT,
+    epochs INTEGER,
+    total_time REAL,
+    flops REAL,
+    ics TEXT,
+    keep_ratio TEXT,
+    min_ratio TEXT,
+    epoch_growth TEXT,
+    epoch_prune TEXT,
+    test_top1_acc TEXT,
+    test_top3_acc TEXT,
+    final_top1_acc REAL,
+    best_epoch INTEGER,
+    checkpoint TEXT,
+    params_path TEXT,
+    updated REAL,
+    UNIQUE (name, epoch)
+);
+CREATE INDEX IF NOT EXISTS runs_network_type ON runs (network_type);
+CREATE INDEX IF NOT EXISTS runs_final_top1_acc ON runs (final_top1_acc);
+CREATE TABLE IF NOT EXISTS epoch_metrics (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    epoch INTEGER NOT NULL,
+    valid_top1_acc TEXT,
+    valid_top3_acc TEXT,
+    train_top1_acc TEXT,
+    train_top3_acc TEXT,
+    lr REAL,
+    epoch_time REAL,
+    PRIMARY KEY (run_id, epoch)
+);
+CREATE TABLE IF NOT EXISTS streams (
+    run_id INTEGER PRIMARY KEY REFERENCES runs (id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    position INTEGER NOT NULL
+);
+"""
+
+
+def get_registry_path(models_path):
+    return os.path.join(models_path, REGISTRY_NAME)
+
+
+def connect(models_path):
+    if not os.path.exists(models_path):
+        os.makedirs(models_path)
+    conn = sqlite3.connect(get_registry_path(models_path), timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA foreign_keys = ON')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _json_default(obj):
+    # accuracies are numpy scalars or tensors
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    return float(obj)
+
+
+def _dumps(value):
+    return None if value is None else json.dumps(value, default=_json_default)
+
+
+def _loads(value):
+    return None if value is None else json.loads(value)
+
+
+def _scalar(value):
+    if value is None:
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+def record_model(models_path, model_name, epoch, model_params, checkpoint=None, params_path=None):
+    row = {column: _scalar(model_params.get(column)) for column in RUN_COLUMNS}
+    row.update({column: _dumps(model_params.get(column)) for column in JSON_COLUMNS})
+    test_top1 = model_params.get('test_top1_acc')
+    row['final_top1_acc'] = float(test_top1[-1]) if test_top1 is not None and len(test_top1) > 0 else None
+    row['best_epoch'] = model_params.get('best_model_epoch')
+    row['checkpoint'] = checkpoint
+    row['params_path'] = params_path
+    row['updated'] = time.time()
+
+    conn = connect(models_path)
+    with conn:
+        if epoch == -1:  # the training is over, its stream is no longer followed
+            conn.execute('DELETE FROM runs WHERE name = ? AND epoch = ?', (model_name, RUNNING_EPOCH))
+        cur = conn.execute('SELECT id FROM runs WHERE name = ? AND epoch = ?', (model_name, epoch))
+        existing = cur.fetchone()
+        if existing is None:
+            columns = ['name', 'epoch'] + list(row.keys())
+            cur = conn.execute('INSERT INTO runs ({}) VALUES ({})'.format(', '.join(columns), ', '.join('?' * len(columns))),
+                               [model_name, epoch] + list(row.values()))
+            run_id = cur.lastrowid
+        else:
+            run_id = existing['id']
+            conn.execute('UPDATE runs SET {} WHERE id = ?'.format(', '.join('{} = ?'.format(c) for c in row.keys())),
+                         list(row.values()) + [run_id])
+            conn.execute('DELETE FROM epoch_metrics WHERE run_id = ?', (run_id,))
+
+        curves = [model_params.get(column) or [] for column in EPOCH_COLUMNS]
+        lrs = model_params.get('lrs') or []
+        epoch_times = model_params.get('epoch_times') or []
+        num_epochs = max([len(c) for c in curves] + [len(lrs), len(epoch_times)])
+        conn.executemany('INSERT INTO epoch_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+            [run_id, e + 1] + [_dumps(c[e]) if e < len(c) else None for c in curves] +
+            [_scalar(lrs[e]) if e < len(lrs) else None, _scalar(epoch_times[e]) if e < len(epoch_times) else None]
+            for e in range(num_epochs)])
+    conn.close()
+    return run_id
+
+
+def ingest_stream(models_path, model_name, stream_path):
+    # adds the epochs written to the metrics stream since the last call to the running run model_name
+    # (epoch RUNNING_EPOCH): only the new bytes of the stream are read, so it can be called at every refresh
+    conn = connect(models_path)
+    with conn:
+        existing = conn.execute('SELECT id FROM runs WHERE name = ? AND epoch = ?', (model_name, RUNNING_EPOCH)).fetchone()
+        if existing is None:
+            run_id = conn.execute('INSERT INTO runs (name, epoch, updated) VALUES (?, ?, ?)',
+                                  (model_name, RUNNING_EPOCH, time.time())).lastrowid
+            offset = 0
+        else:
+            run_id = existing['id']
+            stream = conn.execute('SELECT position FROM streams WHERE run_id = ?', (run_id,)).fetchone()
+            offset = stream['position'] if stream is not None else 0
+        records, offset = metrics_stream.read(stream_path, offset)
+        conn.executemany('INSERT OR REPLACE INTO epoch_metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)', [
+            [run_id, record['epoch']] + [_dumps(record.get(column)) for column in EPOCH_COLUMNS] +
+            [record.get('lr'), record.get('epoch_time')] for record in records])
+        conn.execute('INSERT OR REPLACE INTO streams VALUES (?, ?, ?)', (run_id, stream_path, offset))
+        if len(records) > 0:
+            conn.execute('UPDATE runs SET epochs = ?, flops = ?, updated = ? WHERE id = ?',
+                         (records[-1]['epoch'], records[-1].get('flops'), time.time(), run_id))
+    conn.close()
+    return len(records)
+
+
+def tail_streams(models_path):
+    # ingest_stream of every running run already known to the registry
+    conn = connect(models_path)
+    streams = conn.execute('SELECT runs.name, streams.path FROM streams JOIN runs ON runs.id = streams.run_id '
+                           'WHERE runs.epoch = ?', (RUNNING_EPOCH,)).fetchall()
+    conn.close()
+    return {stream['name']: ingest_stream(models_path, stream['name'], stream['path']) for stream in streams}
+
+
+def _run_from_row(row):
+    run = dict(row)
+    for column in JSON_COLUMNS:
+        run[column] = _loads(run[column])
+    run['best_model_epoch'] = run['best_epoch']
+    return run
+
+
+def get_runs(models_path, name_like=None, network_type=None, epoch=-1, order_by='name'):
+    # name_like is an sql LIKE pattern, e.g. 'cifar10_resnet_dense%'
+    if order_by not in ['name', 'final_top1_acc', 'flops', 'updated']:
+        raise ValueError("cannot order the runs by: {}".format(order_by))
+    query = 'SELECT * FROM runs WHERE epoch = ?'
+    args = [epoch]
+    if name_like is not None:
+        query += ' AND name LIKE ?'
+        args.append(name_like)
+    if network_type is not None:
+        query += ' AND network_type = ?'
+        args.append(network_type)
+    query += ' ORDER BY {}'.format(order_by)
+
+    conn = connect(models_path)
+    runs = [_run_from_row(row) for row in conn.execute(query, args)]
+    conn.close()
+    return runs
+
+
+def get_epoch_metrics(models_path, run_ids):
+    # {run id: {'valid_top1_acc': [...], ..., 'lrs': [...], 'epoch_times': [...]}}
+    conn = connect(models_path)
+    res = {run_id: {c: [] for c in EPOCH_COLUMNS + ['lrs', 'epoch_times']} for run_id in run_ids}
+    query = 'SELECT * FROM epoch_metrics WHERE run_id IN ({}) ORDER BY run_id, epoch'.format(', '.join('?' * len(run_ids)))
+    for row in conn.execute(query, list(run_ids)):
+        metrics = res[row['run_id']]
+        for column in EPOCH_COLUMNS:
+            metrics[column].append(_loads(row[column]))
+        metrics['lrs'].append(row['lr'])
+        metrics['epoch_times'].append(row['epoch_time'])
+    conn.close()
+    return res
+
+
+def get_runs_params(models_path, name_like=None, network_type=None, epoch=-1, with_curves=False):
+    # the runs in the same format as the model parameters, as expected by af.print_acc and af.plot_acc
+    runs = get_runs(models_path, name_like, network_type, epoch)
+    if with_curves and len(runs) > 0:
+        curves = get_epoch_metrics(models_path, [run['id'] for run in runs])
+        for run in runs:
+            run.update(curves[run['id']])
+    return runs
+
+
+def index_existing(models_path, load_params, missing_only=False):
+    # import of the models saved before the registry existed, or with missing_only of the ones it does not know
+    # (e.g. saved by a copy of the code without the registry), which only unpickles their parameters
+    # load_params is network_architectures.load_params, passed to avoid a circular import
+    indexed = set()
+    if missing_only:
+        conn = connect(models_path)
+        indexed = set((row['name'], row['epoch']) for row in conn.execute('SELECT name, epoch FROM runs'))
+        conn.close()
+    count = 0
+    for model_name in sorted(os.listdir(models_path)):
+        network_path = os.path.join(models_path, model_name)
+        for epoch, suffix in [(0, 'untrained'), (-1, 'last')]:
+            params_path = os.path.join(network_path, 'parameters_' + suffix)
+            if not os.path.isfile(params_path) or (model_name, epoch) in indexed:
+                continue
+            try:
+                model_params = load_params(models_path, model_name, epoch)
+            except Exception:
+                print('FAIL: {}'.format(params_path))
+                continue
+            record_model(models_path, model_name, epoch, model_params, os.path.join(network_path, suffix), params_path)
+            count += 1
+    print('{} models indexed in {}'.format(count, get_registry_path(models_path)))
+    return count
+
+
+if __name__ == '__main__':
+    # one time indexing of the models of a directory saved without the registry
+    import sys
+    import network_architectures as arcs
+
+    index_existing(sys.argv[1], arcs.load_params, missing_only=True)
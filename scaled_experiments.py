@@ -1,9 +1,43 @@
 import aux_funcs as af
 import network_architectures as arcs
 
+
 def train_model(models_path, params, device):
+    dataset = af.get_dataset('cifar10')
     res56_model, res56_params = arcs.create_resnet56(models_path, 'cifar10', 'd', return_model=True)
     dense_model, dense_params = arcs.create_dense_iterative(models_path, params)
+    res56_params['name'] = res56_params['base_model']
+    dense_params['name'] = dense_params['base_model'] + "_prune_{}".format([x * 100 for x in dense_params['keep_ratio']])
+
+    train_params = dict(
+        epochs=dense_params['epochs'],
+        epoch_growth=[25, 50, 75],
+        epoch_prune=[10, 35, 60, 85, 110, 135, 160],
+        prune_batch_size=128,
+        prune_type=dense_params['prune_type'],
+        reinit=False,
+        min_ratio=dense_params['min_ratio']
+    )
+    dense_params['epoch_growth'] = train_params['epoch_growth']
+    dense_params['epoch_prune'] = train_params['epoch_prune']
+
+    arr = []
+    for model, model_params in [(res56_model, res56_params), (dense_model, dense_params)]:
+        print("Training: {}".format(model_params['name']))
+        opti_param = (model_params['learning_rate'], model_params['weight_decay'], model_params['momentum'], -1)
+        lr_schedule_params = (model_params['milestones'], model_params['gammas'])
+        model.to(device)
+        optimizer, scheduler = af.get_full_optimizer(model, opti_param, lr_schedule_params)
+        metrics, best_model = model.train_func(model, dataset,
+                                               dict(train_params, epochs=model_params['epochs']),
+                                               optimizer, scheduler, device)
+        for key in ['test_top1_acc', 'test_top3_acc', 'valid_top1_acc', 'epoch_times', 'lrs', 'best_model_epoch']:
+            model_params[key] = metrics[key]
+        model_params['total_time'] = sum(metrics['epoch_times'])
+        model_params['flops'] = af.calculate_flops(best_model, (3, 32, 32))
+        arcs.save_model(best_model, model_params, models_path, model_params['name'], epoch=-1)
+        arr.append((best_model, model_params))
+    return arr
 
 
 if __name__=="__main__":
@@ -14,4 +48,7 @@ if __name__=="__main__":
         # keep_ratio, min_ratio, pruning mode
         ([0.46, 0.46, 0.46, 0.46], [0.1, 0.1, 0.1, 0.1], "2")
     ]
-    arr = [train_model(model_path, param, device) for param in create_params]
\ No newline at end of file
+    arr = [m for param in create_params for m in train_model(models_path, param, device)]
+    af.print_acc(arr)
+    for m, p in arr:
+        print("{}: flops: {}, training time: {}s".format(p['name'], p['flops'], p['total_time']))
@@ -0,0 +1,227 @@
+# search.py
+# successive halving over the placement of the ics, the pruning ratios and the growth epochs of ResNet_Baseline
+# trained with iter_training_0: every configuration of the population is trained for min_budget epochs, the best
+# 1/eta by the weighted validation score (mf.weighted_score) continue for eta times more epochs, and so on until
+# max_budget (the epochs of the lr schedule, so a run stopped at a rung is the beginning of the full training)
+# the runs are checkpointed at the end of every rung, a promoted run is restored and continues where it stopped
+# with proxy_ratio, proxy_ratio times more configurations are sampled and only the best by the zero-cost proxies
+# of proxies.py are trained
+# with a surrogate (surrogate.py), the runs whose predicted result is dominated by the finished runs of the history
+# are stopped at the end of their rung, even if they are in the best 1/eta
+
+import itertools
+import os
+import pickle
+import random
+
+import aux_funcs as af
+import checkpoint
+import iterative_experiments as ie
+import model_funcs as mf
+import network_architectures as arcs
+import proxies
+import surrogate as sg
+from architectures.SDNs.ResNet_Baseline import ResNet_Baseline
+
+SEARCH_SPACE = {
+    'ics': proxies.get_ics_placements(9, 3) + proxies.get_ics_placements(9, 2),
+    'keep_ratio': [0.2, 0.4, 0.6, 0.8],  # same ratio for every output
+    'min_ratio': [0.05, 0.1, 0.3],
+    'epoch_growth': [[25, 50, 75], [15, 30, 45], [40, 80, 120], [30, 60]],
+}
+
+
+def valid_config(config):
+    # the network grows once per ic
+    return len(config['epoch_growth']) == sum(config['ics'])
+
+
+def sample_configs(num_configs, space=SEARCH_SPACE):
+    keys = sorted(space.keys())
+    configs = [dict(zip(keys, values)) for values in itertools.product(*[space[k] for k in keys])]
+    configs = [c for c in configs if valid_config(c)]
+    random.shuffle(configs)
+    return configs[:num_configs]
+
+
+def config_name(config):
+    return 'search_ics_{}_keep_{}_min_{}_growth_{}'.format(
+        ''.join(str(i) for i in config['ics']), config['keep_ratio'], config['min_ratio'],
+        '_'.join(str(e) for e in config['epoch_growth']))
+
+
+class Run(object):
+    def __init__(self, config, type='iterative', mode='0', prune_batch_size=128):
+        self.config = config
+        self.name = config_name(config)
+        num_outputs = sum(config['ics']) + 1
+        keep_ratio = [config['keep_ratio']] * num_outputs
+        self.params = arcs.get_resnet_iterative_params(type, mode, (True, keep_ratio, prune_batch_size), config['ics'])
+        ie.set_schedule(self.params, type, mode)
+        self.params['name'] = self.name
+        self.train_params = ie.get_train_params(self.params, prune_batch_size)
+        self.train_params['epoch_growth'] = config['epoch_growth']
+        self.train_params['min_ratio'] = [config['min_ratio']] * num_outputs
+        self.params['epoch_growth'] = self.train_params['epoch_growth']
+        self.params['epoch_prune'] = self.train_params['epoch_prune']
+        self.params['min_ratio'] = self.train_params['min_ratio']
+        self.model = None
+        self.best_model = None
+        self.optimizer = None
+        self.scheduler = None
+        self.score = None
+
+    def create(self):
+        self.model = ResNet_Baseline(self.params)
+        opti_param = (self.params['learning_rate'], self.params['weight_decay'], self.params['momentum'], -1)
+        self.optimizer, self.scheduler = af.get_full_optimizer(
+            self.model, opti_param, (self.params['milestones'], self.params['gammas']))
+
+    def train(self, data, budget, device):
+        self.train_params['stop_epoch'] = budget
+        metrics, best_model = mf.iter_training_0(
+            self.model, data, self.train_params, self.optimizer, self.scheduler, device)
+        self.score = mf.weighted_score(metrics['valid_top1_acc'][-1])
+        return metrics, best_model
+
+    def save(self, search_path):
+        path = os.path.join(search_path, self.name)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        state = dict(self.train_params['state'])
+        if state['best_model'] is not None:
+            checkpoint.save(state['best_model'], os.path.join(path, 'best_model'))
+        state['best_model'] = None
+        checkpoint.save(self.model, os.path.join(path, 'model'))
+
+        names = {id(p): name for name, p in self.model.named_parameters()}
+        run = {
+            'config': self.config,
+            'params': self.params,
+            'train_params': dict(self.train_params, state=state),
+            'groups': [[names[id(p)] for p in group['params']] for group in self.optimizer.param_groups],
+            'optimizer': self.optimizer.state_dict(),
+            'scheduler': self.scheduler.state_dict(),
+            'score': self.score
+        }
+        with open(os.path.join(path, 'run'), 'wb') as f:
+            pickle.dump(run, f, pickle.HIGHEST_PROTOCOL)
+
+    def get_history_params(self):
+        # the parameters with the validation curve so far, as the runs of the history of the surrogate
+        return dict(self.params, valid_top1_acc=self.train_params['state']['metrics']['valid_top1_acc'])
+
+    def release(self):
+        # the run is on disk, the memory is given back before the next one is trained
+        self.model, self.optimizer, self.scheduler = None, None, None
+        if 'state' in self.train_params:
+            self.train_params['state']['best_model'] = None
+
+    @staticmethod
+    def load(search_path, name, device='cpu'):
+        path = os.path.join(search_path, name)
+        with open(os.path.join(path, 'run'), 'rb') as f:
+            saved = pickle.load(f)
+        run = Run.__new__(Run)
+        run.config, run.name, run.score, run.best_model = saved['config'], name, saved['score'], None
+        run.params, run.train_params = saved['params'], saved['train_params']
+        run.model = checkpoint.CheckpointReader(os.path.join(path, 'model')).restore(ResNet_Baseline(run.params))
+        run.model.to(device)
+        state = run.train_params['state']
+        if os.path.exists(os.path.join(path, 'best_model')):
+            state['best_model'] = checkpoint.CheckpointReader(os.path.join(path, 'best_model')).restore(
+                ResNet_Baseline(run.params))
+
+        # same parameter groups as the saved optimizer (the grown layers have their own groups)
+        params = dict(run.model.named_parameters())
+        groups = [{'params': [params[name] for name in group]} for group in saved['groups']]
+        run.optimizer = af.SGDForPruning(groups[:1], lr=run.params['learning_rate'],
+                                         momentum=run.params['momentum'], weight_decay=run.params['weight_decay'])
+        for group, saved_group in zip(groups[1:], saved['optimizer']['param_groups'][1:]):
+            group.update({k: v for k, v in saved_group.items() if k != 'params'})
+            run.optimizer.add_param_group(group)
+        run.scheduler = af.MultiStepMultiLR(run.optimizer, run.params['milestones'], run.params['gammas'])
+        # after the scheduler, its first step overwrites the learning rates
+        run.optimizer.load_state_dict(saved['optimizer'])
+        run.scheduler.load_state_dict(saved['scheduler'])
+        return run
+
+
+def get_budgets(min_budget, max_budget, eta):
+    budgets = [min_budget]
+    while budgets[-1] * eta < max_budget:
+        budgets.append(budgets[-1] * eta)
+    if budgets[-1] < max_budget:
+        budgets.append(max_budget)
+    return budgets
+
+
+def successive_halving(models_path, num_configs=27, min_budget=10, eta=3, max_budget=None, configs=None,
+                       type='iterative', mode='0', proxy_ratio=None, surrogate=None, history=None, device='cpu'):
+    search_path = os.path.join(models_path, 'search')
+    data = af.get_dataset('cifar10')
+    if configs is None:
+        configs = sample_configs(num_configs if proxy_ratio is None else num_configs * proxy_ratio)
+    if proxy_ratio is not None:  # before any training epoch
+        configs = proxies.filter_configs(configs, data.train_loader, num_configs, type, device=device)
+    runs = [Run(config, type, mode) for config in configs]
+    if max_budget is None:
+        max_budget = runs[0].params['epochs']
+    for run in runs:  # the last rung is the complete training
+        run.params['epochs'] = run.train_params['epochs'] = max_budget
+    budgets = get_budgets(min_budget, max_budget, eta)
+    print('search: {} configurations, budgets: {}'.format(len(runs), budgets))
+    front = sg.history_front(history) if surrogate is not None else None
+
+    for rung, budget in enumerate(budgets):
+        for i in range(len(runs)):
+            if 'state' in runs[i].train_params:  # promoted from the previous rung
+                runs[i] = Run.load(search_path, runs[i].name, device)
+            else:
+                runs[i].create()
+            run = runs[i]
+            print('\nrung {}, budget {}: {}'.format(rung, budget, run.name))
+            metrics, best_model = run.train(data, budget, device)
+            if budget == budgets[-1]:
+                ie._link_metrics(run.params, metrics)
+                run.best_model = best_model
+                # every finished run goes to the registry, the history of the surrogate
+                run.params['flops'] = af.calculate_flops(best_model, (3, 32, 32))
+                arcs.save_model(best_model, run.params, models_path, run.name, epoch=-1)
+            else:
+                run.save(search_path)
+                run.release()
+
+        runs.sort(key=lambda r: r.score, reverse=True)
+        for run in runs:
+            print('rung {} score: {:.2f} {}'.format(rung, run.score, run.name))
+        if budget != budgets[-1]:
+            runs = runs[:max(1, len(runs) // eta)]
+            if front is not None and budget >= surrogate.curve_epochs:
+                kept = [run for run in runs if not sg.is_dominated(surrogate, run.get_history_params(), front)]
+                for run in runs:
+                    if run not in kept:
+                        print('dominated, stopped: {}'.format(run.name))
+                runs = kept if len(kept) > 0 else runs[:1]
+
+    best = runs[0]
+    print('best configuration: {}, test acc: {}'.format(best.config, best.params['test_top1_acc']))
+    return best.best_model, best.params, runs
+
+
+if __name__ == '__main__':
+    import sys
+
+    random_seed = af.get_random_seed()
+    af.set_random_seeds()
+    num_configs = int(sys.argv[1]) if len(sys.argv) > 1 else 27
+    min_budget = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    eta = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    proxy_ratio = int(sys.argv[4]) if len(sys.argv) > 4 and sys.argv[4] != '-' else None
+    models_path = 'networks/{}'.format(random_seed)
+    surrogate, history = None, None
+    if len(sys.argv) > 5:  # epochs of validation curve seen by the surrogate
+        history = sg.load_history(models_path, curve_epochs=int(sys.argv[5]))
+        surrogate = sg.Surrogate(curve_epochs=int(sys.argv[5])).fit(history)
+    successive_halving(models_path, num_configs, min_budget, eta, proxy_ratio=proxy_ratio,
+                       surrogate=surrogate, history=history, device=af.get_pytorch_device())
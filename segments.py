@@ -0,0 +1,183 @@
+# segments.py
+# splits an SDN in per-exit segments for staged inference: trunk_k runs the network from the previous exit to
+# exit k and returns (handoff, exit input), ic_k computes the output of exit k from the exit input
+# the handoff is the activation given to trunk_k+1, so a request can be stopped after any exit and resumed
+# later or on another worker; the last segment runs the remaining blocks and its ic is the end layers
+# every segment is serialized on its own (torchscript or onnx) with a manifest describing the handoffs
+
+import json
+import os
+from typing import Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from static_sdn import StaticSDN, StaticBlock, SequentialTrunk
+
+MANIFEST_NAME = 'segments.json'
+
+
+class TrunkSegment(nn.Module):
+    def __init__(self, init_conv, blocks, last):
+        super(TrunkSegment, self).__init__()
+        self.init_conv = init_conv if init_conv is not None else nn.Identity()
+        self.blocks = nn.ModuleList(blocks)  # blocks without exit
+        self.last = last  # the block of the exit, its exit is computed by the ic segment
+
+    def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor]:
+        fwd = self.init_conv(x)
+        for block in self.blocks:
+            fwd, _ = block(fwd)
+        handoff, exit_input = self.last.trunk(fwd)
+        if self.last.dense:
+            handoff = torch.cat([fwd, handoff], 1)
+        return handoff, exit_input
+
+
+def split_sdn(model):
+    # [(trunk_0, ic_0), ..., (trunk_n, end_layers)]
+    static = StaticSDN(model)
+    static.eval()
+    segments = []
+    init_conv = static.init_conv
+    blocks = []
+    for block in static.blocks:
+        if not block.has_exit:
+            blocks.append(block)
+            continue
+        segments.append((TrunkSegment(init_conv, blocks, block), block.exit))
+        init_conv = None
+        blocks = []
+    # the final features are both the handoff and the input of the end layers
+    last = StaticBlock(SequentialTrunk(nn.Identity()), None)
+    segments.append((TrunkSegment(init_conv, blocks, last), static.end_layers))
+    return segments
+
+
+def _save_segment(module, example, path, fmt, input_names, output_names):
+    module.eval()
+    if fmt == 'torchscript':
+        torch.jit.save(torch.jit.script(module), path)
+    elif fmt == 'onnx':
+        torch.onnx.export(module, example, path, input_names=input_names, output_names=output_names,
+                          dynamic_axes={name: {0: 'batch'} for name in input_names + output_names})
+    else:
+        raise KeyError("the format should be either 'torchscript' or 'onnx' and it is: {}".format(fmt))
+
+
+def export_segments(model, export_path, input_size=32, fmt='torchscript'):
+    if not os.path.exists(export_path):
+        os.makedirs(export_path)
+    ext = 'pt' if fmt == 'torchscript' else 'onnx'
+    manifest = {'format': fmt, 'input_size': input_size, 'segments': []}
+
+    x = torch.rand(1, 3, input_size, input_size)
+    with torch.no_grad():
+        for k, (trunk, ic) in enumerate(split_sdn(model)):
+            handoff, exit_input = trunk(x)
+            trunk_name, ic_name = 'trunk_{}.{}'.format(k, ext), 'ic_{}.{}'.format(k, ext)
+            _save_segment(trunk, x, os.path.join(export_path, trunk_name), fmt, ['input'], ['handoff', 'exit_input'])
+            _save_segment(ic, exit_input, os.path.join(export_path, ic_name), fmt, ['exit_input'], ['output'])
+            manifest['segments'].append({
+                'trunk': trunk_name,
+                'ic': ic_name,
+                'input_shape': list(x.shape[1:]),
+                'handoff_shape': list(handoff.shape[1:]),
+                'exit_input_shape': list(exit_input.shape[1:])
+            })
+            x = handoff
+
+    with open(os.path.join(export_path, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    print('{} segments exported to {}'.format(len(manifest['segments']), export_path))
+    return manifest
+
+
+class _OnnxSegment(object):
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_names = [i.name for i in self.session.get_inputs()]
+
+    def __call__(self, x):
+        res = self.session.run(None, {self.input_names[0]: x.numpy()})
+        res = [torch.from_numpy(np.asarray(r)) for r in res]
+        return tuple(res) if len(res) > 1 else res[0]
+
+
+class StagedRunner(object):
+    # reference runner: the handoff of the requests that did not exit is cached until they are resumed
+    def __init__(self, export_path):
+        with open(os.path.join(export_path, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        self.export_path = export_path
+        self.num_segments = len(self.manifest['segments'])
+        self.loaded = {}
+        self.cache = {}  # key -> (next segment, handoff)
+
+    def _segment(self, name):
+        # the segments are only loaded when a request reaches them
+        if name not in self.loaded:
+            path = os.path.join(self.export_path, name)
+            if self.manifest['format'] == 'onnx':
+                self.loaded[name] = _OnnxSegment(path)
+            else:
+                self.loaded[name] = torch.jit.load(path)
+        return self.loaded[name]
+
+    def run_segment(self, k, x):
+        segment = self.manifest['segments'][k]
+        with torch.no_grad():
+            handoff, exit_input = self._segment(segment['trunk'])(x)
+            output = self._segment(segment['ic'])(exit_input)
+        return handoff, output
+
+    def submit(self, key, x):
+        # runs the first segment, returns the output of exit 0
+        return self.resume(key, x)
+
+    def resume(self, key, x=None):
+        # runs the next segment of the request from its cached handoff
+        k, handoff = self.cache.pop(key) if x is None else (0, x)
+        handoff, output = self.run_segment(k, handoff)
+        if k + 1 < self.num_segments:
+            self.cache[key] = (k + 1, handoff)
+        return k, output
+
+    def release(self, key):
+        self.cache.pop(key, None)
+
+    def run(self, x, threshold=0.9):
+        # early exit of a batch: the samples whose confidence reaches the threshold leave at their exit
+        # returns the outputs and the exit of every sample
+        outputs = [None] * x.size(0)
+        exits = [None] * x.size(0)
+        pending = torch.arange(x.size(0))
+        self.cache['batch'] = (0, x)
+        while len(pending) > 0:
+            k, output = self.resume('batch')
+            confidence = F.softmax(output, dim=1).max(1)[0]
+            done = confidence >= threshold if k + 1 < self.num_segments else torch.ones_like(confidence, dtype=torch.bool)
+            pending_ids = pending.tolist()
+            for i in torch.nonzero(done).view(-1).tolist():
+                outputs[pending_ids[i]] = output[i]
+                exits[pending_ids[i]] = k
+            pending = pending[~done]
+            if len(pending) > 0:
+                next_k, handoff = self.cache['batch']
+                self.cache['batch'] = (next_k, handoff[~done])
+        self.release('batch')
+        return torch.stack(outputs), exits
+
+
+if __name__ == '__main__':
+    import sys
+    import network_architectures as arcs
+
+    models_path, model_name, export_path = sys.argv[1], sys.argv[2], sys.argv[3]
+    fmt = sys.argv[4] if len(sys.argv) > 4 else 'torchscript'
+    model, model_params = arcs.load_model(models_path, model_name, epoch=-1)
+    input_size = int(model_params['input_size']) if 'input_size' in model_params else 32
+    export_segments(model, export_path, input_size, fmt)
@@ -7,6 +7,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+import timing
+
 
 def snip_forward_conv2d(self, x):
     return F.conv2d(x, self.weight * self.weight_mask, self.bias,
@@ -17,45 +19,58 @@ def snip_forward_linear(self, x):
     return F.linear(x, self.weight * self.weight_mask, self.bias)
 
 
-def snip(model, keep_ratio, train_dataloader, loss, device="cpu"):
-    inputs, targets = next(iter(train_dataloader))
-    inputs, targets = inputs.to(device), targets.to(device)
-    network = copy.deepcopy(model)
-
+def add_saliency_masks(network, reinit=False):
+    # a mask of ones on every conv and linear layer, the gradient of the loss for the mask is the saliency g.w
     for layer in network.modules():
         conv2 = isinstance(layer, nn.Conv2d)
         lin = isinstance(layer, nn.Linear)
         if conv2 or lin:
             layer.weight_mask = nn.Parameter(torch.ones_like(layer.weight))
-            nn.init.xavier_normal_(layer.weight)
+            if reinit:
+                nn.init.xavier_normal_(layer.weight)
             layer.weight.requires_grad = False
             if conv2:
                 layer.forward = types.MethodType(snip_forward_conv2d, layer)
             if lin:
                 layer.forward = types.MethodType(snip_forward_linear, layer)
+    return network
+
+
+def get_saliencies(network):
+    return [layer.weight_mask.grad for layer in network.modules()
+            if isinstance(layer, (nn.Conv2d, nn.Linear)) and layer.weight_mask.grad is not None]
+
+
+def snip(model, keep_ratio, train_dataloader, loss, device="cpu"):
+    inputs, targets = next(iter(train_dataloader))
+    inputs, targets = inputs.to(device), targets.to(device)
+    with timing.span('snip_deepcopy'):
+        network = copy.deepcopy(model)
+
+    add_saliency_masks(network, reinit=True)
 
     network.to(device)
     network.zero_grad()
-    outputs = network(inputs)
-    total_loss = loss(outputs, targets)
-    total_loss.backward()
+    with timing.span('snip_forward_backward'):
+        outputs = network(inputs)
+        total_loss = loss(outputs, targets)
+        total_loss.backward()
 
-    grads_abs = []
-    for layer in network.modules():
-        if isinstance(layer, nn.Conv2d) or isinstance(layer, nn.Linear):
-            if layer.weight_mask.grad is not None:
-                grads_abs.append(torch.abs(layer.weight_mask.grad))
-    all_scores = torch.cat([torch.flatten(x) for x in grads_abs])
-    norm_factor = torch.sum(all_scores)
-    all_scores.div_(norm_factor)
+    with timing.span('snip_scores'):
+        grads_abs = [torch.abs(g) for g in get_saliencies(network)]
+        all_scores = torch.cat([torch.flatten(x) for x in grads_abs])
+        norm_factor = torch.sum(all_scores)
+        all_scores.div_(norm_factor)
 
-    num_params_to_keep = int(len(all_scores) * keep_ratio)
-    threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-    acceptable_score = threshold[-1]
+    with timing.span('snip_topk'):
+        num_params_to_keep = int(len(all_scores) * keep_ratio)
+        threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
+        acceptable_score = threshold[-1]
 
-    keep_masks = []
-    for g in grads_abs:
-        keep_masks.append(((g / norm_factor) >= acceptable_score).float())
+    with timing.span('snip_masks'):
+        keep_masks = []
+        for g in grads_abs:
+            keep_masks.append(((g / norm_factor) >= acceptable_score).float())
 
     return (keep_masks)
 
@@ -82,7 +97,8 @@ def apply_prune_mask(model, masks):
 def snip_skip_layers(model, keep_ratio, loader, loss, index_to_prune, previous_masks, device='cpu', reinit=True):
     inputs, targets = next(iter(loader))
     inputs, targets = inputs.to(device), targets.to(device)
-    _model = copy.deepcopy(model)
+    with timing.span('snip_deepcopy'):
+        _model = copy.deepcopy(model)
 
     blocks = get_blocs(_model)
 
@@ -90,22 +106,14 @@ def snip_skip_layers(model, keep_ratio, loader, loss, index_to_prune, previous_m
         print("index out of bloc range: index {}, number of blocks {}".format(index_to_prune, len(blocks)))
         return None
     
-    for layer in _model.modules():
-        conv2 = isinstance(layer, nn.Conv2d)
-        lin = isinstance(layer, nn.Linear)
-        if conv2 or lin:
-            layer.weight_mask = nn.Parameter(torch.ones_like(layer.weight))
-            layer.weight.requires_grad = False
-            if conv2:
-                layer.forward = types.MethodType(snip_forward_conv2d, layer)
-            if lin:
-                layer.forward = types.MethodType(snip_forward_linear, layer)
+    add_saliency_masks(_model)
 
     _model.to(device)
     _model.zero_grad()
-    outputs = _model(inputs)
-    total_loss = loss(outputs, targets)
-    total_loss.backward()
+    with timing.span('snip_forward_backward'):
+        outputs = _model(inputs)
+        total_loss = loss(outputs, targets)
+        total_loss.backward()
 
     masks = []
     for idx, bloc in enumerate(blocks):
@@ -119,16 +127,19 @@ def snip_skip_layers(model, keep_ratio, loader, loss, index_to_prune, previous_m
         if len(grads_abs) == 0:
             masks.append([])
             continue
-        all_scores = torch.cat([torch.flatten(x) for x in grads_abs])
-        norm_factor = torch.sum(all_scores)
-        all_scores.div_(norm_factor)
-        num_params_to_keep = int(len(all_scores) * keep_ratio[idx])
-        threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-        acceptable_score = threshold[-1]
-
-        keep_masks = []
-        for g in grads_abs:
-            keep_masks.append(((g / norm_factor) >= acceptable_score).float())
+        with timing.span('snip_scores'):
+            all_scores = torch.cat([torch.flatten(x) for x in grads_abs])
+            norm_factor = torch.sum(all_scores)
+            all_scores.div_(norm_factor)
+        with timing.span('snip_topk'):
+            num_params_to_keep = int(len(all_scores) * keep_ratio[idx])
+            threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
+            acceptable_score = threshold[-1]
+
+        with timing.span('snip_masks'):
+            keep_masks = []
+            for g in grads_abs:
+                keep_masks.append(((g / norm_factor) >= acceptable_score).float())
         masks.append(keep_masks)
     
     if previous_masks is not None:
@@ -153,36 +164,25 @@ def apply_prune_mask_skip_layers(model, masks, index_to_prune):
             assert (layer.weight.shape == msk.shape)
 
             layer.weight.data[msk == 0.] = 0.
-            layer.register_parameter('weight_mask', nn.Parameter(msk))
-            layer.weight_mask.requires_grad = False
-            if isinstance(layer, nn.Linear):
-                layer.forward = types.MethodType(snip_forward_linear, layer) 
-            if isinstance(layer, nn.Conv2d):
-                layer.forward = types.MethodType(snip_forward_conv2d, layer)             
+            set_prune_mask(layer, msk)
+
 
 def snip_bloc_iterative(model, keep_ratio, mini_ratio, steps, loader, loss, device='cpu', reinit=True):
     # mini_ratio is now an array for every bloc
     inputs, targets = next(iter(loader))
     inputs, targets = inputs.to(device), targets.to(device)
-    _model = copy.deepcopy(model)
+    with timing.span('snip_deepcopy'):
+        _model = copy.deepcopy(model)
 
     blocks = get_blocs(_model)
-    for layer in _model.modules():
-        conv2 = isinstance(layer, nn.Conv2d)
-        lin = isinstance(layer, nn.Linear)
-        if conv2 or lin:
-            layer.weight_mask = nn.Parameter(torch.ones_like(layer.weight))
-            layer.weight.requires_grad = False
-            if conv2:
-                layer.forward = types.MethodType(snip_forward_conv2d, layer)
-            if lin:
-                layer.forward = types.MethodType(snip_forward_linear, layer)
+    add_saliency_masks(_model)
 
     _model.to(device)
     _model.zero_grad()
-    outputs = _model(inputs)
-    total_loss = loss(outputs, targets)
-    total_loss.backward()
+    with timing.span('snip_forward_backward'):
+        outputs = _model(inputs)
+        total_loss = loss(outputs, targets)
+        total_loss.backward()
 
     # ranger les gradients par blocs
     masks = []
@@ -194,21 +194,24 @@ def snip_bloc_iterative(model, keep_ratio, mini_ratio, steps, loader, loss, devi
         if len(grads_abs) == 0:
             masks.append([])
             continue
-        all_scores = torch.cat([torch.flatten(x) for x in grads_abs])
-        norm_factor = torch.sum(all_scores)
-        all_scores.div_(norm_factor)
+        with timing.span('snip_scores'):
+            all_scores = torch.cat([torch.flatten(x) for x in grads_abs])
+            norm_factor = torch.sum(all_scores)
+            all_scores.div_(norm_factor)
 
         intern_keep_ratio = keep_ratio[idx] ** (steps[idx] + 1)
         if mini_ratio is not None:
             intern_keep_ratio = intern_keep_ratio if intern_keep_ratio > mini_ratio[idx] else mini_ratio[idx]
         print("keep ratio {}: {}".format(idx, intern_keep_ratio))
 
-        num_params_to_keep = int(len(all_scores) * intern_keep_ratio)
-        threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
-        acceptable_score = threshold[-1]
-        keep_masks = []
-        for g in grads_abs:
-            keep_masks.append(((g/norm_factor) >= acceptable_score).float())
+        with timing.span('snip_topk'):
+            num_params_to_keep = int(len(all_scores) * intern_keep_ratio)
+            threshold, _ = torch.topk(all_scores, num_params_to_keep, sorted=True)
+            acceptable_score = threshold[-1]
+        with timing.span('snip_masks'):
+            keep_masks = []
+            for g in grads_abs:
+                keep_masks.append(((g/norm_factor) >= acceptable_score).float())
         masks.append(keep_masks)
     return masks
 
@@ -228,13 +231,17 @@ def apply_prune_mask_bloc_iterative(model, masks):
             # fuse the weight masks
             if hasattr(layer, 'weight_mask'):
                 msk = msk*layer.weight_mask
-            layer.register_parameter('weight_mask', nn.Parameter(msk))
-            layer.weight_mask.requires_grad = False
+            set_prune_mask(layer, msk)
+
+
+def set_prune_mask(layer, mask):
+    # the masked weights are not updated anymore, also used to restore the masks of a checkpoint
+    layer.register_parameter('weight_mask', nn.Parameter(mask, requires_grad=False))
+    if isinstance(layer, nn.Linear):
+        layer.forward = types.MethodType(snip_forward_linear, layer)
+    if isinstance(layer, nn.Conv2d):
+        layer.forward = types.MethodType(snip_forward_conv2d, layer)
 
-            if isinstance(layer, nn.Linear):
-                layer.forward = types.MethodType(snip_forward_linear, layer) 
-            if isinstance(layer, nn.Conv2d):
-                layer.forward = types.MethodType(snip_forward_conv2d, layer)
 
 def get_blocs(_model):
     indexes = [0]
@@ -256,28 +263,21 @@ def get_blocs(_model):
 def snip_skip_dense(model, keep_ratio, keep_dense, loader, loss, index_to_prune, previous_masks, device):
     inputs, targets = next(iter(loader))
     inputs, targets = inputs.to(device), targets.to(device)
-    _model = copy.deepcopy(model)
+    with timing.span('snip_deepcopy'):
+        _model = copy.deepcopy(model)
 
     blocks = get_blocs(_model)
     if index_to_prune >= len(blocks):
         print("index out of bloc range: index {}, number of blocks {}".format(index_to_prune, len(blocks)))
         return None
-    for layer in _model.modules():
-        conv2 = isinstance(layer, nn.Conv2d)
-        lin = isinstance(layer, nn.Linear)
-        if conv2 or lin:
-            layer.weight_mask = nn.Parameter(torch.ones_like(layer.weight))
-            layer.weight.requires_grad = False
-            if conv2:
-                layer.forward = types.MethodType(snip_forward_conv2d, layer)
-            if lin:
-                layer.forward = types.MethodType(snip_forward_linear, layer)
-    
+    add_saliency_masks(_model)
+
     _model.to(device)
     _model.zero_grad()
-    outputs = _model(inputs)
-    total_loss = loss(outputs, targets)
-    total_loss.backward()
+    with timing.span('snip_forward_backward'):
+        outputs = _model(inputs)
+        total_loss = loss(outputs, targets)
+        total_loss.backward()
 
     masks = []
     for idx, bloc in enumerate(blocks):
@@ -288,7 +288,6 @@ def snip_skip_dense(model, keep_ratio, keep_dense, loader, loss, index_to_prune,
         grads_abs_dense = []
         for layer in bloc.modules():
             conv = isinstance(layer, nn.Conv2d)
-            lin = isinstance(layer, nn.Linear)
             if conv and layer.in_channel != 16:
                 print("layer with dense connection: {}, {}".format(layer, layer.weight_mask.grad.shape))
                 #grads_abs_dense = 0 # TODO:dissociate dense and normal connections
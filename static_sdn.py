@@ -0,0 +1,208 @@
+# static_sdn.py
+# compile-friendly version of the SDNs for torch.jit.script and torch.compile
+# the models bind their forward at run time (only_forward, to_train/to_eval, the snip masks patched with
+# types.MethodType) and their blocks return (fwd, is_output, output), which breaks scripting and graph capture
+# here every block is rebuilt with a single forward returning (next input, exit output), the exits are fixed
+# when the model is built and the pruning masks are buffers of MaskedConv2d/MaskedLinear
+# the forward returns a List[Tensor] (one output per exit) since a variable length tuple cannot be scripted
+
+import copy
+import time
+from typing import List
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import aux_funcs as af
+from architectures.SDNs.DenseNet import ConvBNRLUnit
+from architectures.SDNs.MobileNet_SDN import BlockWOutput
+from architectures.SDNs.ResNet_SDN import BasicBlockWOutput
+from architectures.SDNs.VGG_SDN import ConvBlockWOutput, FcBlockWOutput
+from architectures.SDNs.WideResNet_SDN import wide_basic
+
+
+class MaskedConv2d(nn.Module):
+    def __init__(self, conv):
+        super(MaskedConv2d, self).__init__()
+        self.weight = conv.weight
+        self.bias = conv.bias
+        self.register_buffer('mask', conv.weight_mask.detach().clone())
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+
+    def forward(self, x):
+        return F.conv2d(x, self.weight * self.mask, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+
+class MaskedLinear(nn.Module):
+    def __init__(self, linear):
+        super(MaskedLinear, self).__init__()
+        self.weight = linear.weight
+        self.bias = linear.bias
+        self.register_buffer('mask', linear.weight_mask.detach().clone())
+
+    def forward(self, x):
+        return F.linear(x, self.weight * self.mask, self.bias)
+
+
+def replace_masked_layers(module):
+    for name, child in module._modules.items():
+        if child is None:
+            continue
+        if 'weight_mask' in child._parameters:
+            if isinstance(child, nn.Conv2d):
+                module._modules[name] = MaskedConv2d(child)
+            elif isinstance(child, nn.Linear):
+                module._modules[name] = MaskedLinear(child)
+        else:
+            replace_masked_layers(child)
+    return module
+
+
+class StaticInternalClassifier(nn.Module):
+    def __init__(self, ic):
+        super(StaticInternalClassifier, self).__init__()
+        self.linear = ic.linear
+        self.pooling = hasattr(ic, 'alpha')
+        if self.pooling:
+            self.max_pool = ic.max_pool
+            self.avg_pool = ic.avg_pool
+            self.alpha = ic.alpha
+        else:  # not used, the attributes have to exist to be scripted
+            self.max_pool = nn.Identity()
+            self.avg_pool = nn.Identity()
+            self.register_buffer('alpha', torch.ones(1))
+
+    def forward(self, x):
+        if self.pooling:
+            x = self.alpha * self.max_pool(x) + (1 - self.alpha) * self.avg_pool(x)
+        return self.linear(x.view(x.size(0), -1))
+
+
+class ResidualTrunk(nn.Module):
+    # BasicBlockWOutput (the exit reads the features before the activation) and wide_basic (no activation)
+    def __init__(self, layers, shortcut, activation):
+        super(ResidualTrunk, self).__init__()
+        self.layers = layers
+        self.shortcut = shortcut
+        self.activation = activation
+
+    def forward(self, x):
+        fwd = self.layers(x) + self.shortcut(x)
+        return self.activation(fwd), fwd
+
+
+class SequentialTrunk(nn.Module):
+    def __init__(self, layers):
+        super(SequentialTrunk, self).__init__()
+        self.layers = layers
+
+    def forward(self, x):
+        fwd = self.layers(x)
+        return fwd, fwd
+
+
+class StaticBlock(nn.Module):
+    def __init__(self, trunk, exit, dense=False):
+        super(StaticBlock, self).__init__()
+        self.trunk = trunk
+        self.has_exit = exit is not None
+        self.exit = exit if exit is not None else nn.Identity()
+        # dense connectivity: the next block sees the concatenation of the input and the new features
+        self.dense = dense
+
+    def forward(self, x):
+        fwd, exit_input = self.trunk(x)
+        if self.dense:
+            fwd = torch.cat([x, fwd], 1)
+        return fwd, self.exit(exit_input)
+
+
+def get_static_block(block, dense=False):
+    if isinstance(block, BasicBlockWOutput):
+        trunk = ResidualTrunk(block.layers[0], block.layers[1], block.layers[2])
+    elif isinstance(block, wide_basic):
+        trunk = ResidualTrunk(block.layers[0], block.layers[1], nn.Identity())
+    elif isinstance(block, (BlockWOutput, ConvBlockWOutput, FcBlockWOutput, ConvBNRLUnit)):
+        trunk = SequentialTrunk(block.layers)
+    else:
+        raise NotImplementedError("no static version of the block: {}".format(type(block).__name__))
+
+    exit = None
+    if not block.no_output:
+        exit = StaticInternalClassifier(block.output) if isinstance(block.output, af.InternalClassifier) else block.output
+    return StaticBlock(trunk, exit, dense)
+
+
+class StaticSDN(nn.Module):
+    # inference structure of the model: the final output is always computed
+    def __init__(self, model):
+        super(StaticSDN, self).__init__()
+        model = replace_masked_layers(copy.deepcopy(model))
+        dense = getattr(model, 'init_type', None) == 'dense'
+        self.init_conv = model.init_conv
+        self.blocks = nn.ModuleList([get_static_block(layer, dense) for layer in model.layers])
+        self.end_layers = model.end_layers
+        self.num_output = sum([block.has_exit for block in self.blocks]) + 1
+
+    def forward(self, x):
+        outputs: List[torch.Tensor] = []
+        fwd = self.init_conv(x)
+        for block in self.blocks:
+            fwd, output = block(fwd)
+            if block.has_exit:
+                outputs.append(output)
+        outputs.append(self.end_layers(fwd))
+        return outputs
+
+
+def _forward_time(model, x, repeats, warmup):
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(x)
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            model(x)
+    return (time.perf_counter() - start_time) / repeats
+
+
+def compile_sdn(model, mode='script', input_size=32, batch_size=64, repeats=20, warmup=5):
+    # mode: 'script' (torch.jit.script, frozen) or 'compile' (torch.compile, pytorch 2)
+    # returns the compiled module and its speedup over the eager model on cpu
+    model = copy.deepcopy(model).cpu()
+    model.eval()
+    if hasattr(model, 'to_eval'):
+        model.to_eval()
+    static = StaticSDN(model)
+    static.eval()
+
+    if mode == 'script':
+        compiled = torch.jit.freeze(torch.jit.script(static))
+    elif mode == 'compile':
+        compiled = torch.compile(static)
+    else:
+        raise KeyError("the mode should be either 'script' or 'compile' and it is: {}".format(mode))
+
+    x = torch.rand(batch_size, 3, input_size, input_size)
+    with torch.no_grad():
+        diffs = [float((a - b).abs().max()) for a, b in zip(model(x), compiled(x))]
+    eager_time = _forward_time(model, x, repeats, warmup)
+    compiled_time = _forward_time(compiled, x, repeats, warmup)
+    speedup = eager_time / compiled_time
+    print('{}: max output difference: {:.2e}, eager: {:.2f}ms, compiled: {:.2f}ms, speedup: {:.2f}x'.format(
+        mode, max(diffs), 1000 * eager_time, 1000 * compiled_time, speedup))
+    return compiled, speedup
+
+
+if __name__ == '__main__':
+    import sys
+    import network_architectures as arcs
+
+    models_path, model_name = sys.argv[1], sys.argv[2]
+    mode = sys.argv[3] if len(sys.argv) > 3 else 'script'
+    model, model_params = arcs.load_model(models_path, model_name, epoch=-1)
+    input_size = int(model_params['input_size']) if 'input_size' in model_params else 32
+    compile_sdn(model, mode, input_size)
@@ -0,0 +1,199 @@
+# surrogate.py
+# surrogate model of the experiment history (registry): an ensemble of small mlps predicts the final test accuracy
+# of every exit and the flops of a run from its configuration (ics, dense or iterative, keep_ratio, min_ratio,
+# epoch_growth) and, optionally, from the validation curve of its first epochs
+# used to stop the runs whose predicted result is dominated on the accuracy/flops plane by a finished run, and to
+# propose the next configurations on the pareto front
+
+import math
+import pickle
+
+import torch
+import torch.nn as nn
+
+import model_funcs as mf
+import registry
+
+MAX_SIZE = 16  # blocks of the network
+MAX_OUTPUTS = 8  # exits, final output included
+
+
+def _pad(values, length, fill=0.):
+    if values is None:
+        values = []
+    elif not isinstance(values, (list, tuple)):  # same ratio for every exit
+        values = [values] * length
+    values = [float(v) for v in values][:length]
+    return values + [fill] * (length - len(values))
+
+
+def get_features(run, curve_epochs=0):
+    # run: model parameters, from the registry or from a running training (with its valid_top1_acc so far)
+    epochs = float(run['epochs']) if run.get('epochs') else 1.
+    features = _pad(run.get('ics'), MAX_SIZE)
+    features.append(len(run.get('ics') or []) / float(MAX_SIZE))
+    features.append(1. if run.get('init_type') == 'dense' else 0.)
+    features += _pad(run.get('keep_ratio'), MAX_OUTPUTS, 1.)
+    features += _pad(run.get('min_ratio'), MAX_OUTPUTS)
+    features += [e / epochs for e in _pad(run.get('epoch_growth'), MAX_OUTPUTS - 1)]
+    curve = run.get('valid_top1_acc') or []
+    for epoch in range(curve_epochs):
+        accuracies = curve[min(epoch, len(curve) - 1)] if len(curve) > 0 else []
+        features += [a / 100. for a in _pad(accuracies, MAX_OUTPUTS)]
+    return features
+
+
+def get_targets(run):
+    accuracies = run['test_top1_acc']
+    mask = [1.] * min(len(accuracies), MAX_OUTPUTS) + [0.] * (MAX_OUTPUTS - len(accuracies))
+    return [a / 100. for a in _pad(accuracies, MAX_OUTPUTS)], mask, math.log10(run['flops'])
+
+
+def load_history(models_path, network_type='resnet_iterative', curve_epochs=0):
+    # the finished runs with their test accuracies, flops and at least curve_epochs epochs of curves
+    runs = registry.get_runs_params(models_path, network_type=network_type, with_curves=True)
+    return [run for run in runs if run.get('test_top1_acc') and run.get('flops')
+            and len(run.get('valid_top1_acc') or []) >= curve_epochs]
+
+
+class SurrogateMLP(nn.Module):
+    def __init__(self, num_features, hidden=64):
+        super(SurrogateMLP, self).__init__()
+        self.body = nn.Sequential(nn.Linear(num_features, hidden), nn.ReLU(), nn.Linear(hidden, hidden), nn.ReLU())
+        self.accuracy = nn.Linear(hidden, MAX_OUTPUTS)
+        self.flops = nn.Linear(hidden, 1)
+
+    def forward(self, x):
+        h = self.body(x)
+        return torch.sigmoid(self.accuracy(h)), self.flops(h).squeeze(1)
+
+
+class Surrogate(object):
+    def __init__(self, curve_epochs=0, hidden=64, num_models=5):
+        self.curve_epochs = curve_epochs
+        self.hidden = hidden
+        self.num_models = num_models  # ensemble: the spread of the predictions is the uncertainty
+        self.models = []
+        self.stats = None
+
+    def _inputs(self, runs):
+        x = torch.tensor([get_features(run, self.curve_epochs) for run in runs], dtype=torch.float32)
+        return (x - self.stats['x_mean']) / self.stats['x_std']
+
+    def fit(self, runs, epochs=500, lr=1e-3, weight_decay=1e-4):
+        if len(runs) < 2:
+            raise ValueError("the surrogate needs at least 2 finished runs, got: {}".format(len(runs)))
+        x = torch.tensor([get_features(run, self.curve_epochs) for run in runs], dtype=torch.float32)
+        targets = [get_targets(run) for run in runs]
+        accuracy = torch.tensor([t[0] for t in targets])
+        mask = torch.tensor([t[1] for t in targets])
+        flops = torch.tensor([t[2] for t in targets])
+        self.stats = {
+            'x_mean': x.mean(0), 'x_std': x.std(0).clamp(min=1e-6),
+            'flops_mean': flops.mean(), 'flops_std': flops.std().clamp(min=1e-6)
+        }
+        x = (x - self.stats['x_mean']) / self.stats['x_std']
+        flops = (flops - self.stats['flops_mean']) / self.stats['flops_std']
+
+        self.models = []
+        for _ in range(self.num_models):
+            model = SurrogateMLP(x.size(1), self.hidden)
+            optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=weight_decay)
+            sample = torch.randint(0, x.size(0), (x.size(0),))  # bootstrap
+            for _ in range(epochs):
+                optimizer.zero_grad()
+                pred_accuracy, pred_flops = model(x[sample])
+                loss = (((pred_accuracy - accuracy[sample]) ** 2) * mask[sample]).sum() / mask[sample].sum()
+                loss = loss + ((pred_flops - flops[sample]) ** 2).mean()
+                loss.backward()
+                optimizer.step()
+            model.eval()
+            self.models.append(model)
+        return self
+
+    def predict(self, runs):
+        # accuracies of the exits (mean and std over the ensemble, in %) and flops
+        x = self._inputs(runs)
+        with torch.no_grad():
+            preds = [model(x) for model in self.models]
+        accuracy = 100. * torch.stack([p[0] for p in preds])
+        flops = torch.stack([p[1] for p in preds]).mean(0) * self.stats['flops_std'] + self.stats['flops_mean']
+        res = []
+        for i, run in enumerate(runs):
+            num_outputs = sum(run['ics']) + 1
+            res.append({
+                'accuracy': accuracy[:, i, :num_outputs].mean(0).tolist(),
+                'accuracy_std': accuracy[:, i, :num_outputs].std(0).tolist(),
+                'flops': float(10 ** flops[i])
+            })
+        return res
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def get_score(accuracies):
+    # the objective of the accuracy axis is the score of the search runs
+    return mf.weighted_score(accuracies)
+
+
+def pareto_front(points):
+    # points: [(score, flops)], the indices of the points not dominated (higher score with fewer flops)
+    front = []
+    for i, (score, flops) in enumerate(points):
+        dominated = any(s >= score and f <= flops and (s > score or f < flops) for s, f in points)
+        if not dominated:
+            front.append(i)
+    return front
+
+
+def history_front(runs):
+    points = [(get_score(run['test_top1_acc']), run['flops']) for run in runs]
+    return [points[i] for i in pareto_front(points)]
+
+
+def is_dominated(surrogate, run, front, optimism=1.):
+    # run is stopped only if even an optimistic prediction (mean + optimism std) is dominated by a finished run
+    pred = surrogate.predict([run])[0]
+    score = get_score([a + optimism * s for a, s in zip(pred['accuracy'], pred['accuracy_std'])])
+    return any(s >= score and f <= pred['flops'] for s, f in front)
+
+
+def propose(surrogate, candidates, history, num_configs=8, optimism=1.):
+    # the candidates (model parameters without curves) on the predicted pareto front, the ones that improve the
+    # front of the history the most first
+    preds = surrogate.predict(candidates)
+    points = [(get_score([a + optimism * s for a, s in zip(p['accuracy'], p['accuracy_std'])]), p['flops'])
+              for p in preds]
+    front = history_front(history)
+    chosen = []
+    remaining = list(range(len(candidates)))
+    while len(chosen) < num_configs and len(remaining) > 0:
+        layer = [remaining[i] for i in pareto_front([points[i] for i in remaining])]
+        # gain over the best finished run that needs at most the same flops
+        layer.sort(key=lambda i: points[i][0] - max([s for s, f in front if f <= points[i][1]] + [0.]), reverse=True)
+        chosen.extend(layer[:num_configs - len(chosen)])
+        remaining = [i for i in remaining if i not in layer]
+    for i in chosen:
+        print('proposed: ics {}, keep_ratio {}, predicted accuracies {}, flops {:.3g}'.format(
+            candidates[i]['ics'], candidates[i].get('keep_ratio'),
+            [round(a, 2) for a in preds[i]['accuracy']], preds[i]['flops']))
+    return [candidates[i] for i in chosen]
+
+
+if __name__ == '__main__':
+    import sys
+    import search
+
+    models_path = sys.argv[1]
+    num_configs = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    history = load_history(models_path)
+    surrogate = Surrogate().fit(history)
+    candidates = [search.Run(config).params for config in search.sample_configs(1000)]
+    propose(surrogate, candidates, history, num_configs)
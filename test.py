@@ -45,6 +45,28 @@ def main():
 
     #af.plot_acc([params])
 
+def check_growth():
+    # every grown cell must get a gradient, for every init type and growth init
+    from architectures.SDNs.ResNet_Baseline import ResNet_Baseline
+    images, labels = next(iter(af.get_dataset('synthetic_cifar10', 32).train_loader))
+    for init_type in ['iterative', 'dense']:
+        for growth_init in ['kaiming', 'zero', 'copy']:
+            model = ResNet_Baseline(arcs.get_resnet_iterative_params(init_type, None, (False, 1., 0),
+                                                                    growth_init=growth_init))
+            model.to_train()
+            for _ in range(model.num_ics):
+                first = len(model.layers)
+                model.grow()
+                dead = af.get_dead_cells(model, model.layers[first:], images, labels)
+                if len(dead) > 0:
+                    raise ValueError("{} {}: the grown cells {} get no gradient".format(
+                        init_type, growth_init, [first + i for i in dead]))
+            print("{} {}: every grown cell gets a gradient".format(init_type, growth_init))
+
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == 'growth':
+        check_growth()
+    else:
+        main()
 
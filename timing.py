@@ -0,0 +1,174 @@
+# timing.py
+# span timers of the hot paths of the training: "with timing.span('backward'):" adds the wall time of the block to
+# the total and the count of its span name, epoch_routine moves the totals of the epoch into metrics['timings']
+# disabled by default: span() then returns a shared null context, the instrumentation costs a call and a test
+# with sync=True the cuda kernels are waited for at the start and end of every span (exact but slower on gpu)
+# during a torch.profiler window (profiler.TrainingProfiler) the spans are also labeled with record_function
+
+import time
+import weakref
+
+import torch
+
+_enabled = False
+_sync = False
+_record = False
+_totals = {}
+_counts = {}
+
+
+def enable(flag=True, sync=False):
+    global _enabled, _sync
+    _enabled = flag
+    _sync = sync and torch.cuda.is_available()
+
+
+def is_enabled():
+    return _enabled
+
+
+# a timed training restores the state it found, the spans of one training do not leak into the next ones
+def get_state():
+    return _enabled, _sync
+
+
+def set_state(state):
+    global _enabled, _sync
+    _enabled, _sync = state
+
+
+def set_record_function(flag):
+    global _record
+    _record = flag
+
+
+def _now():
+    if _sync:
+        torch.cuda.synchronize()
+    return time.perf_counter()
+
+
+def add(name, seconds, count=1):
+    _totals[name] = _totals.get(name, 0.) + seconds
+    _counts[name] = _counts.get(name, 0) + count
+
+
+class _Span(object):
+    __slots__ = ('name', 'start', 'region')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.region = None
+
+    def __enter__(self):
+        if _record:
+            self.region = torch.autograd.profiler.record_function(self.name)
+            self.region.__enter__()
+        if _enabled:
+            self.start = _now()
+        return self
+
+    def __exit__(self, *args):
+        if self.start is not None:
+            add(self.name, _now() - self.start)
+        if self.region is not None:
+            self.region.__exit__(*args)
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    return _Span(name) if _enabled or _record else _NULL_SPAN
+
+
+def iterate(loader, name='data'):
+    # the time spent waiting for each batch of the loader
+    if not _enabled:
+        for batch in loader:
+            yield batch
+        return
+    iterator = iter(loader)
+    while True:
+        start = _now()
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return
+        add(name, _now() - start)
+        yield batch
+
+
+# forward time of each exit: from the previous exit (or the input) to the block that computes the exit,
+# the blocks return (fwd, is_output, output)
+_forward = {'mark': None, 'exit': 0}
+_watched = weakref.WeakSet()
+
+
+def _forward_start(module, input):
+    if _enabled:
+        _forward['mark'], _forward['exit'] = _now(), 0
+
+
+def _block_end(module, input, output):
+    if not _enabled or _forward['mark'] is None:
+        return
+    if isinstance(output, tuple) and len(output) == 3 and output[1]:
+        now = _now()
+        add('forward_exit_{}'.format(_forward['exit']), now - _forward['mark'])
+        _forward['mark'], _forward['exit'] = now, _forward['exit'] + 1
+
+
+def _forward_end(module, input, output):
+    if _enabled and _forward['mark'] is not None:
+        add('forward_end', _now() - _forward['mark'])
+        _forward['mark'] = None
+
+
+def watch_exits(model):
+    # called again after a growth, only the new blocks get hooks
+    if not _enabled:
+        return
+    if model not in _watched:
+        model.register_forward_pre_hook(_forward_start)
+        model.register_forward_hook(_forward_end)
+        _watched.add(model)
+    for block in getattr(model, 'layers', []):
+        if block not in _watched:
+            block.register_forward_hook(_block_end)
+            _watched.add(block)
+
+
+def reset():
+    _totals.clear()
+    _counts.clear()
+
+
+def summary():
+    return {name: {'time': _totals[name], 'count': _counts[name]} for name in sorted(_totals)}
+
+
+def pop_summary():
+    res = summary()
+    reset()
+    return res
+
+
+def print_summary(timings):
+    # the spans are nested, the percentages are of the whole epoch
+    total = timings['epoch']['time'] if 'epoch' in timings else sum([t['time'] for t in timings.values()])
+    for name, t in sorted(timings.items(), key=lambda item: -item[1]['time']):
+        print('{:>20}: {:9.3f}s {:6.1f}% {:8d} calls {:9.3f}ms/call'.format(
+            name, t['time'], 100. * t['time'] / total if total > 0 else 0., t['count'], 1000. * t['time'] / t['count']))